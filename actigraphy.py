@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import argparse, glob, os, time
+from collections import deque
+
+import numpy as np
+
+import sessionfile
+from constants import SLEEP_STAGES
+
+# Sleep/wake staging from the movement and heartrate streams.
+#   Movement is summed into one minute epochs and scored with the Cole-Kripke
+#   (1992) formula, a weighted sum over the four epochs before and the two after:
+#   a score of 1 or more is wake.  Sleep epochs are split into light and deep by
+#   heartrate: deep sleep is very still with the heartrate at or below its recent
+#   average.
+#
+#   Sleep_Stager does this live, one epoch at a time, with a fixed amount of work
+#   per epoch; stages come out cole_kripke_lag epochs late since the formula looks
+#   ahead.  score_night does the same for a whole recorded night at once and gives
+#   identical results.
+
+epoch_seconds = 60
+
+# Weights for epochs t-4 .. t+2
+cole_kripke_weights = np.array([404, 598, 326, 441, 1408, 508, 350], dtype='float64')
+cole_kripke_scale = 0.00001
+cole_kripke_lag = 2
+
+# Converts summed gyro movement (see sleepdata.Average_Gyro_Data) to the activity
+#   counts the Cole-Kripke weights were fitted on.  Tune with recorded nights.
+movement_count_scale = 0.0002
+
+# Scores below this (and a heartrate at or below its baseline) are deep sleep
+deep_sleep_score = 0.25
+deep_sleep_heartrate_ratio = 1.0
+# The heartrate baseline is the average over this many epochs with heartrate data
+heartrate_baseline_epochs = 30
+
+
+class Sleep_Stager():
+
+    def __init__(self, callback=None):
+        # callback(epoch_time, score, stage) is called once per scored epoch.
+        self.callback = callback
+        self.epoch = None
+        self.epoch_movement = 0
+        self.epoch_heartrate_sum = 0
+        self.epoch_heartrate_count = 0
+        window_length = len(cole_kripke_weights)
+        # Epochs t-4 .. t+2 as (epoch, count, heartrate, heartrate baseline)
+        self.window = deque([(None, 0, float('nan'), float('nan'))] * window_length, maxlen=window_length)
+        self.baseline_heartrates = deque()
+        self.baseline_sum = 0
+        self.stage = None
+
+
+    def _advance(self, sample_time):
+        epoch = int(sample_time // epoch_seconds)
+        if self.epoch is None:
+            self.epoch = epoch
+        while self.epoch < epoch:
+            self._close_epoch()
+
+
+    def add_movement(self, sample_time, movement):
+        self._advance(sample_time)
+        self.epoch_movement += movement
+
+
+    def add_heartrate(self, sample_time, heartrate):
+        self._advance(sample_time)
+        if heartrate > 0:
+            self.epoch_heartrate_sum += heartrate
+            self.epoch_heartrate_count += 1
+
+
+    def update(self, tick_time):
+        # Closes the epochs that ended before tick_time, even without new samples.
+        self._advance(tick_time)
+
+
+    def _close_epoch(self):
+        heartrate = float('nan')
+        baseline = float('nan')
+        if self.epoch_heartrate_count:
+            heartrate = self.epoch_heartrate_sum / self.epoch_heartrate_count
+            self.baseline_heartrates.append(heartrate)
+            self.baseline_sum += heartrate
+            if len(self.baseline_heartrates) > heartrate_baseline_epochs:
+                self.baseline_sum -= self.baseline_heartrates.popleft()
+            baseline = self.baseline_sum / len(self.baseline_heartrates)
+        self.window.append((self.epoch, self.epoch_movement * movement_count_scale, heartrate, baseline))
+        self.epoch += 1
+        self.epoch_movement = 0
+        self.epoch_heartrate_sum = 0
+        self.epoch_heartrate_count = 0
+        self._score()
+
+
+    def _score(self):
+        epoch, _, heartrate, baseline = self.window[-1 - cole_kripke_lag]
+        if epoch is None:
+            return
+        score = cole_kripke_scale * sum(weight * window_epoch[1]
+                                        for weight, window_epoch in zip(cole_kripke_weights.tolist(), self.window))
+        self.stage = sleep_stage(score, heartrate, baseline)
+        if self.callback:
+            self.callback(epoch * epoch_seconds, score, self.stage)
+
+
+def sleep_stage(score, heartrate, baseline):
+    if score >= 1:
+        return SLEEP_STAGES.WAKE
+    if score < deep_sleep_score and heartrate <= baseline * deep_sleep_heartrate_ratio:
+        return SLEEP_STAGES.DEEP
+    return SLEEP_STAGES.LIGHT
+
+
+def epoch_sums(times, values, first_epoch, epoch_count):
+    epochs = (np.asarray(times) // epoch_seconds).astype('int64') - first_epoch
+    return (np.bincount(epochs, weights=values, minlength=epoch_count),
+            np.bincount(epochs, minlength=epoch_count))
+
+
+def score_epochs(counts, heartrates):
+    # Vectorized Sleep_Stager: activity counts and mean heartrates (NaN without data)
+    #   of consecutive epochs.  Returns the scores and stages of every epoch.
+    padded_counts = np.concatenate((np.zeros(len(cole_kripke_weights) - 1 - cole_kripke_lag),
+                                    counts, np.zeros(cole_kripke_lag)))
+    scores = cole_kripke_scale * np.correlate(padded_counts, cole_kripke_weights, 'valid')
+
+    has_heartrate = ~np.isnan(heartrates)
+    heartrate_cumsum = np.concatenate(([0], np.cumsum(heartrates[has_heartrate])))
+    heartrate_index = np.arange(1, len(heartrate_cumsum))
+    baseline_start = np.maximum(heartrate_index - heartrate_baseline_epochs, 0)
+    baselines = np.full(len(heartrates), np.nan)
+    baselines[has_heartrate] = (heartrate_cumsum[heartrate_index] - heartrate_cumsum[baseline_start]) \
+                               / (heartrate_index - baseline_start)
+
+    stages = np.full(len(counts), SLEEP_STAGES.LIGHT, dtype='u1')
+    with np.errstate(invalid='ignore'):
+        stages[(scores < deep_sleep_score) & (heartrates <= baselines * deep_sleep_heartrate_ratio)] = SLEEP_STAGES.DEEP
+    stages[scores >= 1] = SLEEP_STAGES.WAKE
+    return scores, stages
+
+
+def score_night(movement_times, movements, heartrate_times, heartrates):
+    # Stages a recorded night in one pass; returns 'sleep_stage' records.  Like
+    #   Sleep_Stager, every epoch from the first sample on is scored (epochs without
+    #   samples count as still), up to the last one the live stager would have
+    #   scored when the last sample arrived.
+    sample_times = np.concatenate((movement_times, heartrate_times))
+    if not len(sample_times):
+        return sessionfile.make_records('sleep_stage', [], [[], []])
+    first_epoch = int(sample_times.min() // epoch_seconds)
+    # Epochs are closed by a later sample, the last sample's epoch is still open.
+    epoch_count = int(sample_times.max() // epoch_seconds) - first_epoch
+    movement_sums, _ = epoch_sums(movement_times, np.asarray(movements, dtype='float64'), first_epoch, epoch_count + 1)
+    heartrates = np.asarray(heartrates, dtype='float64')
+    has_heartrate = heartrates > 0
+    heartrate_sums, heartrate_counts = epoch_sums(heartrate_times[has_heartrate], heartrates[has_heartrate],
+                                                  first_epoch, epoch_count + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        epoch_heartrates = heartrate_sums[:epoch_count] / heartrate_counts[:epoch_count]
+
+    scores, stages = score_epochs(movement_sums[:epoch_count] * movement_count_scale, epoch_heartrates)
+    scored = max(epoch_count - cole_kripke_lag, 0)
+    times = (first_epoch + np.arange(scored)) * epoch_seconds
+    return sessionfile.make_records('sleep_stage', times, [scores[:scored], stages[:scored]])
+
+
+def score_session(session):
+    movement = session['raw_movement'] if 'raw_movement' in session else sessionfile.make_records('raw_movement', [], [[]])
+    heartrate = session['raw_bpm'] if 'raw_bpm' in session else sessionfile.make_records('raw_bpm', [], [[]])
+    return score_night(movement['time'], movement['movement'], heartrate['time'], heartrate['bpm'])
+
+
+def session_datestamps(session_dir='.'):
+    pattern = os.path.join(session_dir, sessionfile.session_filename_format.format('*', 'raw_movement'))
+    return sorted(os.path.basename(filename)[:-len(sessionfile.session_filename_format.format('', 'raw_movement'))]
+                  for filename in glob.glob(pattern))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sleep/wake staging of recorded binary sessions')
+    parser.add_argument('sessions', nargs='*', help='session datestamps, e.g. 2020_01_01 (default: all)')
+    parser.add_argument('--session-dir', default='.')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    epoch_total = 0
+    for datestamp in args.sessions or session_datestamps(args.session_dir):
+        stage_records = score_session(sessionfile.Session_Reader(datestamp, args.session_dir))
+        epoch_total += len(stage_records)
+        stage_minutes = np.bincount(stage_records['stage'], minlength=len(SLEEP_STAGES.NAMES)) * epoch_seconds / 60
+        print("{}: {}".format(datestamp, ', '.join("{} {:.0f} min".format(name, minutes)
+                                                   for name, minutes in zip(SLEEP_STAGES.NAMES, stage_minutes))))
+    print("Scored {} epochs in {:.2f} seconds".format(epoch_total, time.time() - start_time))
@@ -0,0 +1,166 @@
+import asyncio, functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import clock
+import latency
+from constants import QUEUE_TYPES
+
+# asyncio core for talking to a band.
+#   A transport owns the band object and is the only thing that calls into it.
+#   Band_Transport runs every call on one worker thread, since bluepy blocks and is
+#   not thread safe.  Simulated_Transport drives a Simulated_Band from inside the
+#   event loop without any thread, which makes the whole core runnable locally.
+#   Async_Band sits on top of either and provides the notification stream, the
+#   heart/gyro keepalive and vibration programs as coroutines, so one event
+#   loop can run every timer and consumer that used to need its own thread.
+
+# How long one wait for notifications may hold the band; queued writes go out in between.
+notification_wait_seconds = 0.1
+
+keepalive_seconds = 12
+
+
+class Band_Transport():
+
+    def __init__(self, band):
+        self.band = band
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='band')
+
+
+    async def call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+
+    async def wait_for_notifications(self, timeout):
+        return await self.call(self.band.wait_for_notifications_with_queued_writes, timeout)
+
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class Simulated_Transport(Band_Transport):
+
+    def __init__(self, band):
+        self.band = band
+
+
+    async def call(self, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+
+    async def wait_for_notifications(self, timeout):
+        # Sleeps in the loop until the simulated band's next packet is due, then lets
+        #   it emit without blocking.
+        band = self.band
+        band.process_write_queue()
+        deadline = clock.time() + timeout
+        next_pulse_time = band._play_vibration()
+        if next_pulse_time is not None:
+            deadline = min(deadline, next_pulse_time)
+        if not band.pending_notifications:
+            next_stream, next_time = band.next_notification()
+            if next_stream is None or next_time > deadline:
+                await asyncio.sleep(max(deadline - clock.time(), 0))
+                return False
+            await asyncio.sleep(max(next_time - clock.time(), 0))
+        band.wait_for_notifications_with_queued_writes(0)
+        return True
+
+
+    def close(self):
+        pass
+
+
+class Async_Band():
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.band = transport.band
+
+
+    async def notifications(self, queue_types):
+        # Parsed data of the given QUEUE_TYPES values, in arrival order per type.
+        #   Queues are drained by miband._parse_queue, as on the threaded path; its
+        #   callbacks only collect the items (with their latency traces) for yielding.
+        band = self.band
+        parsed_items = deque()
+        def collect(parsed_data):
+            parsed_items.append((parsed_data, latency.current_trace()))
+        for _type in queue_types:
+            band.register_callback(_type, collect)
+        try:
+            while True:
+                await self.transport.wait_for_notifications(notification_wait_seconds)
+                band._parse_queue()
+                while parsed_items:
+                    parsed_data, trace = parsed_items.popleft()
+                    latency.set_trace(trace)
+                    yield parsed_data
+                    # Hands the loop to other bands after every item, so a burst from
+                    #   one band cannot hold up another band's samples or alarm.
+                    await asyncio.sleep(0)
+        finally:
+            for _type in queue_types:
+                band.register_callback(_type, None)
+
+
+    async def start_heart_and_gyro(self, sensitivity):
+        await self.transport.call(self.band.send_gyro_start, sensitivity)
+        await self.transport.call(self.band.send_heart_measure_start)
+
+
+    async def keepalive(self, sensitivity):
+        while True:
+            await asyncio.sleep(keepalive_seconds)
+            await self.transport.call(self.band.send_heart_measure_keepalive)
+            await self.transport.call(self.band.send_gyro_start, sensitivity)
+
+
+    async def vibration_program(self, program, trace=None):
+        # The band's I/O loop sends the pulses at their planned times (see
+        #   miband.play_vibration_program); this only waits for the program to end.
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def set_finished(playback):
+            if not finished.done():
+                finished.set_result(playback)
+
+        playback = self.band.play_vibration_program(program, trace)
+        playback.add_done_callback(lambda playback: loop.call_soon_threadsafe(set_finished, playback))
+        return await finished
+
+
+async def play_alarm(band, vibration, vibration_settings, trace):
+    program = vibration.vibration_program(vibration_settings['type'], vibration_settings['duration_seconds'])
+    playback = await band.vibration_program(program, trace)
+    vibration.log_playback(playback)
+
+
+async def run_monitor(transport, callback, vibration, vibration_settings, sensitivity=1):
+    # Streams heart and gyro data to callback and buzzes the band when the heartrate
+    #   alarm fires.  The alarm is checked right after each sample is handled, so no
+    #   separate alarm task has to be woken.  The caller configures vibration once
+    #   (Vibrate.configure_heartrate_alarm), so a reconnect does not restart the
+    #   buzz interval.
+    band = Async_Band(transport)
+    await band.start_heart_and_gyro(sensitivity)
+
+    keepalive_task = asyncio.create_task(band.keepalive(sensitivity))
+    vibration_task = None
+    try:
+        async for data in band.notifications([QUEUE_TYPES.HEART, QUEUE_TYPES.RAW_GYRO]):
+            callback(data)
+            if vibration_task and not vibration_task.done():
+                continue
+            if vibration.check_heartrate_alarm():
+                latency.mark('alarm_decision')
+                vibration_task = asyncio.create_task(play_alarm(band, vibration, vibration_settings,
+                                                                latency.current_trace()))
+    finally:
+        keepalive_task.cancel()
+        if vibration_task:
+            vibration_task.cancel()
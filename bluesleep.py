@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
-import time, re, threading
+import argparse, asyncio, os, time, re, threading, signal
 from bluepy.btle import BTLEDisconnectError
 from miband import miband
+from simband import Simulated_Band
 import sleepdata
+import bandio
+import clock
+import latency
+import metrics
+import lstmdetector
+import detectors
 from vibrate import Vibrate
+from notificationlog import Notification_Recorder
 
 
 
@@ -14,13 +22,45 @@ mac_filename = 'mac.txt'
 
 maximize_graph = False
 
+# Run as a daemon without the live graph; matplotlib is never imported
+headless = False
+
+# Use a software band (see simband.py) instead of connecting over Bluetooth
+simulate_band = False
+
+# Run band I/O, keepalives and alarms as coroutines on one event loop (see bandio.py)
+use_asyncio = False
+
+# Download the minutes stored on the band since the last run before streaming starts
+fetch_activity_on_connect = True
+
+# Record notification-to-vibration latency; send SIGUSR1 to print the histograms
+measure_latency = False
+
+# Set to a filename to log every raw notification for later use with replay.py
+notification_log_filename = None
+notification_recorder = None
+
+# Serve pipeline counters and queue depths in the Prometheus text format (see metrics.py)
+#   on this localhost port and/or Unix socket path
+metrics_port = None
+metrics_socket = None
+
 vibration_settings = {
     'interval_minutes': 20,
     'duration_seconds': 10,
     'type': 'random',
-    'heartrate_alarm_pct': 17
+    'heartrate_alarm_pct': 17,
+    # Any of detectors.detector_names; the band vibrates when one reaches its threshold
+    'detectors': ['heartrate'],
+    'baseline_alarm_pct': 25,
+    'zscore_alarm': 4,
+    'lstm_alarm_pct': 80
     }
 
+# Trained with: python3 lstmdetector.py train
+lstm_model_filename = 'lstm_model.npz'
+
 band = None
 
 #-------------------------------------------------------------------------#
@@ -61,35 +101,64 @@ def get_auth_key(filename):
     return AUTH_KEY
 
 
-def average_data(tick_time):
-    if (tick_time - sleepdata.last_tick_time) >= sleepdata.tick_seconds:
-        sleepdata.average_raw_data(tick_time)
-        sleepdata.last_tick_time = time.time()
-
-   
-def sleep_monitor_callback(data):
-    tick_time = time.time()
-
-    if not sleepdata.last_tick_time:
-        sleepdata.last_tick_time = time.time()
+def handle_sample(session, vibration, data):
+    # Everything done with one parsed notification of one band.
+    latency.mark('callback')
+    tick_time = clock.time()
 
     if data[0] == "GYRO_RAW":
-        sleepdata.process_gyro_data(data[1], tick_time)
+        session.process_gyro_data(data[1], tick_time)
+    elif data[0] == "GYRO_RAW_BATCH":
+        session.process_gyro_batch(data[1], tick_time)
     elif data[0] == "HR":
-        sleepdata.process_heartrate_data(data[1], tick_time)
+        session.process_heartrate_data(data[1], tick_time)
+
+    session.average_data(tick_time)
+
+    # The detectors were updated as their samples came in; this only reads the decision.
+    detector_bank = session.detector_bank
+    vibration.heartrate_increase_pct = detector_bank.alarm_level
+    if session.name is None:
+        print("Alarm level: {} ({})".format(detector_bank.alarm_level, detector_bank.report()))
+    else:
+        print("{} alarm level: {} ({})".format(session.name, detector_bank.alarm_level, detector_bank.report()))
+
+
+def configure_detectors(session, settings, model_filename=lstm_model_filename):
+    lstm_detector = None
+    if 'lstm' in settings['detectors']:
+        if not os.path.exists(model_filename):
+            print("LSTM model not found: {}".format(model_filename))
+            exit(1)
+        lstm_detector = lstmdetector.LSTM_Detector(lstmdetector.load_model(model_filename))
+    session.detector_bank = detectors.build_detector_bank(settings, lstm_detector)
 
-    average_data(tick_time)
 
-    vibration.heartrate_increase_pct = sleepdata.analyze_heartrate(10)
-    print("HR increase percent: {}".format(vibration.heartrate_increase_pct))
+def parse_detectors(detector_list):
+    detector_names = detector_list.split(',')
+    for name in detector_names:
+        if name not in detectors.detector_names:
+            raise argparse.ArgumentTypeError("unknown detector {}, choose from {}".format(
+                name, ', '.join(detectors.detector_names)))
+    return detector_names
+
+
+def sleep_monitor_callback(data):
+    handle_sample(sleepdata.default_session, vibration, data)
 
 
 def connect():
-    global band
+    global band, notification_recorder
     success = False
     timeout = 3
     msg = 'Connection to the band failed. Trying again in {} seconds'
 
+    if simulate_band:
+        band = Simulated_Band(debug=True)
+        band.initialize()
+        band.metric_counts['connects_total'] += 1
+        return
+
     MAC_ADDR = get_mac_address(mac_filename)
     AUTH_KEY = get_auth_key(auth_key_filename)
 
@@ -97,7 +166,18 @@ def connect():
         try:
             band = miband(MAC_ADDR, AUTH_KEY, debug=True)
             success = band.initialize()
+            if success:
+                band.metric_counts['connects_total'] += 1
+            else:
+                band.metric_counts['connect_failures_total'] += 1
+            if success and fetch_activity_on_connect:
+                band.fetch_activity_history(sleepdata.default_session.write_activity)
+            if notification_log_filename:
+                if not notification_recorder:
+                    notification_recorder = Notification_Recorder(notification_log_filename)
+                band.notification_recorder = notification_recorder
         except BTLEDisconnectError:
+            metrics.counts(band=MAC_ADDR)['connect_failures_total'] += 1
             print(msg.format(timeout))
             time.sleep(timeout)
         except KeyboardInterrupt:
@@ -110,8 +190,10 @@ def start_data_pull():
         try:
             band.start_heart_and_gyro(sensitivity=1, callback=sleep_monitor_callback)
         except BTLEDisconnectError:
+            band.metric_counts['disconnects_total'] += 1
             band.gyro_started_flag = False
             connect()
+            vibration.vibrate_band = band
 
 
 def start_vibration():
@@ -125,12 +207,78 @@ def start_vibration():
             time.sleep(1)
 
 
+def start_async_monitor():
+    vibration.configure_heartrate_alarm(vibration_settings)
+    while True:
+        if simulate_band:
+            transport = bandio.Simulated_Transport(band)
+        else:
+            transport = bandio.Band_Transport(band)
+        try:
+            asyncio.run(bandio.run_monitor(transport, sleep_monitor_callback, vibration, vibration_settings))
+        except BTLEDisconnectError:
+            band.metric_counts['disconnects_total'] += 1
+            band.gyro_started_flag = False
+            connect()
+            vibration.vibrate_band = band
+        finally:
+            transport.close()
+
+
+def start_metrics(port, socket_path):
+    if port:
+        metrics.start_server(port)
+        print("Serving metrics on http://{}:{}/metrics".format(metrics.metrics_host, port))
+    if socket_path:
+        metrics.start_unix_server(socket_path)
+        print("Serving metrics on {}".format(socket_path))
+
+
+def print_latency(signal_number, frame):
+    print(latency.dump())
+    for timing_report in sleepdata.default_session.detector_bank.timing_reports():
+        print(timing_report)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monitor sleep with a Mi Band 4')
+    parser.add_argument('--headless', action='store_true', default=headless,
+                        help='record data and run alarms without showing the graph')
+    parser.add_argument('--simulate', action='store_true', default=simulate_band,
+                        help='use a simulated band instead of connecting over Bluetooth')
+    parser.add_argument('--asyncio', action='store_true', default=use_asyncio,
+                        help='run band I/O and alarms on one asyncio event loop')
+    parser.add_argument('--detectors', type=parse_detectors, default=vibration_settings['detectors'],
+                        help='comma separated alarm detectors: ' + ', '.join(detectors.detector_names))
+    parser.add_argument('--metrics-port', type=int, default=metrics_port,
+                        help='serve Prometheus metrics on this localhost port')
+    parser.add_argument('--metrics-socket', default=metrics_socket,
+                        help='serve Prometheus metrics on this Unix socket')
+    args = parser.parse_args()
+    headless = args.headless
+    simulate_band = args.simulate
+    use_asyncio = args.asyncio
+    vibration_settings['detectors'] = args.detectors
+    configure_detectors(sleepdata.default_session, vibration_settings)
+
+    if measure_latency:
+        latency.enabled = True
+        signal.signal(signal.SIGUSR1, print_latency)
+    start_metrics(args.metrics_port, args.metrics_socket)
     connect()
     vibration = Vibrate(band)
-    threading.Thread(target=start_data_pull).start()
-    threading.Thread(target=start_vibration).start()
-    sleepdata.init_graph(maximize=maximize_graph, graph_displaytime_mins=5)
+    vibration.on_alarm = sleepdata.default_session.write_alarm
+    if use_asyncio:
+        data_thread = threading.Thread(target=start_async_monitor)
+        data_thread.start()
+    else:
+        data_thread = threading.Thread(target=start_data_pull)
+        data_thread.start()
+        threading.Thread(target=start_vibration).start()
+    if headless:
+        data_thread.join()
+    else:
+        sleepdata.init_graph(maximize=maximize_graph, graph_displaytime_mins=5)
 
 
 
@@ -0,0 +1,50 @@
+import time as system_time
+
+# Time source shared by bluesleep, sleepdata and Vibrate.
+#   Live runs use the system clock.  Replay swaps in a Virtual_Clock, which only
+#   moves when it is told to, so recorded data can be pushed through the pipeline
+#   as fast as the CPU allows while every stage still sees the recorded times.
+
+class Clock():
+
+    def time(self):
+        return system_time.time()
+
+
+    def sleep(self, seconds):
+        system_time.sleep(seconds)
+
+
+class Virtual_Clock():
+
+    def __init__(self, start_time=0):
+        self.current_time = start_time
+
+
+    def time(self):
+        return self.current_time
+
+
+    def sleep(self, seconds):
+        self.current_time += seconds
+
+
+    def set_time(self, new_time):
+        # Never runs backwards, even if a sleep() already moved past new_time.
+        self.current_time = max(self.current_time, new_time)
+
+
+current_clock = Clock()
+
+
+def set_clock(new_clock):
+    global current_clock
+    current_clock = new_clock
+
+
+def time():
+    return current_clock.time()
+
+
+def sleep(seconds):
+    current_clock.sleep(seconds)
@@ -91,6 +91,19 @@ class QUEUE_TYPES(object):
     RAW_GYRO = 'raw_gyro'
     AVG_GYRO = 'avg_gyro'
 
+    ALL = (HEART, RAW_ACCEL, RAW_HEART, RAW_GYRO, AVG_GYRO)
+
+
+class SLEEP_STAGES(object):
+
+    __metaclass__ = Immutable
+
+    WAKE = 0
+    LIGHT = 1
+    DEEP = 2
+
+    NAMES = ('wake', 'light', 'deep')
+
 
 class BYTEPATTERNS():
 
@@ -112,6 +125,8 @@ class BYTEPATTERNS():
     fetch_error_hex = '100104'
     fetch_continue_hex = '100201'
     fetch_complete_hex = '100204'
+    fetch_trigger_hex = '0101'
+    fetch_data_hex = '02'
 
     auth_ok_hex = '100301'
     request_random_number_hex = '0200'
@@ -141,6 +156,8 @@ class BYTEPATTERNS():
     fetch_error = bytes.fromhex(fetch_error_hex)
     fetch_continue = bytes.fromhex(fetch_continue_hex)
     fetch_complete = bytes.fromhex(fetch_complete_hex)
+    fetch_trigger = bytes.fromhex(fetch_trigger_hex)
+    fetch_data = bytes.fromhex(fetch_data_hex)
 
     auth_ok = bytes.fromhex(auth_ok_hex)
     request_random_number = bytes.fromhex(request_random_number_hex)
@@ -0,0 +1,149 @@
+import csv, os, threading, time
+from datetime import datetime
+from queue import Queue, Empty
+
+from sessionfile import Session_Writer
+import timeindex
+
+# Writer stage for the CSV and binary session output of sleepdata.
+#   Callers only put rows on a queue; a dedicated thread keeps the files open,
+#   batches the rows and flushes them once 'batch_rows' rows are pending or
+#   'flush_seconds' have passed.  Flushed data is fsync'd every 'fsync_seconds'
+#   (0 fsyncs on every flush, None leaves it to the OS).
+#   Files are named after the date of the rows they hold, so output rotates to a
+#   new set of files at midnight.  Each output rotates on its own: raw rows only
+#   arrive once they leave the averaging window, so for a while after midnight they
+#   still belong to yesterday's files while 'avg' rows already go to today's.  A
+#   day's file is closed once its own output has moved on to the next day.  Binary
+#   records are handed to a Session_Writer (see sessionfile.py) which is opened on
+#   first use.
+#   Every CSV file gets a sparse time index as it is written (see timeindex.py).
+
+class Data_Writer(threading.Thread):
+
+    def __init__(self, filename_format='{}_{}.csv', output_dir='.',
+                 batch_rows=200, flush_seconds=5, fsync_seconds=60):
+        threading.Thread.__init__(self, name='data_writer', daemon=True)
+        self.filename_format = filename_format
+        self.output_dir = output_dir
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_seconds = fsync_seconds
+
+        self.queue = Queue()
+        self.open_files = {}
+        self.open_indexes = {}
+        self.session_writer = None
+        self.pending_rows = 0
+        self.last_flush_time = time.time()
+        self.last_fsync_time = time.time()
+
+
+    def write(self, name, rows, fieldnames):
+        self.queue.put((self.write_rows, (name, rows, fieldnames)))
+
+
+    def write_records(self, channel, records):
+        self.queue.put((self.append_records, (channel, records)))
+
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+
+    def run(self):
+        while True:
+            flush_wait = max(self.last_flush_time + self.flush_seconds - time.time(), 0)
+            try:
+                item = self.queue.get(timeout=flush_wait)
+            except Empty:
+                item = False
+
+            if item is None:
+                self.flush(fsync=self.fsync_seconds is not None)
+                self.close_files()
+                if self.session_writer:
+                    self.session_writer.close()
+                break
+            elif item:
+                write_function, write_args = item
+                write_function(*write_args)
+
+            if (self.pending_rows >= self.batch_rows or
+                    time.time() - self.last_flush_time >= self.flush_seconds):
+                self.flush()
+
+
+    def write_rows(self, name, rows, fieldnames):
+        for row in rows:
+            datestamp = row_datestamp(row['time'])
+            csv_writer, block_indexer = self.get_writer(datestamp, name, fieldnames)
+            block_indexer.add_row(timeindex.row_timestamp(row['time']))
+            csv_writer.writerow(row)
+            self.pending_rows += 1
+
+
+    def append_records(self, channel, records):
+        if self.session_writer is None:
+            self.session_writer = Session_Writer(self.output_dir)
+        self.session_writer.append(channel, records)
+        self.pending_rows += len(records)
+
+
+    def get_writer(self, datestamp, name, fieldnames):
+        file_key = (datestamp, name)
+        if file_key not in self.open_files:
+            # Rows of one output come in time order, so its files of earlier days are done.
+            self.close_files([open_key for open_key in self.open_files
+                              if open_key[1] == name and open_key[0] < datestamp],
+                             fsync=self.fsync_seconds is not None)
+            csv_filename = os.path.join(self.output_dir, self.filename_format.format(datestamp, name))
+            write_header = not os.path.exists(csv_filename) or os.path.getsize(csv_filename) == 0
+            csvfile = open(csv_filename, 'a', newline='')
+            csv_writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            if write_header:
+                csv_writer.writeheader()
+            else:
+                # Rows written before an unclean exit may not be indexed yet.
+                timeindex.index_csv(csv_filename)
+            self.open_files[file_key] = (csvfile, csv_writer)
+            self.open_indexes[file_key] = timeindex.Block_Indexer(csv_filename, csvfile)
+        return self.open_files[file_key][1], self.open_indexes[file_key]
+
+
+    def flush(self, fsync=False):
+        now = time.time()
+        if self.fsync_seconds is not None and now - self.last_fsync_time >= self.fsync_seconds:
+            fsync = True
+        for csvfile, _ in self.open_files.values():
+            csvfile.flush()
+            if fsync:
+                os.fsync(csvfile.fileno())
+        for block_indexer in self.open_indexes.values():
+            block_indexer.flush(fsync)
+        if self.session_writer:
+            self.session_writer.flush(fsync)
+        if fsync:
+            self.last_fsync_time = now
+        self.pending_rows = 0
+        self.last_flush_time = now
+
+
+    def close_files(self, file_keys=None, fsync=False):
+        # Closes the given (datestamp, name) files, or all of them.
+        if file_keys is None:
+            file_keys = list(self.open_files)
+        for file_key in file_keys:
+            csvfile, _ = self.open_files.pop(file_key)
+            csvfile.flush()
+            if fsync:
+                os.fsync(csvfile.fileno())
+            self.open_indexes.pop(file_key).close()
+            csvfile.close()
+
+
+def row_datestamp(row_time):
+    if not isinstance(row_time, datetime):
+        row_time = datetime.fromtimestamp(row_time)
+    return row_time.strftime("%Y_%m_%d")
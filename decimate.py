@@ -0,0 +1,70 @@
+import math
+from collections import deque
+
+import numpy as np
+
+# Min/max decimation for plotting long series at screen resolution.
+#   The time axis is cut into fixed buckets of 'bucket_width' (about one pixel wide);
+#   each bucket keeps only its lowest and highest point, in the order they occurred.
+#   Drawing those two points per bucket gives the same picture as drawing every
+#   point, spikes included, at a cost set by the plot width instead of the amount of
+#   data.  Points are added one at a time and old buckets dropped from the front, so
+#   both stay O(1).
+
+class MinMax_Decimator():
+
+    def __init__(self, bucket_width):
+        self.bucket_width = bucket_width
+        self.bucket_ids = deque()
+        self.min_points = deque()
+        self.max_points = deque()
+
+
+    def __len__(self):
+        return len(self.bucket_ids)
+
+
+    def add(self, x, y):
+        if y != y:
+            return
+        bucket_id = math.floor(x / self.bucket_width)
+        if self.bucket_ids and self.bucket_ids[-1] == bucket_id:
+            if y < self.min_points[-1][1]:
+                self.min_points[-1] = (x, y)
+            if y > self.max_points[-1][1]:
+                self.max_points[-1] = (x, y)
+        else:
+            self.bucket_ids.append(bucket_id)
+            self.min_points.append((x, y))
+            self.max_points.append((x, y))
+
+
+    def evict_before(self, x):
+        cutoff_bucket = math.floor(x / self.bucket_width)
+        while self.bucket_ids and self.bucket_ids[0] < cutoff_bucket:
+            self.bucket_ids.popleft()
+            self.min_points.popleft()
+            self.max_points.popleft()
+
+
+    def points(self):
+        x_values = []
+        y_values = []
+        for min_point, max_point in zip(self.min_points, self.max_points):
+            if min_point == max_point:
+                x_values.append(min_point[0])
+                y_values.append(min_point[1])
+            elif min_point[0] <= max_point[0]:
+                x_values.extend((min_point[0], max_point[0]))
+                y_values.extend((min_point[1], max_point[1]))
+            else:
+                x_values.extend((max_point[0], min_point[0]))
+                y_values.extend((max_point[1], min_point[1]))
+        return np.array(x_values), np.array(y_values)
+
+
+    def value_range(self):
+        if not self.bucket_ids:
+            return None
+        return (min(point[1] for point in self.min_points),
+                max(point[1] for point in self.max_points))
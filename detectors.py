@@ -0,0 +1,225 @@
+import math
+from collections import deque
+
+# Streaming alarm detectors.
+#   A detector reads one input stream: 'heartrate' (each reading), 'movement'
+#   (each gyro packet's movement) or 'tick' (the averages of each averaging tick,
+#   as in the 'avg' output).  update() takes one sample in constant time and sets
+#   value, which alarms once it reaches alarm_threshold.
+#
+#   A Detector_Bank holds the detectors of one session.  Samples are only passed
+#   to the detectors reading that stream, and after each update the bank keeps a
+#   single decision for Vibrate: alarm_level, the highest value of any detector as
+#   a percent of its own threshold.  The band vibrates at 100.
+
+# Defaults for sessions nobody configured, see bluesleep.vibration_settings
+heartrate_alarm_pct = 17
+heartrate_window_readings = 10
+
+# Half-life of the EWMA baselines, in samples
+baseline_half_life = 300
+# Samples before a baseline detector starts reporting
+baseline_warmup = 60
+
+
+class Sliding_Min():
+    # Minimum of the last window values.  The deque holds (sample number, value)
+    #   of the values that can still become the minimum, increasing from the left.
+
+    def __init__(self, window):
+        self.window = window
+        self.candidates = deque()
+        self.count = 0
+
+
+    def dominates(self, new_value, old_value):
+        return new_value <= old_value
+
+
+    def push(self, value):
+        candidates = self.candidates
+        while candidates and self.dominates(value, candidates[-1][1]):
+            candidates.pop()
+        candidates.append((self.count, value))
+        self.count += 1
+        if candidates[0][0] <= self.count - 1 - self.window:
+            candidates.popleft()
+
+
+    def value(self):
+        return self.candidates[0][1]
+
+
+class Sliding_Max(Sliding_Min):
+
+    def dominates(self, new_value, old_value):
+        return new_value >= old_value
+
+
+class EWMA():
+    # Exponentially weighted mean and variance.
+
+    def __init__(self, half_life):
+        self.alpha = 1 - 0.5 ** (1 / half_life)
+        self.mean = None
+        self.variance = 0.0
+        self.count = 0
+
+
+    def push(self, value):
+        self.count += 1
+        if self.mean is None:
+            self.mean = float(value)
+            return
+        difference = value - self.mean
+        increment = self.alpha * difference
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + difference * increment)
+
+
+class Heartrate_Increase_Detector():
+    # The original rule: percent of the current heartrate over the lowest of the
+    #   last window readings.
+    stream = 'heartrate'
+
+    def __init__(self, alarm_pct=heartrate_alarm_pct, window=heartrate_window_readings):
+        self.name = 'heartrate'
+        self.alarm_threshold = alarm_pct
+        self.lowest = Sliding_Min(window)
+        self.value = 0
+
+
+    def update(self, heartrate):
+        if heartrate <= 0:
+            return
+        self.lowest.push(heartrate)
+        if self.lowest.count >= self.lowest.window:
+            lowest_heartrate = self.lowest.value()
+            self.value = int((heartrate - lowest_heartrate) / lowest_heartrate * 100)
+
+
+class Heartrate_Baseline_Detector():
+    # Percent of the current heartrate over its slow moving average.
+    stream = 'heartrate'
+
+    def __init__(self, alarm_pct, half_life=baseline_half_life):
+        self.name = 'heartrate_baseline'
+        self.alarm_threshold = alarm_pct
+        self.baseline = EWMA(half_life)
+        self.value = 0
+
+
+    def update(self, heartrate):
+        if heartrate <= 0:
+            return
+        baseline = self.baseline
+        if baseline.count >= baseline_warmup:
+            self.value = int((heartrate - baseline.mean) / baseline.mean * 100)
+        baseline.push(heartrate)
+
+
+class Z_Score_Detector():
+    # Standard deviations of the current sample above its moving average.
+
+    def __init__(self, stream, alarm_z, half_life=baseline_half_life):
+        self.name = stream + '_zscore'
+        self.stream = stream
+        self.alarm_threshold = alarm_z
+        self.baseline = EWMA(half_life)
+        self.value = 0.0
+
+
+    def update(self, sample):
+        if self.stream == 'heartrate' and sample <= 0:
+            return
+        baseline = self.baseline
+        if baseline.count >= baseline_warmup and baseline.variance > 0:
+            self.value = (sample - baseline.mean) / math.sqrt(baseline.variance)
+        baseline.push(sample)
+
+
+class LSTM_Alarm_Detector():
+    # Nightmare probability in percent from a lstmdetector.LSTM_Detector.
+    stream = 'tick'
+
+    def __init__(self, lstm_detector, alarm_pct):
+        self.name = 'lstm'
+        self.lstm_detector = lstm_detector
+        self.alarm_threshold = alarm_pct
+        self.value = 0
+
+
+    def update(self, averages):
+        self.lstm_detector.step_averages(averages)
+        self.value = self.lstm_detector.alarm_pct()
+
+
+class Detector_Bank():
+
+    def __init__(self, detectors):
+        self.detectors = list(detectors)
+        self.streams = {}
+        for detector in self.detectors:
+            self.streams.setdefault(detector.stream, []).append(detector)
+        self.alarm_level = 0
+        self.alarm_detector = None
+
+
+    def update(self, stream, sample):
+        stream_detectors = self.streams.get(stream)
+        if not stream_detectors:
+            return
+        for detector in stream_detectors:
+            detector.update(sample)
+        self.decide()
+
+
+    def update_many(self, stream, samples):
+        if stream not in self.streams:
+            return
+        for sample in samples:
+            self.update(stream, sample)
+
+
+    def decide(self):
+        alarm_level = 0
+        alarm_detector = None
+        for detector in self.detectors:
+            detector_level = int(detector.value * 100 / detector.alarm_threshold)
+            if alarm_detector is None or detector_level > alarm_level:
+                alarm_level = detector_level
+                alarm_detector = detector
+        self.alarm_level = alarm_level
+        self.alarm_detector = alarm_detector
+
+
+    def report(self):
+        return ', '.join("{} {:.3g}/{:.3g}".format(detector.name, detector.value, detector.alarm_threshold)
+                         for detector in self.detectors)
+
+
+    def timing_reports(self):
+        return [detector.lstm_detector.timing_report() for detector in self.detectors
+                if isinstance(detector, LSTM_Alarm_Detector)]
+
+
+detector_names = ['heartrate', 'heartrate_baseline', 'heartrate_zscore', 'movement_zscore', 'lstm']
+
+
+def build_detector_bank(settings, lstm_detector=None):
+    # Detectors named in settings['detectors'], with their thresholds from settings.
+    detectors = []
+    for name in settings.get('detectors', ['heartrate']):
+        if name == 'heartrate':
+            detectors.append(Heartrate_Increase_Detector(settings['heartrate_alarm_pct']))
+        elif name == 'heartrate_baseline':
+            detectors.append(Heartrate_Baseline_Detector(settings['baseline_alarm_pct']))
+        elif name == 'heartrate_zscore':
+            detectors.append(Z_Score_Detector('heartrate', settings['zscore_alarm']))
+        elif name == 'movement_zscore':
+            detectors.append(Z_Score_Detector('movement', settings['zscore_alarm']))
+        elif name == 'lstm':
+            detectors.append(LSTM_Alarm_Detector(lstm_detector, settings['lstm_alarm_pct']))
+        else:
+            raise ValueError("Unknown detector: {}".format(name))
+    return Detector_Bank(detectors)
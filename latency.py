@@ -0,0 +1,105 @@
+import math, threading, time
+
+# Latency from a BLE notification arriving to each later stage of its handling.
+#   A trace is the perf_counter() time a notification arrived.  It follows the data
+#   through the thread handling it (set_trace/current_trace) and is handed across
+#   threads explicitly (Vibrate keeps the trace that raised the alarm, queued writes
+#   carry theirs).  mark() records the time since the trace started into a per-stage
+#   histogram with quarter-octave buckets, so recording costs a few hundred
+#   nanoseconds and memory stays fixed however long it runs.
+#   'detector' is marked once the sample's own detectors are updated, 'averaging'
+#   only on the samples that end an averaging tick, once its windows and tick
+#   detectors are done (see sleepdata.py).
+
+stages = ['dequeue', 'callback', 'detector', 'averaging', 'alarm_decision', 'write_enqueue', 'write_sent']
+
+enabled = False
+
+bucket_count = 112
+buckets_per_octave = 4
+
+trace_local = threading.local()
+
+
+class Latency_Histogram():
+
+    def __init__(self):
+        self.counts = [0] * bucket_count
+        self.total = 0
+        self.max_seconds = 0
+
+
+    def record(self, seconds):
+        microseconds = seconds * 1e6
+        if microseconds < 1:
+            bucket = 0
+        else:
+            bucket = min(int(math.log2(microseconds) * buckets_per_octave) + 1, bucket_count - 1)
+        self.counts[bucket] += 1
+        self.total += 1
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+
+    def percentile(self, pct):
+        # Upper edge of the bucket holding the given percentile, in seconds.
+        if self.total == 0:
+            return None
+        threshold = self.total * pct / 100
+        running_count = 0
+        for bucket, count in enumerate(self.counts):
+            running_count += count
+            if running_count >= threshold:
+                return min(2 ** (bucket / buckets_per_octave) / 1e6, self.max_seconds)
+        return self.max_seconds
+
+
+histograms = {stage: Latency_Histogram() for stage in stages}
+
+
+def reset():
+    for stage in stages:
+        histograms[stage] = Latency_Histogram()
+
+
+def now():
+    return time.perf_counter()
+
+
+def set_trace(trace):
+    trace_local.trace = trace
+
+
+def current_trace():
+    return getattr(trace_local, 'trace', None)
+
+
+def take_trace():
+    # Returns the current trace and clears it, so only the first use is measured.
+    trace = getattr(trace_local, 'trace', None)
+    trace_local.trace = None
+    return trace
+
+
+def mark(stage, trace=None):
+    if not enabled:
+        return
+    if trace is None:
+        trace = getattr(trace_local, 'trace', None)
+        if trace is None:
+            return
+    histograms[stage].record(time.perf_counter() - trace)
+
+
+def dump():
+    lines = ["{:<16}{:>10}{:>12}{:>12}{:>12}{:>12}".format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+    for stage in stages:
+        histogram = histograms[stage]
+        if histogram.total == 0:
+            lines.append("{:<16}{:>10}".format(stage, 0))
+            continue
+        lines.append("{:<16}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+            stage, histogram.total,
+            histogram.percentile(50) * 1000, histogram.percentile(95) * 1000,
+            histogram.percentile(99) * 1000, histogram.max_seconds * 1000))
+    return '\n'.join(lines)
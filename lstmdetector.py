@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+import argparse, glob, math, os, time
+from datetime import datetime
+
+import numpy as np
+
+import latency
+import sessionfile
+import sleepdata
+
+# Nightmare detector: a small LSTM over the averaged heartrate and movement ticks,
+#   trained per user on recorded binary sessions, as a replacement for the fixed
+#   heartrate percent rule (detectors.Heartrate_Increase_Detector).
+#
+#   LSTM_Detector runs live.  It advances one step per averaging tick with the
+#   hidden state carried from the previous tick, in plain NumPy on preallocated
+#   buffers, and records how long every step takes so it can be checked against
+#   step_budget_ms.  Its output is the probability of a nightmare in percent, which
+#   detectors.LSTM_Alarm_Detector compares with vibration_settings['lstm_alarm_pct'];
+#   Vibrate only sees the Detector_Bank's alarm_level.
+#
+#   train() runs the same cell over many ticks of several streams at once
+#   (truncated backpropagation through time, the state carried between chunks as it
+#   is live) and evaluate() replays sessions through LSTM_Detector itself.
+#
+#   Labels come from a file of nightmare time ranges, one per line:
+#     2020-01-01 03:12:00  2020-01-01 03:15:30
+#   Without one, the fixed heartrate rule is used as the label, which gives a
+#   model to start from until real labels are collected.
+
+hidden_size = 16
+
+# A step taking longer than this is counted as over budget.  A step is a few
+#   dozen microseconds on a desktop and a few hundred on a Raspberry Pi 3.
+step_budget_ms = 2.0
+
+# Training
+sequence_ticks = 240
+stream_count = 16
+learning_rate = 0.01
+training_epochs = 30
+# Ticks of heartrate history for the rule labels, and the percent that is a nightmare
+rule_window_ticks = 20
+rule_alarm_pct = 17
+
+
+class LSTM_Model():
+    # Gates are stacked as input, forget, output (sigmoid) then candidate (tanh).
+
+    def __init__(self, feature_names, hidden_size=hidden_size, seed=0):
+        rng = np.random.default_rng(seed)
+        input_size = len(feature_names)
+        weight_scale = 1 / math.sqrt(input_size + hidden_size)
+        self.feature_names = list(feature_names)
+        self.weights = rng.uniform(-weight_scale, weight_scale, (4 * hidden_size, input_size + hidden_size))
+        self.bias = np.zeros(4 * hidden_size)
+        self.bias[hidden_size:2 * hidden_size] = 1
+        self.output_weights = np.zeros(hidden_size)
+        self.output_bias = np.zeros(1)
+        self.feature_mean = np.zeros(input_size)
+        self.feature_std = np.ones(input_size)
+
+
+    @property
+    def input_size(self):
+        return len(self.feature_names)
+
+
+    @property
+    def hidden_size(self):
+        return len(self.output_weights)
+
+
+    def parameters(self):
+        return [self.weights, self.bias, self.output_weights, self.output_bias]
+
+
+    def normalize(self, features):
+        # NaN (no data yet) becomes the training mean.
+        normalized = (features - self.feature_mean) / self.feature_std
+        return np.nan_to_num(normalized, nan=0.0)
+
+
+    def save(self, filename):
+        np.savez(filename, feature_names=np.array(self.feature_names), weights=self.weights, bias=self.bias,
+                 output_weights=self.output_weights, output_bias=self.output_bias,
+                 feature_mean=self.feature_mean, feature_std=self.feature_std)
+
+
+def load_model(filename):
+    with np.load(filename) as model_file:
+        model = LSTM_Model(model_file['feature_names'].tolist(), len(model_file['output_weights']))
+        for name in ('weights', 'bias', 'output_weights', 'output_bias', 'feature_mean', 'feature_std'):
+            setattr(model, name, model_file[name])
+    return model
+
+
+class LSTM_Detector():
+
+    def __init__(self, model):
+        self.model = model
+        input_size = model.input_size
+        hidden_size = model.hidden_size
+        # inputs holds the features followed by the previous hidden state, so one
+        #   matrix product computes every gate.
+        self.inputs = np.zeros(input_size + hidden_size)
+        self.features = self.inputs[:input_size]
+        self.hidden = self.inputs[input_size:]
+        self.cell = np.zeros(hidden_size)
+        self.gates = np.zeros(4 * hidden_size)
+        self.sigmoid_gates = self.gates[:3 * hidden_size]
+        self.input_gate = self.gates[:hidden_size]
+        self.forget_gate = self.gates[hidden_size:2 * hidden_size]
+        self.output_gate = self.gates[2 * hidden_size:3 * hidden_size]
+        self.candidate = self.gates[3 * hidden_size:]
+        self.scratch = np.zeros(hidden_size)
+        self.feature_scale = 1 / model.feature_std
+        self.feature_offset = -model.feature_mean * self.feature_scale
+        self.probability = 0.0
+        self.step_times = latency.Latency_Histogram()
+        self.over_budget = 0
+
+
+    def reset(self):
+        self.hidden[:] = 0
+        self.cell[:] = 0
+        self.probability = 0.0
+
+
+    def step_averages(self, averages):
+        # averages maps avg column names (as in the CSV/binary 'avg' output) to values.
+        return self.step([averages[name] for name in self.model.feature_names])
+
+
+    def step(self, feature_values):
+        start_time = time.perf_counter()
+        model = self.model
+        features = self.features
+        features[:] = feature_values
+        features *= self.feature_scale
+        features += self.feature_offset
+        np.copyto(features, 0.0, where=features != features)
+
+        np.dot(model.weights, self.inputs, out=self.gates)
+        self.gates += model.bias
+        # sigmoid(x) = (1 + tanh(x / 2)) / 2, without overflow for large inputs
+        self.sigmoid_gates *= 0.5
+        np.tanh(self.sigmoid_gates, out=self.sigmoid_gates)
+        self.sigmoid_gates *= 0.5
+        self.sigmoid_gates += 0.5
+        np.tanh(self.candidate, out=self.candidate)
+
+        self.cell *= self.forget_gate
+        np.multiply(self.input_gate, self.candidate, out=self.scratch)
+        self.cell += self.scratch
+        np.tanh(self.cell, out=self.hidden)
+        self.hidden *= self.output_gate
+
+        logit = float(np.dot(model.output_weights, self.hidden)) + float(model.output_bias[0])
+        self.probability = 0.5 * (1 + math.tanh(0.5 * logit))
+
+        step_seconds = time.perf_counter() - start_time
+        self.step_times.record(step_seconds)
+        if step_seconds * 1000 > step_budget_ms:
+            self.over_budget += 1
+        return self.probability
+
+
+    def alarm_pct(self):
+        return int(self.probability * 100)
+
+
+    def timing_report(self):
+        step_times = self.step_times
+        if step_times.total == 0:
+            return "LSTM steps: none"
+        return "LSTM steps: {}, p50 {:.1f} us, p99 {:.1f} us, max {:.1f} us, {} over the {} ms budget".format(
+            step_times.total, step_times.percentile(50) * 1e6, step_times.percentile(99) * 1e6,
+            step_times.max_seconds * 1e6, self.over_budget, step_budget_ms)
+
+
+def sigmoid(values):
+    return 0.5 * (1 + np.tanh(0.5 * values))
+
+
+def forward(model, inputs, hidden, cell):
+    # Batched forward pass over normalized inputs of shape (ticks, streams, features),
+    #   starting from hidden and cell of shape (streams, hidden size).  Returns the
+    #   probabilities (ticks, streams) and what backward() needs.
+    hidden_size = model.hidden_size
+    tick_count = len(inputs)
+    steps = []
+    probabilities = np.zeros(inputs.shape[:2])
+    for tick in range(tick_count):
+        stacked_inputs = np.concatenate((inputs[tick], hidden), axis=1)
+        gates = stacked_inputs @ model.weights.T + model.bias
+        gates[:, :3 * hidden_size] = sigmoid(gates[:, :3 * hidden_size])
+        gates[:, 3 * hidden_size:] = np.tanh(gates[:, 3 * hidden_size:])
+        input_gate, forget_gate, output_gate, candidate = np.split(gates, 4, axis=1)
+        last_cell = cell
+        cell = forget_gate * last_cell + input_gate * candidate
+        cell_tanh = np.tanh(cell)
+        hidden = output_gate * cell_tanh
+        probabilities[tick] = sigmoid(hidden @ model.output_weights + model.output_bias[0])
+        steps.append((stacked_inputs, gates, last_cell, cell_tanh, hidden))
+    return probabilities, steps, hidden, cell
+
+
+def backward(model, steps, output_gradients):
+    # Gradients of the parameters, given the loss gradients of the output logits.
+    hidden_size = model.hidden_size
+    input_size = model.input_size
+    gradients = [np.zeros_like(parameter) for parameter in model.parameters()]
+    weight_gradient, bias_gradient, output_weight_gradient, output_bias_gradient = gradients
+    stream_count = output_gradients.shape[1]
+    next_hidden_gradient = np.zeros((stream_count, hidden_size))
+    next_cell_gradient = np.zeros((stream_count, hidden_size))
+    for tick in range(len(steps) - 1, -1, -1):
+        stacked_inputs, gates, last_cell, cell_tanh, hidden = steps[tick]
+        input_gate, forget_gate, output_gate, candidate = np.split(gates, 4, axis=1)
+        output_gradient = output_gradients[tick]
+        output_weight_gradient += hidden.T @ output_gradient
+        output_bias_gradient += output_gradient.sum()
+        hidden_gradient = np.outer(output_gradient, model.output_weights) + next_hidden_gradient
+        cell_gradient = hidden_gradient * output_gate * (1 - cell_tanh ** 2) + next_cell_gradient
+        gate_gradients = np.concatenate((
+            cell_gradient * candidate * input_gate * (1 - input_gate),
+            cell_gradient * last_cell * forget_gate * (1 - forget_gate),
+            hidden_gradient * cell_tanh * output_gate * (1 - output_gate),
+            cell_gradient * input_gate * (1 - candidate ** 2)), axis=1)
+        weight_gradient += gate_gradients.T @ stacked_inputs
+        bias_gradient += gate_gradients.sum(axis=0)
+        next_hidden_gradient = (gate_gradients @ model.weights)[:, input_size:]
+        next_cell_gradient = cell_gradient * forget_gate
+    return gradients
+
+
+def session_features(avg_records, feature_names):
+    return np.column_stack([avg_records[name] for name in feature_names]).astype('float64')
+
+
+def read_labels(filename):
+    label_ranges = []
+    with open(filename, 'r') as labels_file:
+        for line in labels_file:
+            line = line.split('#')[0].split()
+            if len(line) != 4:
+                continue
+            start = datetime.strptime(' '.join(line[:2]), '%Y-%m-%d %H:%M:%S').timestamp()
+            end = datetime.strptime(' '.join(line[2:]), '%Y-%m-%d %H:%M:%S').timestamp()
+            label_ranges.append((start, end))
+    return label_ranges
+
+
+def range_labels(times, label_ranges):
+    labels = np.zeros(len(times))
+    for start, end in label_ranges:
+        labels[(times >= start) & (times <= end)] = 1
+    return labels
+
+
+def rule_labels(avg_records):
+    # The fixed rule on the averaged heartrate: percent over the lowest of the
+    #   last rule_window_ticks ticks.
+    heartrate_name = sleepdata.csv_header_name_format.format('heartrate', min(sleepdata.sleep_data['heartrate']['periods']))
+    heartrates = np.nan_to_num(np.asarray(avg_records[heartrate_name], dtype='float64'), nan=0.0)
+    padded = np.concatenate((np.full(rule_window_ticks - 1, np.inf), np.where(heartrates > 0, heartrates, np.inf)))
+    window_min = np.lib.stride_tricks.sliding_window_view(padded, rule_window_ticks).min(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        increase_pct = (heartrates - window_min) / window_min * 100
+    return (np.nan_to_num(increase_pct, nan=0.0, neginf=0.0) >= rule_alarm_pct).astype('float64')
+
+
+def load_sessions(datestamps, session_dir, label_ranges=None):
+    # Returns (times, features, labels) of every session with an 'avg' channel.
+    sessions = []
+    for datestamp in datestamps:
+        session = sessionfile.Session_Reader(datestamp, session_dir)
+        if 'avg' not in session or not len(session['avg']):
+            continue
+        avg_records = session['avg']
+        times = np.asarray(avg_records['time'])
+        labels = range_labels(times, label_ranges) if label_ranges is not None else rule_labels(avg_records)
+        sessions.append((times, avg_records, labels))
+    return sessions
+
+
+def feature_names_of(avg_records):
+    return [name for name in avg_records.dtype.names if name != 'time']
+
+
+def training_streams(model, sessions):
+    # Lays all sessions end to end and cuts them into up to stream_count equal
+    #   streams, shaped (ticks, streams, ...).
+    features = np.concatenate([session_features(avg_records, model.feature_names) for _, avg_records, _ in sessions])
+    labels = np.concatenate([labels for _, _, labels in sessions])
+    streams = min(stream_count, max(len(features) // sequence_ticks, 1))
+    stream_ticks = len(features) // streams
+    used = stream_ticks * streams
+    inputs = model.normalize(features[:used]).reshape(streams, stream_ticks, -1).transpose(1, 0, 2)
+    targets = labels[:used].reshape(streams, stream_ticks).T
+    return inputs, targets
+
+
+def train(model, sessions, epochs=training_epochs, log=print):
+    features = np.concatenate([session_features(avg_records, model.feature_names) for _, avg_records, _ in sessions])
+    model.feature_mean = np.nan_to_num(np.nanmean(features, axis=0), nan=0.0)
+    model.feature_std = np.nan_to_num(np.nanstd(features, axis=0), nan=1.0)
+    model.feature_std[model.feature_std == 0] = 1
+    inputs, targets = training_streams(model, sessions)
+
+    # Nightmares are rare; weight them up to half of the loss.
+    positive_count = targets.sum()
+    positive_weight = (targets.size - positive_count) / positive_count if positive_count else 1
+    tick_weights = np.where(targets > 0, positive_weight, 1.0)
+    tick_weights /= tick_weights.sum()
+
+    # Adam
+    first_moments = [np.zeros_like(parameter) for parameter in model.parameters()]
+    second_moments = [np.zeros_like(parameter) for parameter in model.parameters()]
+    update_count = 0
+    for epoch in range(epochs):
+        hidden = np.zeros((inputs.shape[1], model.hidden_size))
+        cell = np.zeros_like(hidden)
+        epoch_loss = 0
+        for chunk_start in range(0, len(inputs), sequence_ticks):
+            chunk = slice(chunk_start, chunk_start + sequence_ticks)
+            probabilities, steps, hidden, cell = forward(model, inputs[chunk], hidden, cell)
+            chunk_targets = targets[chunk]
+            chunk_weights = tick_weights[chunk]
+            clipped = np.clip(probabilities, 1e-7, 1 - 1e-7)
+            epoch_loss -= (chunk_weights * (chunk_targets * np.log(clipped) + (1 - chunk_targets) * np.log(1 - clipped))).sum()
+            gradients = backward(model, steps, chunk_weights * (probabilities - chunk_targets))
+            update_count += 1
+            for parameter, gradient, first_moment, second_moment in zip(model.parameters(), gradients,
+                                                                        first_moments, second_moments):
+                first_moment *= 0.9
+                first_moment += 0.1 * gradient
+                second_moment *= 0.999
+                second_moment += 0.001 * gradient ** 2
+                parameter -= learning_rate * (first_moment / (1 - 0.9 ** update_count)) \
+                             / (np.sqrt(second_moment / (1 - 0.999 ** update_count)) + 1e-8)
+        log("Epoch {}: loss {:.4f}".format(epoch + 1, epoch_loss))
+    return model
+
+
+def evaluate(model, sessions, alarm_pct):
+    # Replays each session through a live detector, tick by tick.
+    detector = LSTM_Detector(model)
+    true_positives = false_positives = positives = 0
+    for times, avg_records, labels in sessions:
+        detector.reset()
+        features = session_features(avg_records, model.feature_names)
+        alarms = np.array([detector.step(tick_features) * 100 >= alarm_pct for tick_features in features])
+        true_positives += int((alarms & (labels > 0)).sum())
+        false_positives += int((alarms & (labels == 0)).sum())
+        positives += int((labels > 0).sum())
+    return {
+        'precision': true_positives / (true_positives + false_positives) if true_positives + false_positives else None,
+        'recall': true_positives / positives if positives else None,
+        'detector': detector
+        }
+
+
+def session_datestamps(session_dir='.'):
+    suffix = sessionfile.session_filename_format.format('', 'avg')
+    pattern = os.path.join(session_dir, sessionfile.session_filename_format.format('*', 'avg'))
+    return sorted(os.path.basename(filename)[:-len(suffix)] for filename in glob.glob(pattern))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train or evaluate the LSTM nightmare detector on recorded binary sessions')
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('sessions', nargs='*', help='session datestamps, e.g. 2020_01_01 (default: all)')
+    parser.add_argument('--session-dir', default='.')
+    parser.add_argument('--model', default='lstm_model.npz')
+    parser.add_argument('--labels', help='file of nightmare time ranges (default: the heartrate rule)')
+    parser.add_argument('--epochs', type=int, default=training_epochs)
+    parser.add_argument('--alarm-pct', type=int, default=80)
+    args = parser.parse_args()
+
+    label_ranges = read_labels(args.labels) if args.labels else None
+    sessions = load_sessions(args.sessions or session_datestamps(args.session_dir), args.session_dir, label_ranges)
+    if not sessions:
+        print("No sessions with averaged ('avg') binary data found")
+        exit(1)
+
+    if args.command == 'train':
+        model = LSTM_Model(feature_names_of(sessions[0][1]))
+        start_time = time.time()
+        train(model, sessions, args.epochs)
+        model.save(args.model)
+        print("Trained on {} ticks in {:.1f} seconds, saved to {}".format(
+            sum(len(times) for times, _, _ in sessions), time.time() - start_time, args.model))
+    else:
+        model = load_model(args.model)
+
+    results = evaluate(model, sessions, args.alarm_pct)
+    print("Precision: {}, recall: {}".format(results['precision'], results['recall']))
+    print(results['detector'].timing_report())
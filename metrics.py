@@ -0,0 +1,141 @@
+import http.server, os, socketserver, threading
+from collections import defaultdict
+
+# Counters and gauges of the running pipeline, served in the Prometheus text format
+#   on localhost (start_server) or a Unix socket (start_unix_server).
+#   Counting is a single integer increment: every source (a band, a session) gets
+#   its own dict from counts(), keyed by its labels and kept for the life of the
+#   process, so counts carry on across reconnects.  Keys are metric names, or
+#   (metric name, type) for counts split by notification type.  An increment is not
+#   atomic, so each key is only incremented from one thread at a time: sources that
+#   run in different threads get their own labels (a band's Vibrate counts under
+#   source="vibrate"), and counts a source bumps from several threads (a session's
+#   output, also written by the alarm thread) are taken under the source's lock.
+#   Gauges such as queue depths, and counts a source already keeps itself (a ring's
+#   overwritten rows), cost nothing until scraped: a source registers a function and
+#   render() calls it.
+
+metrics_host = '127.0.0.1'
+
+metric_prefix = 'bluesleep_'
+
+metric_help = {
+    'notifications_total': ('counter', 'BLE notifications received, by type'),
+    'dropped_notifications_total': ('counter', 'Notifications dropped from a full queue, by type'),
+    'parsed_items_total': ('counter', 'Parsed items handed to the callbacks, by type'),
+    'parse_batches_total': ('counter', 'Queue drains that found data, by type'),
+    'connects_total': ('counter', 'Successful connections; every one after the first is a reconnect'),
+    'connect_failures_total': ('counter', 'Connection attempts that failed'),
+    'disconnects_total': ('counter', 'Connections lost while streaming'),
+    'ticks_total': ('counter', 'Averaging ticks'),
+    'csv_writes_total': ('counter', 'CSV writes queued'),
+    'csv_rows_total': ('counter', 'CSV rows queued'),
+    'session_records_total': ('counter', 'Binary session records queued'),
+    'alarms_total': ('counter', 'Alarms raised'),
+    'alarms_suppressed_total': ('counter', 'Alarm threshold crossings within the buzz interval'),
+    'vibrations_total': ('counter', 'Vibrations sent'),
+    'notification_queue_depth': ('gauge', 'Notifications waiting to be parsed, by type'),
+    'write_queue_depth': ('gauge', 'Writes waiting to be sent to the band'),
+    'data_writer_queue_depth': ('gauge', 'Writes waiting for the data writer thread'),
+    'ring_overwritten_rows_total': ('counter', 'Rows overwritten in a full ring buffer before they were evicted'),
+    'ring_capacity': ('gauge', 'Rows a ring buffer holds; raw rings grow instead of overwriting'),
+    'alarm_level': ('gauge', 'Alarm level in percent of the threshold of the closest detector')
+    }
+
+counter_sets = {}
+gauges = {}
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def counts(**labels):
+    # The counter dict of the source with these labels.
+    key = label_key(labels)
+    counter_set = counter_sets.get(key)
+    if counter_set is None:
+        counter_set = counter_sets.setdefault(key, defaultdict(int))
+    return counter_set
+
+
+def register_gauge(name, function, **labels):
+    # function() is called on every scrape.  Registering again with the same labels
+    #   replaces the function, e.g. for the new band object after a reconnect.
+    gauges[(name, label_key(labels))] = function
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def collect():
+    # Returns {metric name: [(labels, value), ...]}.
+    samples = defaultdict(list)
+    for labels, counter_set in list(counter_sets.items()):
+        for key, value in list(counter_set.items()):
+            if isinstance(key, tuple):
+                name, _type = key
+                samples[name].append((labels + (('type', _type),), value))
+            else:
+                samples[key].append((labels, value))
+    for (name, labels), function in list(gauges.items()):
+        try:
+            value = function()
+        except Exception:
+            continue
+        if value is not None:
+            samples[name].append((labels, value))
+    return samples
+
+
+def render():
+    lines = []
+    for name, name_samples in sorted(collect().items()):
+        metric_type, help_text = metric_help.get(name, ('untyped', name))
+        lines.append('# HELP {}{} {}'.format(metric_prefix, name, help_text))
+        lines.append('# TYPE {}{} {}'.format(metric_prefix, name, metric_type))
+        for labels, value in sorted(name_samples):
+            lines.append('{}{}{} {}'.format(metric_prefix, name, format_labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics_Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Unix_Metrics_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def start_server(port, host=metrics_host):
+    return serve(http.server.ThreadingHTTPServer((host, port), Metrics_Handler))
+
+
+def start_unix_server(socket_path):
+    # Scrape with: curl --unix-socket <socket_path> http://localhost/metrics
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return serve(Unix_Metrics_Server(socket_path, Metrics_Handler))
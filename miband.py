@@ -1,11 +1,12 @@
-import sys, os, time
+import sys, os, time, threading, json, tempfile
 import logging
 import struct
+import numpy as np
 
 from bluepy.btle import (
-    Peripheral, DefaultDelegate, 
+    Peripheral, DefaultDelegate, Characteristic, Descriptor,
     ADDR_TYPE_RANDOM, ADDR_TYPE_PUBLIC,
-    BTLEException, BTLEDisconnectError
+    BTLEException, BTLEDisconnectError, BTLEGattError
 )
 from datetime import datetime, timedelta
 from Crypto.Cipher import AES
@@ -14,9 +15,127 @@ from datetime import datetime
 from constants import (
     UUIDS, AUTH_STATES, QUEUE_TYPES, BYTEPATTERNS
 )
+import latency
+import clock
+import metrics
 
 from queue import Queue, Empty
-
+from collections import deque
+
+# Raw gyro packet: 2 header bytes followed by three x/y/z int16 samples.
+raw_gyro_packet_dtype = np.dtype([('header', 'u1', (2,)), ('xyz', '<i2', (3, 3))])
+
+# Most notifications collected without waiting before the queue is parsed.
+notification_batch_limit = 64
+
+# Each notification type has its own queue; once full the oldest entries are dropped.
+notification_queue_length = 1024
+
+# Discovered GATT handles per band MAC address, reused on reconnect while the band's
+#   software revision stays the same.  None disables the cache.  Bands connecting
+#   from several threads (see multiband.py) share the file: every read-modify-write
+#   holds gatt_cache_lock.
+gatt_cache_filename = 'gatt_cache.json'
+gatt_cache_lock = threading.Lock()
+gatt_cache_characteristics = ['_char_alert', '_char_auth', '_char_heart_ctrl', '_char_heart_measure',
+                              '_char_fetch', '_char_activity', '_char_hz', '_char_sensor', '_char_steps',
+                              '_char_revision', '_char_current_time']
+gatt_cache_descriptors = ['_desc_auth', '_desc_fetch', '_desc_activity']
+
+# Resume points of the activity history download per band MAC address, and how far
+#   back the first download goes.  Like the GATT cache the file is shared by all
+#   bands, so updates hold activity_fetch_lock.
+activity_fetch_filename = 'activity_fetch.json'
+activity_fetch_lock = threading.Lock()
+activity_history_default_hours = 24
+# Give up on a history download after this many seconds without a notification.
+activity_fetch_timeout = 10
+
+# One minute of stored activity history as sent by the band.
+activity_record_dtype = np.dtype([('category', 'u1'), ('intensity', 'u1'), ('steps', 'u1'), ('heart_rate', 'u1')])
+
+# A vibration value of '150' runs the motor for ~200ms.  This isn't exact, but leaves
+#   a ~5ms gap between pulses; any lower and the pulses blur together for a human.
+vibration_scaler = 0.75
+
+
+class Vibration_Playback():
+    # One compiled vibration program (see vibrate.compile_vibration_program) being
+    #   played by a band.  Offsets count from the first pulse actually sent, and
+    #   'jitter' collects how late each pulse went out against its offset.
+    #   An abandoned playback (see vibrate.Vibrate.vibrate_type) sends no more pulses.
+
+    def __init__(self, program, trace=None):
+        self.program = program
+        self.trace = trace
+        self.start_time = None
+        self.next_pulse = 0
+        self.jitter = []
+        self.finished = threading.Event()
+        self.done_callbacks = []
+        self.lock = threading.Lock()
+        self.abandoned = False
+
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.finished.is_set():
+                self.done_callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def finish(self):
+        with self.lock:
+            self.finished.set()
+            done_callbacks, self.done_callbacks = self.done_callbacks, []
+        for callback in done_callbacks:
+            callback(self)
+
+
+    def jitter_ms(self):
+        # (mean, max) lateness of the pulses in milliseconds.
+        if not self.jitter:
+            return 0, 0
+        return 1000 * sum(self.jitter) / len(self.jitter), 1000 * max(self.jitter)
+
+
+class Activity_Fetch():
+    # Incremental parser for a download of the band's stored history.  The band sends
+    #   it in chunks: a fetch response with the chunk's start minute, then activity
+    #   packets of a counter byte followed by 4-byte per-minute records.  Each packet
+    #   is decoded as it arrives and handed to callback(times, records), so nothing
+    #   has to be held until the end.
+
+    def __init__(self, end_time, callback):
+        self.end_time = end_time
+        self.callback = callback
+        self.chunk_start_time = None
+        self.chunk_records = 0
+        self.last_time = None
+        self.record_count = 0
+        self.finished = False
+
+
+    def start_chunk(self, chunk_start_time):
+        self.chunk_start_time = chunk_start_time
+        self.chunk_records = 0
+
+
+    def feed(self, data):
+        if self.chunk_start_time is None or len(data) % 4 != 1:
+            return
+        records = np.frombuffer(data, dtype=activity_record_dtype, offset=1)
+        times = self.chunk_start_time + 60 * (self.chunk_records + np.arange(len(records)))
+        self.chunk_records += len(records)
+        # The minute in progress is not complete yet; it comes with the next download.
+        complete = times < self.end_time - 60
+        if not complete.any():
+            return
+        times = times[complete]
+        self.last_time = float(times[-1])
+        self.record_count += len(times)
+        self.callback(times, records[complete])
 
 
 class Delegate(DefaultDelegate):
@@ -27,6 +146,7 @@ class Delegate(DefaultDelegate):
 
     def handleNotification(self, hnd, data):
         if hnd == self.device._char_auth.getHandle():
+            self.device.metric_counts['notifications_total', 'auth'] += 1
             if data[:3] == BYTEPATTERNS.fetch_begin:
                 self.device._req_rdn()
             elif data[:3] == BYTEPATTERNS.fetch_error:
@@ -41,17 +161,23 @@ class Delegate(DefaultDelegate):
             else:
                 self.device.state = AUTH_STATES.AUTH_FAILED
         elif hnd == self.device._char_heart_measure.getHandle():
-            self.device.queue.put((QUEUE_TYPES.HEART, data))
+            self.device.enqueue_notification(QUEUE_TYPES.HEART, data)
+        elif self.device.activity_fetch and hnd == self.device._char_fetch.getHandle():
+            self.device.metric_counts['notifications_total', 'fetch'] += 1
+            self.device._handle_fetch_response(data)
+        elif self.device.activity_fetch and hnd == self.device._char_activity.getHandle():
+            self.device.metric_counts['notifications_total', 'activity'] += 1
+            self.device.activity_fetch.feed(data)
         elif hnd == 0x38:
             if len(data) == 20 and struct.unpack('b', data[0:1])[0] == 1:
-                self.device.queue.put((QUEUE_TYPES.RAW_ACCEL, data))
+                self.device.enqueue_notification(QUEUE_TYPES.RAW_ACCEL, data)
             elif len(data) == 16:
-                self.device.queue.put((QUEUE_TYPES.RAW_HEART, data))
+                self.device.enqueue_notification(QUEUE_TYPES.RAW_HEART, data)
             else:
                 print("Unhandled data on handle 0x38: {}".format(data))
         elif hnd == self.device._char_hz.getHandle():
             if len(data) == 20 and struct.unpack('b', data[0:1])[0] == 1:
-                self.device.queue.put((QUEUE_TYPES.RAW_GYRO, data))
+                self.device.enqueue_notification(QUEUE_TYPES.RAW_GYRO, data)
             elif len(data) == 11:
                 #print("Unknown data: {}".format(bytes.hex(data, " ")))
                 #print(struct.unpack('BBBBBBBBBB', data[1:]))
@@ -60,7 +186,7 @@ class Delegate(DefaultDelegate):
                 #print(struct.unpack("<x5H", data))
                 ...
             elif len(data) == 8:
-                self.device.queue.put((QUEUE_TYPES.AVG_GYRO, data))
+                self.device.enqueue_notification(QUEUE_TYPES.AVG_GYRO, data)
             else:
                 #print("Unknown sensor data ({}): {}".format(len(data), bytes.hex(data, " ")))
                 ...
@@ -70,7 +196,7 @@ class Delegate(DefaultDelegate):
 
 
 class miband(Peripheral):
-    def __init__(self, mac_address, key=None, timeout=0.5, debug=False):
+    def __init__(self, mac_address, key=None, timeout=0.5, debug=False, iface=None):
         FORMAT = '%(asctime)-15s %(name)s (%(levelname)s) > %(message)s'
         logging.basicConfig(format=FORMAT)
         log_level = logging.WARNING if not debug else logging.DEBUG
@@ -78,7 +204,8 @@ class miband(Peripheral):
         self._log.setLevel(log_level)
 
         self._log.info('Connecting to ' + mac_address)
-        Peripheral.__init__(self, mac_address, addrType=ADDR_TYPE_PUBLIC)
+        # iface selects the HCI adapter (0 for hci0, ...); None uses the default one.
+        Peripheral.__init__(self, mac_address, addrType=ADDR_TYPE_PUBLIC, iface=iface)
         self._log.info('Connected')
         if not key:
             self.setSecurityLevel(level = "medium")
@@ -86,19 +213,42 @@ class miband(Peripheral):
         self.timeout = timeout
         self.mac_address = mac_address
         self.state = None
-        self.heart_measure_callback = None
-        self.heart_raw_callback = None
-        self.gyro_raw_callback = None
-        self.gyro_avg_callback = None
         self.auth_key = key
-        self.queue = Queue()
+        self._init_queues()
         self.write_queue = Queue()
+        self.vibration_programs = deque()
         self.gyro_started_flag = False
+        self.notification_recorder = None
+        self.activity_fetch = None
+
+        # Handles come from the cache when it matches this band, see _load_cached_handles.
+        self.handles_from_cache = self._load_cached_handles()
+        if not self.handles_from_cache:
+            self._discover_handles()
+        self._set_sensor_handles()
 
+        try:
+            self._auth_notif(True)
+        except BTLEGattError:
+            if not self.handles_from_cache:
+                raise
+            self._log.warning("Cached GATT handles rejected, rediscovering")
+            invalidate_gatt_cache(mac_address)
+            self.handles_from_cache = False
+            self._discover_handles()
+            self._set_sensor_handles()
+            self._auth_notif(True)
+        self.activity_notif_enabled = False
+        self.waitForNotifications(0.1)
+        self.setDelegate( Delegate(self) )
+
+
+    def _discover_handles(self):
         self.svc_1 = self.getServiceByUUID(UUIDS.SERVICE_MIBAND1)
         self.svc_2 = self.getServiceByUUID(UUIDS.SERVICE_MIBAND2)
         self.svc_heart = self.getServiceByUUID(UUIDS.SERVICE_HEART_RATE)
         self.svc_alert = self.getServiceByUUID(UUIDS.SERVICE_ALERT)
+        self.svc_device_info = self.getServiceByUUID(UUIDS.SERVICE_DEVICE_INFO)
 
         self._char_alert = self.svc_alert.getCharacteristics(UUIDS.CHARACTERISTIC_ALERT)[0]
 
@@ -107,7 +257,6 @@ class miband(Peripheral):
 
         self._char_heart_ctrl = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL)[0]
         self._char_heart_measure = self.svc_heart.getCharacteristics(UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE)[0]
-        self._heart_measure_handle = self._char_heart_measure.getHandle() + 1
 
         # Recorded information
         self._char_fetch = self.getCharacteristics(uuid=UUIDS.CHARACTERISTIC_FETCH)[0]
@@ -115,20 +264,75 @@ class miband(Peripheral):
         self._char_activity = self.getCharacteristics(uuid=UUIDS.CHARACTERISTIC_ACTIVITY_DATA)[0]
         self._desc_activity = self._char_activity.getDescriptors(forUUID=UUIDS.NOTIFICATION_DESCRIPTOR)[0]
 
-        # Sensor characteristics and handles/descriptors
+        # Sensor characteristics
         self._char_hz = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_HZ)[0]
-        self._hz_handle = self._char_hz.getHandle() + 1
-
         self._char_sensor = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_SENSOR)[0]
-        self._sensor_handle = self._char_sensor.getHandle() + 1
-
         self._char_steps = self.svc_1.getCharacteristics(UUIDS.CHARACTERISTIC_STEPS)[0]
+
+        # The software revision tells whether cached handles still fit the band.
+        self._char_revision = self.svc_device_info.getCharacteristics(UUIDS.CHARACTERISTIC_REVISION)[0]
+        self.firmware_revision = self._char_revision.read().decode(errors='replace')
+        self._char_current_time = self.getCharacteristics(uuid=UUIDS.CHARACTERISTIC_CURRENT_TIME)[0]
+        self._save_cached_handles()
+
+
+    def _set_sensor_handles(self):
+        self._heart_measure_handle = self._char_heart_measure.getHandle() + 1
+        self._hz_handle = self._char_hz.getHandle() + 1
+        self._sensor_handle = self._char_sensor.getHandle() + 1
         self._steps_handle = self._char_steps.getHandle() + 1
 
-        self._auth_notif(True)
-        self.activity_notif_enabled = False
-        self.waitForNotifications(0.1)
-        self.setDelegate( Delegate(self) )
+
+    def _load_cached_handles(self):
+        # Service discovery takes seconds; a cached entry only needs one read of the
+        #   revision characteristic to confirm it still belongs to this band's firmware.
+        if not gatt_cache_filename:
+            return False
+        cache_entry = read_gatt_cache().get(self.mac_address)
+        if not cache_entry or any(name not in cache_entry['characteristics'] for name in gatt_cache_characteristics) \
+                or any(name not in cache_entry['descriptors'] for name in gatt_cache_descriptors):
+            return False
+        revision_handle = cache_entry['characteristics']['_char_revision'][3]
+        try:
+            firmware_revision = self.readCharacteristic(revision_handle).decode(errors='replace')
+        except BTLEGattError:
+            firmware_revision = None
+        if firmware_revision != cache_entry['firmware_revision']:
+            self._log.info("Firmware revision changed, discarding cached GATT handles")
+            invalidate_gatt_cache(self.mac_address)
+            return False
+
+        for name in gatt_cache_characteristics:
+            uuid, handle, properties, value_handle = cache_entry['characteristics'][name]
+            setattr(self, name, Characteristic(self, uuid, handle, properties, value_handle))
+        for name in gatt_cache_descriptors:
+            uuid, handle = cache_entry['descriptors'][name]
+            setattr(self, name, Descriptor(self, uuid, handle))
+        self.firmware_revision = firmware_revision
+        self._log.info("Using cached GATT handles")
+        return True
+
+
+    def _save_cached_handles(self):
+        if not gatt_cache_filename:
+            return
+        characteristics = {}
+        for name in gatt_cache_characteristics:
+            characteristic = getattr(self, name)
+            characteristics[name] = [str(characteristic.uuid), characteristic.handle,
+                                     characteristic.properties, characteristic.valHandle]
+        descriptors = {}
+        for name in gatt_cache_descriptors:
+            descriptor = getattr(self, name)
+            descriptors[name] = [str(descriptor.uuid), descriptor.handle]
+        with gatt_cache_lock:
+            gatt_cache = read_gatt_cache()
+            gatt_cache[self.mac_address] = {
+                'firmware_revision': self.firmware_revision,
+                'characteristics': characteristics,
+                'descriptors': descriptors
+                }
+            write_gatt_cache(gatt_cache)
 
 
     def _auth_notif(self, enabled):
@@ -169,6 +373,9 @@ class miband(Peripheral):
                 continue
 
             self._log.error(self.state)
+            if self.handles_from_cache:
+                # Could be stale handles rather than a bad key; rediscover next time.
+                invalidate_gatt_cache(self.mac_address)
             return False
 
 
@@ -186,37 +393,156 @@ class miband(Peripheral):
         self.waitForNotifications(self.timeout)
 
 
+    def fetch_activity_history(self, callback, end_time=None):
+        # Downloads the per-minute history stored on the band since the last download
+        #   (or the last activity_history_default_hours) and hands it to
+        #   callback(times, records) as it arrives.  Blocking; run it on the band's I/O
+        #   thread before streaming starts.  Returns the number of minutes fetched.
+        if end_time is None:
+            end_time = time.time()
+        start_time = read_activity_fetch_state().get(self.mac_address,
+                                                     end_time - activity_history_default_hours * 3600)
+        if start_time >= end_time - 60:
+            return 0
+
+        self._log.info("Fetching activity history since {}".format(datetime.fromtimestamp(start_time)))
+        self.activity_fetch = Activity_Fetch(end_time, callback)
+        if not self.activity_notif_enabled:
+            self._auth_previews_data_notif(True)
+        self._request_activity(start_time)
+
+        idle_deadline = time.time() + activity_fetch_timeout
+        while not self.activity_fetch.finished:
+            if self.waitForNotifications(0.5):
+                idle_deadline = time.time() + activity_fetch_timeout
+            elif time.time() > idle_deadline:
+                self._log.warning("Activity history download stalled, continuing next time")
+                break
+
+        record_count = self.activity_fetch.record_count
+        self.activity_fetch = None
+        self._auth_previews_data_notif(False)
+        self._log.info("Fetched {} minutes of activity history".format(record_count))
+        return record_count
+
+
+    def _request_activity(self, start_time):
+        start = datetime.fromtimestamp(start_time)
+        # The band wants the time zone offset it reports in its current time characteristic.
+        utc_offset = self._char_current_time.read()[9:11]
+        trigger = BYTEPATTERNS.fetch_trigger + struct.pack('<HBBBB', start.year, start.month, start.day,
+                                                           start.hour, start.minute) + utc_offset
+        self._char_fetch.write(trigger, False)
+
+
+    def _handle_fetch_response(self, data):
+        activity_fetch = self.activity_fetch
+        if data[:3] == BYTEPATTERNS.fetch_begin:
+            year, month, day, hour, minute = struct.unpack('<HBBBB', data[7:13])
+            activity_fetch.start_chunk(datetime(year, month, day, hour, minute).timestamp())
+            self._char_fetch.write(BYTEPATTERNS.fetch_data, False)
+        elif data[:3] == BYTEPATTERNS.fetch_continue:
+            # End of a chunk; save progress, then ask for the rest if there is more.
+            if activity_fetch.last_time is None:
+                activity_fetch.finished = True
+                return
+            save_activity_fetch_state(self.mac_address, activity_fetch.last_time + 60)
+            if activity_fetch.last_time >= activity_fetch.end_time - 120:
+                activity_fetch.finished = True
+            else:
+                self._request_activity(activity_fetch.last_time + 60)
+        else:
+            # fetch_complete (no more data) or fetch_error
+            if activity_fetch.last_time is not None:
+                save_activity_fetch_state(self.mac_address, activity_fetch.last_time + 60)
+            activity_fetch.finished = True
+
+
     def _encrypt(self, message):
         aes = AES.new(self.auth_key, AES.MODE_ECB)
         return aes.encrypt(message)
 
 
+    def _init_queues(self):
+        self.queues = {_type: deque(maxlen=notification_queue_length) for _type in QUEUE_TYPES.ALL}
+        # Arrival times, kept alongside the queued payloads while latency is measured
+        self.queue_times = {_type: deque(maxlen=notification_queue_length) for _type in QUEUE_TYPES.ALL}
+        self.dropped_notifications = {_type: 0 for _type in QUEUE_TYPES.ALL}
+        self.callbacks = {}
+        self.metric_counts = metrics.counts(band=self.mac_address)
+        for _type in QUEUE_TYPES.ALL:
+            metrics.register_gauge('notification_queue_depth', self.queues[_type].__len__,
+                                   band=self.mac_address, type=_type)
+        metrics.register_gauge('write_queue_depth', lambda: self.write_queue.qsize(), band=self.mac_address)
+
+
+    def register_callback(self, _type, callback):
+        # Parsed data of the given QUEUE_TYPES value goes to callback; None unregisters.
+        #   Only types with a callback are queued, so unregistering drops what is left.
+        if callback is None:
+            self.callbacks.pop(_type, None)
+            self.queues[_type].clear()
+            self.queue_times[_type].clear()
+        elif _type not in queue_parsers:
+            raise ValueError("No parser for notification type {}".format(_type))
+        else:
+            self.callbacks[_type] = callback
+
+
+    def enqueue_notification(self, _type, data):
+        self.metric_counts['notifications_total', _type] += 1
+        if self.notification_recorder:
+            self.notification_recorder.record(_type, data)
+        if _type not in self.callbacks:
+            # Nobody reads this type, as in the days before per-type queues.
+            return
+        queue = self.queues[_type]
+        if len(queue) == queue.maxlen:
+            self.dropped_notifications[_type] += 1
+            self.metric_counts['dropped_notifications_total', _type] += 1
+        queue.append(data)
+        if latency.enabled:
+            self.queue_times[_type].append(latency.now())
+
+
     def _get_from_queue(self, _type):
         try:
-            res = self.queue.get(False)
-        except Empty:
+            return self.queues[_type].popleft()
+        except IndexError:
             return None
-        if res[0] != _type:
-            self.queue.put(res)
-            return None
-        return res[1]
 
 
     def _parse_queue(self):
-        while True:
-            try:
-                queue_data = self.queue.get(False)
-                _type = queue_data[0]
-                if self.heart_measure_callback and _type == QUEUE_TYPES.HEART:
-                    self.heart_measure_callback(self._parse_heart_measure(queue_data[1]))
-                elif self.gyro_raw_callback and _type == QUEUE_TYPES.RAW_GYRO:
-                    self.gyro_raw_callback(self._parse_raw_gyro(queue_data[1]))
-                elif self.gyro_avg_callback and _type == QUEUE_TYPES.AVG_GYRO:
-                    self.gyro_avg_callback(self._parse_avg_gyro(queue_data[1]))
-            except Empty:
-                break
-
-    def _parse_avg_gyro(self, bytes):
+        # Drains each registered type's queue in one go; ordering within a stream is kept.
+        for _type, callback in list(self.callbacks.items()):
+            queue = self.queues[_type]
+            if not queue:
+                continue
+            payloads = [queue.popleft() for _ in range(len(queue))]
+            parsed_items = queue_parsers[_type](payloads)
+            self.metric_counts['parse_batches_total', _type] += 1
+            self.metric_counts['parsed_items_total', _type] += len(parsed_items)
+            if latency.enabled:
+                self._dispatch_traced(_type, parsed_items, callback)
+            else:
+                for parsed_data in parsed_items:
+                    callback(parsed_data)
+
+
+    def _dispatch_traced(self, _type, parsed_items, callback):
+        # Batched items are traced from the arrival of the oldest payload in the batch.
+        queue_times = self.queue_times[_type]
+        trace_times = [queue_times.popleft() for _ in range(len(queue_times))]
+        if len(trace_times) != len(parsed_items):
+            trace_times = trace_times[:1] * len(parsed_items)
+        for parsed_data, trace_time in zip(parsed_items, trace_times):
+            latency.set_trace(trace_time)
+            latency.mark('dequeue')
+            callback(parsed_data)
+        latency.set_trace(None)
+
+    @staticmethod
+    def _parse_avg_gyro(bytes):
         gyro_avg_data = struct.unpack('<b3h', bytes[1:])
         gyro_dict = {
             'gyro_time': gyro_avg_data[0],
@@ -228,14 +554,16 @@ class miband(Peripheral):
         return return_tuple
 
 
-    def _parse_heart_measure(self, bytes):
+    @staticmethod
+    def _parse_heart_measure(bytes):
         res = struct.unpack('bb', bytes)[1]
         return_tuple = ["HR", res]
         #print("BPM: {}".format(res))
         return return_tuple
 
 
-    def _parse_raw_gyro(self, bytes):
+    @staticmethod
+    def _parse_raw_gyro(bytes):
         gyro_raw_data_list = []
         for i in range(2, 20, 6):
             gyro_raw_data = struct.unpack("3h", bytes[i:(i+6)])
@@ -249,6 +577,15 @@ class miband(Peripheral):
         return return_tuple
 
 
+    @staticmethod
+    def _parse_raw_gyro_batch(packets):
+        # Decodes any number of 20-byte raw gyro packets into an (N, 3) int16 x/y/z array,
+        #   three consecutive rows per packet.
+        gyro_packets = np.frombuffer(b''.join(packets), dtype=raw_gyro_packet_dtype)
+        return_tuple = ["GYRO_RAW_BATCH", gyro_packets['xyz'].reshape(-1, 3)]
+        return return_tuple
+
+
     def process_write_queue(self):
         while True:
             try:
@@ -259,6 +596,8 @@ class miband(Peripheral):
                     self.write_cmd(_payload[0], _payload[1], response=_payload[2])
                 elif _type == 'write_req':
                     self.write_req(_payload[0], _payload[1], response=_payload[2])
+                if res[2] is not None:
+                    latency.mark('write_sent', res[2])
             except Empty:
                 break
 
@@ -271,34 +610,82 @@ class miband(Peripheral):
             self.write_cmd(self._char_alert, BYTEPATTERNS.vibration(value), queued=True)
         else:
             # A value of '150' will vibrate for ~200ms, hence vibration_scaler.
-            #   This isn't exact however, but does leave a ~5ms gap between pulses.
-            #   A scaler any lower causes the pulses to be indistinguishable from each other to a human.
             #   I considered making this function accept a desired amount of vibration time in ms, 
             #   however it was fiddly and I couldn't get it right.  More work could be done here.
-            vibration_scaler = 0.75  
-            ms = round(value / vibration_scaler)
-            vibration_duration = ms / 1000
+            vibration_duration = vibration_seconds(value)
             self.write_cmd(self._char_alert, BYTEPATTERNS.vibration(value), queued=True)
             time.sleep(vibration_duration)
 
 
     def write_cmd(self, characteristic, data, response=False, queued=False):
         if queued:
-            self.write_queue.put(['write_cmd', [characteristic, data, response]])
+            trace = latency.take_trace()
+            self.write_queue.put(['write_cmd', [characteristic, data, response], trace])
+            if trace is not None:
+                latency.mark('write_enqueue', trace)
         else:
             characteristic.write(data, withResponse=response)
 
 
     def write_req(self, handle, data, response=True, queued=False):
         if queued:
-            self.write_queue.put(['write_req', [handle, data, response]])
+            trace = latency.take_trace()
+            self.write_queue.put(['write_req', [handle, data, response], trace])
+            if trace is not None:
+                latency.mark('write_enqueue', trace)
         else:
             self.writeCharacteristic(handle, data, withResponse=response)
 
 
+    def play_vibration_program(self, program, trace=None):
+        # Hands a compiled program to this band's I/O loop, which sends every pulse
+        #   itself at its due time (see _play_vibration).  Safe to call from any thread.
+        playback = Vibration_Playback(program, trace)
+        if trace is not None:
+            latency.mark('write_enqueue', trace)
+        self.vibration_programs.append(playback)
+        return playback
+
+
+    def _play_vibration(self):
+        # Sends the pulses that are due; returns the time the next one is due, or None.
+        while self.vibration_programs:
+            playback = self.vibration_programs[0]
+            if playback.abandoned:
+                self.vibration_programs.popleft()
+                playback.finish()
+                continue
+            if playback.start_time is None:
+                playback.start_time = clock.time()
+            while playback.next_pulse < len(playback.program):
+                offset, value = playback.program[playback.next_pulse]
+                due_time = playback.start_time + offset
+                send_time = clock.time()
+                if due_time > send_time:
+                    return due_time
+                self._char_alert.write(BYTEPATTERNS.vibration(value), withResponse=False)
+                playback.jitter.append(send_time - due_time)
+                if playback.next_pulse == 0 and playback.trace is not None:
+                    latency.mark('write_sent', playback.trace)
+                playback.next_pulse += 1
+            self.vibration_programs.popleft()
+            playback.finish()
+        return None
+
+
     def wait_for_notifications_with_queued_writes(self, wait):
         self.process_write_queue()
-        self.waitForNotifications(wait)
+        next_pulse_time = self._play_vibration()
+        if next_pulse_time is not None:
+            # Wake up in time for the next pulse rather than after a full wait.
+            wait = min(wait, max(next_pulse_time - clock.time(), 0))
+        if self.waitForNotifications(wait):
+            # Pick up whatever else has already arrived, so it is parsed as one batch.
+            for _ in range(notification_batch_limit):
+                if next_pulse_time is not None and clock.time() >= next_pulse_time:
+                    break
+                if not self.waitForNotifications(0):
+                    break
 
 
     def send_gyro_start(self, sensitivity):
@@ -326,8 +713,8 @@ class miband(Peripheral):
 
 
     def start_heart_and_gyro(self, sensitivity, callback):
-        self.heart_measure_callback = callback
-        self.gyro_raw_callback = callback
+        self.register_callback(QUEUE_TYPES.HEART, callback)
+        self.register_callback(QUEUE_TYPES.RAW_GYRO, callback)
 
         self.send_gyro_start(sensitivity)
         self.send_heart_measure_start()
@@ -339,4 +726,68 @@ class miband(Peripheral):
             if (time.time() - heartbeat_time) >= 12:
                 heartbeat_time = time.time()
                 self.send_heart_measure_keepalive()
-                self.send_gyro_start(sensitivity)
\ No newline at end of file
+                self.send_gyro_start(sensitivity)
+
+
+def vibration_seconds(value):
+    # How long the motor runs for a vibration value, see vibration_scaler.
+    return round(value / vibration_scaler) / 1000
+
+
+def read_gatt_cache():
+    try:
+        with open(gatt_cache_filename, 'r') as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_json_file(filename, data, **dump_args):
+    # Written to a temporary file of its own, then renamed over the old one, so a
+    #   reader never sees a partial file.
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(filename)),
+                                     prefix=os.path.basename(filename) + '.', delete=False) as temp_file:
+        try:
+            json.dump(data, temp_file, **dump_args)
+        except BaseException:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, filename)
+
+
+def write_gatt_cache(gatt_cache):
+    write_json_file(gatt_cache_filename, gatt_cache, indent=1)
+
+
+def invalidate_gatt_cache(mac_address):
+    if not gatt_cache_filename:
+        return
+    with gatt_cache_lock:
+        gatt_cache = read_gatt_cache()
+        if gatt_cache.pop(mac_address, None) is not None:
+            write_gatt_cache(gatt_cache)
+
+
+def read_activity_fetch_state():
+    try:
+        with open(activity_fetch_filename, 'r') as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_activity_fetch_state(mac_address, resume_time):
+    with activity_fetch_lock:
+        fetch_state = read_activity_fetch_state()
+        fetch_state[mac_address] = resume_time
+        write_json_file(activity_fetch_filename, fetch_state)
+
+
+# Turns a list of queued payloads into the items handed to a type's callback.
+#   Raw gyro packets are decoded as one batch, everything else one by one.
+queue_parsers = {
+    QUEUE_TYPES.HEART: lambda payloads: [miband._parse_heart_measure(payload) for payload in payloads],
+    QUEUE_TYPES.RAW_GYRO: lambda payloads: [miband._parse_raw_gyro_batch(payloads)],
+    QUEUE_TYPES.AVG_GYRO: lambda payloads: [miband._parse_avg_gyro(payload) for payload in payloads]
+    }
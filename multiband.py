@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse, asyncio, os, re, time
+
+from bluepy.btle import BTLEDisconnectError
+
+import sleepdata
+import bandio
+import bluesleep
+import detectors
+import metrics
+from miband import miband
+from simband import Simulated_Band
+from vibrate import Vibrate
+
+# Monitors several bands from one process, e.g. for several sleepers in a shared room.
+#   Every band gets a Band_Monitor with its own Sleep_Session (buffers, averaging,
+#   heartrate history, output in a subdirectory named after the band) and its own
+#   Vibrate alarm.  All bands are serviced by one asyncio loop (see bandio.py), each
+#   through its own transport, so a slow or disconnected band only blocks its own
+#   worker thread.  The notification stream yields to the loop after every item, so
+#   a burst of gyro packets from one band cannot delay another band's alarm by more
+#   than a single sample.
+#
+# Bands are listed one per line in bands_filename:
+#   <name> <MAC address> <auth key> [HCI adapter number]
+
+bands_filename = 'bands.txt'
+
+reconnect_seconds = 3
+
+band_line_pattern = re.compile(r'^(\S+)\s+([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})\s+([0-9a-fA-F]{32})(?:\s+(?:hci)?(\d+))?$')
+
+
+class Band_Monitor():
+
+    def __init__(self, name, mac_address=None, auth_key=None, iface=None, simulated=False):
+        self.name = name
+        self.mac_address = mac_address
+        self.auth_key = auth_key
+        self.iface = iface
+        self.simulated = simulated
+        self.band = None
+        self.session = sleepdata.Sleep_Session(name)
+        self.vibration = Vibrate(None)
+        self.vibration.on_alarm = self.session.write_alarm
+        self.vibration.metric_counts = metrics.counts(session=name, source='vibrate')
+
+
+    def connect(self):
+        # Blocking; retries until the band is authenticated.
+        while True:
+            try:
+                if self.simulated:
+                    self.band = Simulated_Band(self.mac_address or '00:00:00:00:00:00')
+                else:
+                    self.band = miband(self.mac_address, self.auth_key, debug=True, iface=self.iface)
+                if self.band.initialize():
+                    self.band.metric_counts['connects_total'] += 1
+                    if not self.simulated and bluesleep.fetch_activity_on_connect:
+                        self.band.fetch_activity_history(self.session.write_activity)
+                    self.vibration.vibrate_band = self.band
+                    return
+            except BTLEDisconnectError:
+                pass
+            except Exception as error:
+                # BTLEException, OSError from a missing adapter, ...: retried the same way.
+                print("{}: {}: {}".format(self.name, type(error).__name__, error))
+            metrics.counts(band=self.mac_address)['connect_failures_total'] += 1
+            print("{}: connection failed, trying again in {} seconds".format(self.name, reconnect_seconds))
+            time.sleep(reconnect_seconds)
+
+
+    def handle_sample(self, data):
+        bluesleep.handle_sample(self.session, self.vibration, data)
+
+
+    async def run(self, vibration_settings):
+        loop = asyncio.get_running_loop()
+        # Each sleeper has their own LSTM model, next to their recorded sessions.
+        bluesleep.configure_detectors(self.session, vibration_settings, os.path.join(
+            sleepdata.data_writer_settings['output_dir'], self.name, bluesleep.lstm_model_filename))
+        self.vibration.configure_heartrate_alarm(vibration_settings)
+        while True:
+            # Any error is this band's own: it reconnects while the other bands carry on.
+            transport = None
+            try:
+                if self.band is None:
+                    await loop.run_in_executor(None, self.connect)
+                if self.simulated:
+                    transport = bandio.Simulated_Transport(self.band)
+                else:
+                    transport = bandio.Band_Transport(self.band)
+                await bandio.run_monitor(transport, self.handle_sample, self.vibration, vibration_settings)
+            except BTLEDisconnectError:
+                print("{}: disconnected".format(self.name))
+                self.band.metric_counts['disconnects_total'] += 1
+                self.band = None
+            except Exception as error:
+                print("{}: {}: {}, reconnecting in {} seconds".format(
+                    self.name, type(error).__name__, error, reconnect_seconds))
+                self.band.metric_counts['disconnects_total'] += 1
+                self.band = None
+                await asyncio.sleep(reconnect_seconds)
+            finally:
+                if transport is not None:
+                    transport.close()
+
+
+def read_bands(filename):
+    band_monitors = []
+    with open(filename, 'r') as bands_file:
+        for line_number, line in enumerate(bands_file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            band_match = band_line_pattern.match(line)
+            if not band_match:
+                print("Invalid band on line {} of {}: {}".format(line_number, filename, line))
+                exit(1)
+            name, mac_address, auth_key, iface = band_match.groups()
+            band_monitors.append(Band_Monitor(name, mac_address, bytes.fromhex(auth_key),
+                                              iface=int(iface) if iface is not None else None))
+    return band_monitors
+
+
+async def supervise(band_monitors, vibration_settings, seconds=None):
+    band_tasks = [asyncio.create_task(band_monitor.run(vibration_settings)) for band_monitor in band_monitors]
+    try:
+        await asyncio.wait_for(asyncio.gather(*band_tasks), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monitor several bands at once')
+    parser.add_argument('bands', nargs='?', default=bands_filename, help='file listing the bands to monitor')
+    parser.add_argument('--simulate', type=int, metavar='N', help='monitor N simulated bands instead')
+    parser.add_argument('--seconds', type=float, help='stop after this many seconds')
+    parser.add_argument('--detectors', type=bluesleep.parse_detectors, default=bluesleep.vibration_settings['detectors'],
+                        help='comma separated alarm detectors: ' + ', '.join(detectors.detector_names))
+    parser.add_argument('--metrics-port', type=int, default=bluesleep.metrics_port,
+                        help='serve Prometheus metrics on this localhost port')
+    parser.add_argument('--metrics-socket', default=bluesleep.metrics_socket,
+                        help='serve Prometheus metrics on this Unix socket')
+    args = parser.parse_args()
+    bluesleep.vibration_settings['detectors'] = args.detectors
+    bluesleep.start_metrics(args.metrics_port, args.metrics_socket)
+
+    if args.simulate:
+        # Distinct addresses keep each simulated band's metrics apart.
+        band_monitors = [Band_Monitor('band{}'.format(number), '00:00:00:00:00:{:02X}'.format(number), simulated=True)
+                         for number in range(args.simulate)]
+    elif os.path.exists(args.bands):
+        band_monitors = read_bands(args.bands)
+    else:
+        print("Bands file not found: {}".format(args.bands))
+        exit(1)
+
+    asyncio.run(supervise(band_monitors, bluesleep.vibration_settings, args.seconds))
@@ -0,0 +1,28 @@
+import time
+
+# Text log of the raw notifications miband queues, one per line:
+#   <receive time> <queue type> <payload hex>
+#   Written while monitoring (see bluesleep.notification_log_filename) and read back
+#   by replay.py to push a recorded night through the same parsing path again.
+
+class Notification_Recorder():
+
+    def __init__(self, filename):
+        self.log_file = open(filename, 'a')
+
+
+    def record(self, queue_type, data):
+        self.log_file.write("{:.6f} {} {}\n".format(time.time(), queue_type, bytes.hex(data)))
+
+
+    def close(self):
+        self.log_file.close()
+
+
+def read_notification_log(filename):
+    with open(filename, 'r') as log_file:
+        for line in log_file:
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            yield float(fields[0]), fields[1], bytes.fromhex(fields[2])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import argparse, contextlib, logging, os, time
+from datetime import datetime
+
+import numpy as np
+
+import clock
+import sleepdata
+import bluesleep
+import detectors
+import sessionfile
+from miband import miband
+from constants import QUEUE_TYPES
+from notificationlog import read_notification_log
+from vibrate import Vibrate
+
+# Offline replay of a recorded night through bluesleep.sleep_monitor_callback.
+#   Events come either from a raw notification log (see notificationlog.py) or from
+#   the parsed samples in a binary session (see sessionfile.py).  A Virtual_Clock is
+#   set to each event's recorded time before it is handed to the callback, so
+#   averaging and the heartrate alarm behave as they did live, only as fast as the
+#   CPU allows.  Alarms are evaluated after every event and reported instead of
+#   being sent to a band.
+#
+#   A session only holds raw data that was written out: heartrate and movement rows
+#   are written once they leave the longest averaging window, so the last window of
+#   a night (e.g. 15 seconds of heartrate) never reaches the file, and neither does
+#   an alarm raised on it.  Replaying a session can therefore report fewer alarms
+#   than the live run did.
+
+notification_parsers = {
+    QUEUE_TYPES.HEART: miband._parse_heart_measure,
+    QUEUE_TYPES.RAW_GYRO: miband._parse_raw_gyro
+    }
+
+
+def notification_log_events(filename):
+    for receive_time, queue_type, data in read_notification_log(filename):
+        parser = notification_parsers.get(queue_type)
+        if parser:
+            yield receive_time, parser(data)
+
+
+def session_events(session):
+    heartrate = session['raw_bpm'] if 'raw_bpm' in session else sessionfile.make_records('raw_bpm', [], [[]])
+    gyro = session['raw_gyro'] if 'raw_gyro' in session else sessionfile.make_records('raw_gyro', [], [[], [], []])
+
+    # Every batch of packets handled live was written with its own tick time, so
+    #   records sharing a time are one batch.  Replayed as a batch, three samples to
+    #   a packet, movement is scored per packet exactly as it was live.
+    gyro_bounds = np.flatnonzero(np.diff(gyro['time'])) + 1
+    gyro_starts = np.concatenate(([0], gyro_bounds)) if len(gyro) else np.zeros(0, dtype=int)
+    gyro_ends = np.concatenate((gyro_bounds, [len(gyro)])) if len(gyro) else np.zeros(0, dtype=int)
+
+    heartrate_times = heartrate['time'].tolist()
+    heartrate_values = heartrate['bpm'].tolist()
+    gyro_times = gyro['time'].tolist()
+    gyro_xyz = np.column_stack([gyro[axis] for axis in ('gyro_raw_x', 'gyro_raw_y', 'gyro_raw_z')])
+
+    heartrate_index = 0
+    for gyro_start, gyro_end in zip(gyro_starts.tolist(), gyro_ends.tolist()):
+        packet_time = gyro_times[gyro_start]
+        while heartrate_index < len(heartrate_times) and heartrate_times[heartrate_index] <= packet_time:
+            yield heartrate_times[heartrate_index], ["HR", heartrate_values[heartrate_index]]
+            heartrate_index += 1
+        yield packet_time, ["GYRO_RAW_BATCH", gyro_xyz[gyro_start:gyro_end]]
+    for i in range(heartrate_index, len(heartrate_times)):
+        yield heartrate_times[i], ["HR", heartrate_values[i]]
+
+
+def replay(events, vibration_settings):
+    virtual_clock = clock.Virtual_Clock()
+    clock.set_clock(virtual_clock)
+
+    vibration = Vibrate(None)
+    vibration.configure_heartrate_alarm(vibration_settings)
+    vibration.on_alarm = sleepdata.default_session.write_alarm
+    bluesleep.vibration = vibration
+
+    alarms = []
+    event_count = 0
+    first_time = last_time = None
+    for event_time, data in events:
+        virtual_clock.set_time(event_time)
+        bluesleep.sleep_monitor_callback(data)
+        if vibration.check_heartrate_alarm():
+            alarms.append((event_time, vibration.heartrate_increase_pct,
+                           sleepdata.default_session.detector_bank.alarm_detector.name))
+        if first_time is None:
+            first_time = event_time
+        last_time = event_time
+        event_count += 1
+
+    return {
+        'events': event_count,
+        'first_time': first_time,
+        'last_time': last_time,
+        'alarms': alarms
+        }
+
+
+def parse_periods(periods):
+    return [int(period) for period in periods.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a recorded night through the blesleep pipeline')
+    parser.add_argument('logs', nargs='*', help='raw notification logs to replay, in order')
+    parser.add_argument('--session', help='datestamp of a binary session to replay, e.g. 2020_01_01')
+    parser.add_argument('--session-dir', default='.')
+    parser.add_argument('--alarm-pct', type=int, default=bluesleep.vibration_settings['heartrate_alarm_pct'])
+    parser.add_argument('--interval-minutes', type=float, default=bluesleep.vibration_settings['interval_minutes'])
+    parser.add_argument('--hr-periods', type=parse_periods, help='comma separated, e.g. 2,5,10,15')
+    parser.add_argument('--movement-periods', type=parse_periods, help='comma separated, e.g. 10,30,60')
+    parser.add_argument('--detectors', type=bluesleep.parse_detectors, default=bluesleep.vibration_settings['detectors'],
+                        help='comma separated alarm detectors: ' + ', '.join(detectors.detector_names))
+    parser.add_argument('--lstm-model', help='alarm on this trained LSTM model (alone, unless --detectors names others)')
+    parser.add_argument('--lstm-alarm-pct', type=int, default=bluesleep.vibration_settings['lstm_alarm_pct'])
+    parser.add_argument('--output', help='directory for the replayed CSV output (default: none)')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if not args.logs and not args.session:
+        parser.error('give notification logs or --session')
+
+    vibration_settings = dict(bluesleep.vibration_settings)
+    vibration_settings['heartrate_alarm_pct'] = args.alarm_pct
+    vibration_settings['interval_minutes'] = args.interval_minutes
+    vibration_settings['lstm_alarm_pct'] = args.lstm_alarm_pct
+
+    if args.hr_periods:
+        sleepdata.sleep_data['heartrate']['periods'] = args.hr_periods
+    if args.movement_periods:
+        sleepdata.sleep_data['movement']['periods'] = args.movement_periods
+    sleepdata.init_sleep_data()
+    vibration_settings['detectors'] = args.detectors
+    if args.lstm_model and 'lstm' not in args.detectors:
+        vibration_settings['detectors'] = ['lstm']
+    bluesleep.configure_detectors(sleepdata.default_session, vibration_settings,
+                                  args.lstm_model or bluesleep.lstm_model_filename)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        sleepdata.data_writer_settings['output_dir'] = args.output
+    else:
+        sleepdata.output_formats = []
+
+    if args.session:
+        events = session_events(sessionfile.Session_Reader(args.session, args.session_dir))
+    else:
+        events = (event for filename in args.logs for event in notification_log_events(filename))
+
+    start_time = time.time()
+    if args.verbose:
+        results = replay(events, vibration_settings)
+    else:
+        logging.disable(logging.INFO)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = replay(events, vibration_settings)
+    elapsed_time = time.time() - start_time
+
+    print("Replayed {} events in {:.2f} seconds".format(results['events'], elapsed_time))
+    if results['events']:
+        recorded_seconds = results['last_time'] - results['first_time']
+        print("Recorded span: {:.0f} seconds ({:.0f}x real time)".format(
+            recorded_seconds, recorded_seconds / max(elapsed_time, 1e-9)))
+    print("Alarms: {}".format(len(results['alarms'])))
+    for alarm_time, alarm_level, detector_name in results['alarms']:
+        print("  {} by {} at {} percent of its threshold".format(datetime.fromtimestamp(alarm_time), detector_name, alarm_level))
+    for timing_report in sleepdata.default_session.detector_bank.timing_reports():
+        print(timing_report)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import argparse, csv, json, os, re, time
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import sessionfile
+from constants import SLEEP_STAGES
+
+# Nightly summaries of recorded data: resting heartrate, heartrate spikes over the
+#   alarm percent, movement, alarms and sleep stages, one row per night.  Files are
+#   named after the calendar date of their rows, so a night runs from noon
+#   (night_start_hour) of its date to noon of the next and is read from both days'
+#   files.  Every night is loaded and summarized in a worker process, reading
+#   binary session files (see sessionfile.py) where they exist and CSV otherwise.
+#   Summaries are cached in report_cache_filename in each data directory, keyed by
+#   the size and modification time of the night's files, so a rerun only
+#   processes new or changed nights.
+
+report_cache_filename = 'report_cache.json'
+
+# A night is named after the date it starts on, and runs from this hour to the same
+#   hour of the next day.
+night_start_hour = 12
+
+# Spikes are counted at the alarm's percent, see bluesleep.vibration_settings
+heartrate_alarm_pct = 17
+# Resting heartrate is this percentile of the night's heartrate readings
+resting_heartrate_percentile = 5
+# Readings the spike rule looks back over, see detectors.heartrate_window_readings
+spike_window_readings = 10
+
+session_file_pattern = re.compile(r'^(\d{4}_\d{2}_\d{2})_(\w+)\.(csv|bsl)$')
+
+# Data read for a summary: binary channel, CSV name and field of each
+report_columns = {
+    'heartrate': ('raw_bpm', 'raw_bpm', 'bpm'),
+    'movement': ('raw_movement', 'raw_movement', 'movement'),
+    'alarm': ('alarm', 'alarm', 'pct'),
+    'stage': ('sleep_stage', 'stage', 'stage')
+    }
+
+report_fields = ['date', 'hours', 'resting_hr', 'mean_hr', 'hr_spikes', 'movement', 'alarms',
+                 'wake_minutes', 'light_minutes', 'deep_minutes']
+
+
+def night_datestamps(night):
+    # The datestamps of the files holding a night's rows: its own date and the next.
+    night_date = datetime.strptime(night, "%Y_%m_%d")
+    return [night, (night_date + timedelta(days=1)).strftime("%Y_%m_%d")]
+
+
+def night_bounds(night):
+    night_start = datetime.strptime(night, "%Y_%m_%d").replace(hour=night_start_hour)
+    return night_start.timestamp(), (night_start + timedelta(days=1)).timestamp()
+
+
+def find_nights(data_dir):
+    # Returns {night: {filename: [size, mtime_ns]}} of the files a summary reads.
+    #   A day's files belong to two nights: the one ending that morning and the one
+    #   starting that evening.
+    used_names = set()
+    for binary_channel, csv_name, _ in report_columns.values():
+        used_names.update((binary_channel, csv_name))
+    nights = {}
+    for filename in os.listdir(data_dir):
+        file_match = session_file_pattern.match(filename)
+        if not file_match or file_match.group(2) not in used_names:
+            continue
+        file_stat = os.stat(os.path.join(data_dir, filename))
+        datestamp = file_match.group(1)
+        previous_night = (datetime.strptime(datestamp, "%Y_%m_%d") - timedelta(days=1)).strftime("%Y_%m_%d")
+        for night in (previous_night, datestamp):
+            nights.setdefault(night, {})[filename] = [file_stat.st_size, file_stat.st_mtime_ns]
+    return nights
+
+
+def load_night_column(data_dir, night, filenames, column):
+    # Times and values of one report column between the night's bounds, from the
+    #   files of both its datestamps.
+    start_time, end_time = night_bounds(night)
+    times, values = zip(*(load_column(data_dir, datestamp, filenames, column)
+                          for datestamp in night_datestamps(night)))
+    times = np.concatenate(times)
+    in_night = (times >= start_time) & (times < end_time)
+    return times[in_night], np.concatenate(values)[in_night]
+
+
+def load_column(data_dir, datestamp, filenames, column):
+    # Times and values of one report column, or empty arrays without data.
+    binary_channel, csv_name, field = report_columns[column]
+    binary_filename = sessionfile.session_filename_format.format(datestamp, binary_channel)
+    csv_filename = '{}_{}.csv'.format(datestamp, csv_name)
+    if binary_filename in filenames:
+        _, records = sessionfile.read_channel(os.path.join(data_dir, binary_filename))
+        return np.asarray(records['time']), np.asarray(records[field])
+    if csv_filename in filenames:
+        path = os.path.join(data_dir, csv_filename)
+        with open(path, 'r') as csv_file:
+            header = csv_file.readline().strip().split(',')
+        if column == 'stage':
+            rows = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, header.index(field)), dtype=str, ndmin=2)
+            stage_codes = {name: code for code, name in enumerate(SLEEP_STAGES.NAMES)}
+            return rows[:, 0].astype('float64'), np.array([stage_codes[name] for name in rows[:, 1]], dtype='u1')
+        rows = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, header.index(field)), ndmin=2)
+        return rows[:, 0], rows[:, 1]
+    return np.zeros(0), np.zeros(0)
+
+
+def count_heartrate_spikes(heartrates, alarm_pct):
+    # Episodes where a reading is alarm_pct over the lowest of the last
+    #   spike_window_readings readings, the rule the heartrate alarm uses.
+    heartrates = heartrates[heartrates > 0].astype('float64')
+    if len(heartrates) < spike_window_readings:
+        return 0
+    window_min = np.lib.stride_tricks.sliding_window_view(heartrates, spike_window_readings).min(axis=1)
+    over = (heartrates[spike_window_readings - 1:] - window_min) / window_min * 100 >= alarm_pct
+    return int(np.count_nonzero(over[1:] & ~over[:-1]) + over[0])
+
+
+def summarize_night(data_dir, night, filenames, heartrate_alarm_pct):
+    # None if nothing was recorded that night, e.g. for the night before the first
+    #   day's files.
+    heartrate_times, heartrates = load_night_column(data_dir, night, filenames, 'heartrate')
+    movement_times, movements = load_night_column(data_dir, night, filenames, 'movement')
+    alarm_times, _ = load_night_column(data_dir, night, filenames, 'alarm')
+    stage_times, stages = load_night_column(data_dir, night, filenames, 'stage')
+
+    recorded_times = np.concatenate((heartrate_times, movement_times))
+    if not len(recorded_times) and not len(alarm_times) and not len(stage_times):
+        return None
+    valid_heartrates = heartrates[heartrates > 0]
+    stage_minutes = np.bincount(stages.astype('int64'), minlength=len(SLEEP_STAGES.NAMES))
+    return {
+        'date': night,
+        'hours': round(float(recorded_times.max() - recorded_times.min()) / 3600, 2) if len(recorded_times) else 0,
+        'resting_hr': round(float(np.percentile(valid_heartrates, resting_heartrate_percentile)), 1)
+                      if len(valid_heartrates) else None,
+        'mean_hr': round(float(valid_heartrates.mean()), 1) if len(valid_heartrates) else None,
+        'hr_spikes': count_heartrate_spikes(heartrates, heartrate_alarm_pct),
+        'movement': int(movements.sum()),
+        'alarms': len(alarm_times),
+        'wake_minutes': int(stage_minutes[SLEEP_STAGES.WAKE]),
+        'light_minutes': int(stage_minutes[SLEEP_STAGES.LIGHT]),
+        'deep_minutes': int(stage_minutes[SLEEP_STAGES.DEEP])
+        }
+
+
+def read_report_cache(data_dir):
+    try:
+        with open(os.path.join(data_dir, report_cache_filename), 'r') as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_report_cache(data_dir, report_cache):
+    cache_filename = os.path.join(data_dir, report_cache_filename)
+    with open(cache_filename + '.tmp', 'w') as cache_file:
+        json.dump(report_cache, cache_file)
+    os.replace(cache_filename + '.tmp', cache_filename)
+
+
+def build_report(data_dirs, heartrate_alarm_pct, workers=None):
+    # Returns ({data_dir: [summary, ...]}, nights summarized, nights from the cache).
+    #   Nights without any recorded rows are cached but left out of the report.
+    settings = {'heartrate_alarm_pct': heartrate_alarm_pct}
+    caches = {}
+    pending = []
+    for data_dir in data_dirs:
+        report_cache = read_report_cache(data_dir)
+        nights = find_nights(data_dir)
+        # Drop nights whose files are gone.
+        caches[data_dir] = {night: entry for night, entry in report_cache.items() if night in nights}
+        for night, files in nights.items():
+            cache_entry = caches[data_dir].get(night)
+            if not cache_entry or cache_entry['files'] != files or cache_entry['settings'] != settings:
+                pending.append((data_dir, night, files))
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(data_dir, night, files,
+                        executor.submit(summarize_night, data_dir, night, sorted(files), heartrate_alarm_pct))
+                       for data_dir, night, files in pending]
+            for data_dir, night, files, future in futures:
+                caches[data_dir][night] = {'files': files, 'settings': settings, 'summary': future.result()}
+        for data_dir in data_dirs:
+            write_report_cache(data_dir, caches[data_dir])
+
+    summarized_count = sum(1 for data_dir, night, _ in pending if caches[data_dir][night]['summary'] is not None)
+    report = {data_dir: [caches[data_dir][night]['summary'] for night in sorted(caches[data_dir])
+                         if caches[data_dir][night]['summary'] is not None]
+              for data_dir in data_dirs}
+    summary_count = sum(len(summaries) for summaries in report.values())
+    return report, summarized_count, summary_count - summarized_count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Nightly summaries of recorded sleep data')
+    parser.add_argument('dirs', nargs='*', default=['.'],
+                        help='data directories, e.g. one per band as written by multiband.py')
+    parser.add_argument('--alarm-pct', type=int, default=heartrate_alarm_pct,
+                        help='heartrate increase percent counted as a spike')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--csv', help='also write the report to this CSV file')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    report, summarized_count, cached_count = build_report(args.dirs, args.alarm_pct, args.workers)
+
+    fields = (['user'] if len(args.dirs) > 1 else []) + report_fields
+    rows = [dict(summary, user=os.path.basename(os.path.abspath(data_dir)))
+            for data_dir, summaries in report.items() for summary in summaries]
+    print(' '.join("{:>13}".format(field) for field in fields))
+    for row in rows:
+        print(' '.join("{:>13}".format('-' if row[field] is None else str(row[field])) for field in fields))
+    print("{} nights summarized, {} from cache, in {:.2f} seconds".format(
+        summarized_count, cached_count, time.time() - start_time))
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=fields, extrasaction='ignore')
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
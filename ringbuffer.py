@@ -0,0 +1,195 @@
+import numpy as np
+
+# Fixed-capacity time/value store used for the raw and averaged sleep data series.
+#   Rows are addressed by an absolute, ever-increasing index: 'start' is the oldest
+#   row still held and 'end' is one past the newest.  The physical slot of a row is
+#   index % capacity, so evicting old rows only moves 'start' and never copies data.
+#   Timestamps must be appended in non-decreasing order.
+#   A full buffer overwrites its oldest rows, counted in 'overwritten', unless it was
+#   made with grow=True: then it doubles its capacity instead, for series whose rows
+#   must all be evicted (and written out) rather than lost.
+
+class Ring_Buffer():
+
+    def __init__(self, capacity, columns, dtype='float64', grow=False):
+        self.capacity = capacity
+        self.grow = grow
+        self.columns = list(columns)
+        self.column_index = {column: i for i, column in enumerate(self.columns)}
+        self.times = np.zeros(capacity, dtype='float64')
+        self.values = np.zeros((capacity, len(self.columns)), dtype=dtype)
+        self.start = 0
+        self.end = 0
+        self.overwritten = 0
+
+
+    def __len__(self):
+        return self.end - self.start
+
+
+    def append(self, tick_time, values):
+        # When full the oldest row is overwritten, so memory use never grows.
+        if len(self) == self.capacity:
+            if self.grow:
+                self.resize(self.capacity * 2)
+            else:
+                self.start += 1
+                self.overwritten += 1
+        slot = self.end % self.capacity
+        self.times[slot] = tick_time
+        self.values[slot] = values
+        self.end += 1
+
+
+    def append_many(self, times, values):
+        count = len(times)
+        if count == 0:
+            return
+        values = np.asarray(values).reshape(count, len(self.columns))
+        if self.grow and len(self) + count > self.capacity:
+            capacity = self.capacity
+            while len(self) + count > capacity:
+                capacity *= 2
+            self.resize(capacity)
+        if count > self.capacity:
+            # Only the newest rows fit; the rest are counted as overwritten below.
+            self.end += count - self.capacity
+            times = times[-self.capacity:]
+            values = values[-self.capacity:]
+            count = self.capacity
+        slots = np.arange(self.end, self.end + count) % self.capacity
+        self.times[slots] = times
+        self.values[slots] = values
+        self.end += count
+        if len(self) > self.capacity:
+            self.overwritten += len(self) - self.capacity
+            self.start = self.end - self.capacity
+
+
+    def _slots(self, first, last):
+        first = max(first, self.start)
+        last = min(last, self.end)
+        if last <= first:
+            return slice(0, 0), slice(0, 0)
+        first_slot = first % self.capacity
+        last_slot = first_slot + (last - first)
+        if last_slot <= self.capacity:
+            return slice(first_slot, last_slot), slice(0, 0)
+        return slice(first_slot, self.capacity), slice(0, last_slot - self.capacity)
+
+
+    def get_times(self, first=None, last=None):
+        head, tail = self._slots(self.start if first is None else first,
+                                 self.end if last is None else last)
+        if tail.stop == 0:
+            return self.times[head]
+        return np.concatenate((self.times[head], self.times[tail]))
+
+
+    def get_values(self, column=None, first=None, last=None):
+        head, tail = self._slots(self.start if first is None else first,
+                                 self.end if last is None else last)
+        if column is None:
+            columns = slice(None)
+        else:
+            columns = self.column_index[column]
+        if tail.stop == 0:
+            return self.values[head, columns]
+        return np.concatenate((self.values[head, columns], self.values[tail, columns]))
+
+
+    def time_at(self, index):
+        return self.times[index % self.capacity]
+
+
+    def value_at(self, index, column=None):
+        if column is None:
+            return self.values[index % self.capacity]
+        return self.values[index % self.capacity, self.column_index[column]]
+
+
+    def index_before(self, cutoff_time):
+        # Absolute index of the first row with time >= cutoff_time (binary search).
+        head, tail = self._slots(self.start, self.end)
+        head_times = self.times[head]
+        position = int(np.searchsorted(head_times, cutoff_time, side='left'))
+        if position == len(head_times) and tail.stop > 0:
+            position += int(np.searchsorted(self.times[tail], cutoff_time, side='left'))
+        return self.start + position
+
+
+    def evict_before(self, cutoff_time):
+        # Drops every row older than cutoff_time and returns them as (times, values).
+        first = self.start
+        last = self.index_before(cutoff_time)
+        if last == first:
+            return None
+        evicted = (np.array(self.get_times(first, last)),
+                   np.array(self.get_values(None, first, last)))
+        self.start = last
+        return evicted
+
+
+    def resize(self, capacity):
+        # Keeps the newest rows that fit into the new capacity.
+        first = max(self.start, self.end - capacity)
+        times = np.array(self.get_times(first, self.end))
+        values = np.array(self.get_values(None, first, self.end))
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype='float64')
+        self.values = np.zeros((capacity, len(self.columns)), dtype=values.dtype)
+        self.start = self.end = first
+        self.append_many(times, values)
+
+
+    def clear(self):
+        self.start = self.end
+
+
+# Running sum/count over the rows of a Ring_Buffer that are younger than 'period_seconds'.
+#   'head' is the next row to add and 'tail' the oldest row still inside the window,
+#   so each row is added once and subtracted once: updating costs O(1) per sample,
+#   independent of the window length and of how often it is read.
+
+class Window_Average():
+
+    def __init__(self, period_seconds, column=None):
+        self.period_seconds = period_seconds
+        self.column = column
+        self.total = 0
+        self.count = 0
+        self.head = 0
+        self.tail = 0
+        # Times the window lost rows to the ring and had to start over
+        self.resets = 0
+
+
+    def reset(self, first_index):
+        self.total = 0
+        self.count = 0
+        self.head = first_index
+        self.tail = first_index
+
+
+    def update(self, ring, tick_time):
+        if self.tail < ring.start:
+            # Rows were overwritten before the window let go of them, start over.
+            self.resets += 1
+            self.reset(ring.start)
+
+        while self.head < ring.end:
+            self.total += ring.value_at(self.head, self.column).item()
+            self.count += 1
+            self.head += 1
+
+        cutoff_time = tick_time - self.period_seconds
+        while self.tail < self.head and ring.time_at(self.tail) <= cutoff_time:
+            self.total -= ring.value_at(self.tail, self.column).item()
+            self.count -= 1
+            self.tail += 1
+
+
+    def average(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
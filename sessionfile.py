@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import argparse, csv, glob, json, os, struct
+from datetime import datetime
+
+import numpy as np
+
+# Append-only binary storage for sleepdata's streams.
+#   Every channel of a night goes to its own file, named like the CSV output
+#   ('2020_01_01_raw_bpm.bsl', '2020_01_01_avg.bsl', ...).  A file is a small header
+#   followed by fixed-size little-endian records:
+#
+#     magic 'BSLP' | version (uint16) | header length (uint32) | JSON field list | padding
+#
+#   The JSON holds the channel name and the [name, dtype] list of the record, so the
+#   reader can memory-map the records as a NumPy structured array and hand out
+#   zero-copy views per column.  A record cut short by a crash is ignored on read.
+
+session_magic = b'BSLP'
+session_version = 1
+session_header_format = '<4sHI'
+session_filename_format = '{}_{}.bsl'
+
+channel_fields = {
+    'raw_bpm': [('time', '<f8'), ('bpm', '<i2')],
+    'raw_movement': [('time', '<f8'), ('movement', '<i4')],
+    'raw_gyro': [('time', '<f8'), ('gyro_raw_x', '<i2'), ('gyro_raw_y', '<i2'), ('gyro_raw_z', '<i2')],
+    # Per-minute history stored on the band, see miband.fetch_activity_history
+    'raw_activity': [('time', '<f8'), ('category', 'u1'), ('intensity', 'u1'), ('steps', 'u1'), ('heart_rate', 'u1')],
+    # Per-minute sleep stages, see actigraphy.py
+    'sleep_stage': [('time', '<f8'), ('score', '<f4'), ('stage', 'u1')],
+    # Alarms that made the band vibrate, with the percent that triggered them
+    'alarm': [('time', '<f8'), ('pct', '<i2')]
+    }
+
+# Channels whose CSV output carries a formatted datetime instead of an epoch time.
+datetime_channels = ['avg']
+
+
+def channel_dtype(channel, fields=None):
+    if fields is None:
+        fields = channel_fields[channel]
+    return np.dtype([(str(name), field_type) for name, field_type in fields])
+
+
+def avg_fields(column_names):
+    return [('time', '<f8')] + [(column_name, '<f8') for column_name in column_names]
+
+
+def make_records(channel, times, columns, fields=None):
+    dtype = channel_dtype(channel, fields)
+    records = np.zeros(len(times), dtype=dtype)
+    records['time'] = times
+    for name, column in zip(dtype.names[1:], columns):
+        records[name] = column
+    return records
+
+
+def encode_header(channel, dtype):
+    header_json = json.dumps({
+        'channel': channel,
+        'fields': [[name, dtype.fields[name][0].str] for name in dtype.names]
+        }).encode()
+    header_length = struct.calcsize(session_header_format) + len(header_json)
+    header_length += -header_length % 8
+    header = struct.pack(session_header_format, session_magic, session_version, header_length)
+    return (header + header_json).ljust(header_length, b' ')
+
+
+def read_header(filename):
+    with open(filename, 'rb') as session_file:
+        prefix = session_file.read(struct.calcsize(session_header_format))
+        magic, version, header_length = struct.unpack(session_header_format, prefix)
+        if magic != session_magic:
+            raise ValueError("Not a session file: {}".format(filename))
+        if version > session_version:
+            raise ValueError("Unsupported session file version {}: {}".format(version, filename))
+        header = json.loads(session_file.read(header_length - len(prefix)).decode())
+    header['dtype'] = channel_dtype(header['channel'], header['fields'])
+    header['header_length'] = header_length
+    return header
+
+
+class Session_Writer():
+
+    def __init__(self, output_dir='.', filename_format=session_filename_format):
+        self.output_dir = output_dir
+        self.filename_format = filename_format
+        # (datestamp, channel): file.  Channels rotate at midnight each on their own,
+        #   see datawriter.py.
+        self.open_files = {}
+
+
+    def append(self, channel, records):
+        # Records are split at midnight so each night's file only holds its own data.
+        while len(records):
+            first_time = datetime.fromtimestamp(records['time'][0])
+            datestamp = first_time.strftime("%Y_%m_%d")
+            next_midnight = datetime(first_time.year, first_time.month, first_time.day).timestamp() + 86400
+            split_index = np.searchsorted(records['time'], next_midnight, side='left')
+            self.get_file(datestamp, channel, records.dtype).write(records[:split_index].tobytes())
+            records = records[split_index:]
+
+
+    def get_file(self, datestamp, channel, dtype):
+        file_key = (datestamp, channel)
+        if file_key not in self.open_files:
+            # Records of one channel come in time order, so its files of earlier days are done.
+            for open_key in [open_key for open_key in self.open_files
+                             if open_key[1] == channel and open_key[0] < datestamp]:
+                self.open_files.pop(open_key).close()
+            filename = os.path.join(self.output_dir, self.filename_format.format(datestamp, channel))
+            if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                header = read_header(filename)
+                if header['dtype'] != dtype:
+                    raise ValueError("Record layout of {} does not match {}".format(channel, filename))
+                trim_partial_record(filename, header)
+                self.open_files[file_key] = open(filename, 'ab')
+            else:
+                self.open_files[file_key] = open(filename, 'wb')
+                self.open_files[file_key].write(encode_header(channel, dtype))
+        return self.open_files[file_key]
+
+
+    def flush(self, fsync=False):
+        for session_file in self.open_files.values():
+            session_file.flush()
+            if fsync:
+                os.fsync(session_file.fileno())
+
+
+    def close(self):
+        for session_file in self.open_files.values():
+            session_file.close()
+        self.open_files = {}
+
+
+def trim_partial_record(filename, header):
+    record_bytes = os.path.getsize(filename) - header['header_length']
+    partial_bytes = record_bytes % header['dtype'].itemsize
+    if partial_bytes:
+        with open(filename, 'r+b') as session_file:
+            session_file.truncate(os.path.getsize(filename) - partial_bytes)
+
+
+def read_channel(filename):
+    # Returns the channel name and its records memory-mapped read-only; indexing
+    #   the result by field name ('time', 'bpm', ...) gives zero-copy column views.
+    header = read_header(filename)
+    dtype = header['dtype']
+    record_count = (os.path.getsize(filename) - header['header_length']) // dtype.itemsize
+    if record_count == 0:
+        return header['channel'], np.zeros(0, dtype=dtype)
+    records = np.memmap(filename, dtype=dtype, mode='r',
+                        offset=header['header_length'], shape=(record_count,))
+    return header['channel'], records
+
+
+class Session_Reader():
+
+    def __init__(self, datestamp, session_dir='.', filename_format=session_filename_format):
+        self.datestamp = datestamp
+        self.channels = {}
+        pattern = os.path.join(session_dir, filename_format.format(datestamp, '*'))
+        for filename in sorted(glob.glob(pattern)):
+            channel, records = read_channel(filename)
+            self.channels[channel] = records
+
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+
+    def __contains__(self, channel):
+        return channel in self.channels
+
+
+def export_csv(filename, csv_filename=None):
+    channel, records = read_channel(filename)
+    if csv_filename is None:
+        csv_filename = os.path.splitext(filename)[0] + '.csv'
+    with open(csv_filename, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(records.dtype.names)
+        columns = [records[name].tolist() for name in records.dtype.names]
+        if channel in datetime_channels:
+            columns[0] = [datetime.fromtimestamp(row_time) for row_time in columns[0]]
+        for row in zip(*columns):
+            csv_writer.writerow([csv_value(value) for value in row])
+    return csv_filename
+
+
+def csv_value(value):
+    # Matches the live CSV output, which writes averages as int or 'nan'.
+    if isinstance(value, float):
+        if value != value:
+            return 'nan'
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or convert blesleep binary session files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    info_parser = subparsers.add_parser('info', help='show channel, layout and record count')
+    info_parser.add_argument('files', nargs='+')
+    export_parser = subparsers.add_parser('export', help='convert session files to CSV')
+    export_parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        if args.command == 'info':
+            channel, records = read_channel(filename)
+            print("{}: channel {}, {} records, fields {}".format(
+                filename, channel, len(records), ', '.join(records.dtype.names)))
+        elif args.command == 'export':
+            print("{} -> {}".format(filename, export_csv(filename)))
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+import argparse, contextlib, logging, os, random, struct, threading, time
+from collections import deque
+from queue import Queue
+
+from Crypto.Cipher import AES
+
+import clock
+from miband import miband, Delegate
+from constants import UUIDS, BYTEPATTERNS
+
+# A Mi Band that only exists in software, for running the whole stack without Bluetooth.
+#   Simulated_Band is a drop-in replacement for miband: it skips the bluepy connection
+#   and GATT discovery, answers the auth handshake, and once heart measurement and the
+#   gyro are started it emits HR, raw gyro (20 byte), averaged gyro (8 byte) and raw
+#   PPG (16 byte) packets through the real Delegate at 'rates' (packets per second),
+#   multiplied by 'speed'.  Every write is logged; alert writes also go to 'alert_log'
+#   as (time, data) so vibration timing can be checked.
+
+default_rates = {
+    'heart': 1.0,
+    'raw_gyro': 8.0,
+    'avg_gyro': 1.0,
+    'raw_heart': 4.0
+    }
+
+# Continuous heart measurement stops if no keepalive arrives within this many seconds.
+heart_keepalive_timeout = 15
+
+simulated_handles = {
+    'auth': 0x0051,
+    'alert': 0x0060,
+    'heart_ctrl': 0x0029,
+    'heart_measure': 0x0026,
+    'fetch': 0x0070,
+    'activity': 0x0073,
+    'hz': 0x0041,
+    'sensor': 0x003e,
+    'steps': 0x0035,
+    'raw_sensor': 0x0038
+    }
+
+
+class Simulated_Characteristic():
+
+    def __init__(self, band, uuid, handle):
+        self.band = band
+        self.uuid = uuid
+        self.handle = handle
+
+
+    def getHandle(self):
+        return self.handle
+
+
+    def write(self, data, withResponse=False):
+        self.band.handle_write(self.handle, data)
+
+
+class Simulated_Band(miband):
+
+    def __init__(self, mac_address='00:00:00:00:00:00', key=None, timeout=0.5, debug=False, iface=None,
+                 speed=1.0, rates=None, resting_heartrate=60, spike_probability=0.005):
+        FORMAT = '%(asctime)-15s %(name)s (%(levelname)s) > %(message)s'
+        logging.basicConfig(format=FORMAT)
+        log_level = logging.WARNING if not debug else logging.DEBUG
+        self._log = logging.getLogger(self.__class__.__name__)
+        self._log.setLevel(log_level)
+
+        self.timeout = timeout
+        self.mac_address = mac_address
+        self.state = None
+        # Any key works against the simulator, as long as both sides use the same one.
+        self.auth_key = key or os.urandom(16)
+        self._init_queues()
+        self.write_queue = Queue()
+        self.vibration_programs = deque()
+        self.gyro_started_flag = False
+        self.notification_recorder = None
+        self.activity_notif_enabled = False
+        self.activity_fetch = None
+
+        self.speed = speed
+        self.rates = dict(default_rates)
+        if rates:
+            self.rates.update(rates)
+        self.resting_heartrate = resting_heartrate
+        self.spike_probability = spike_probability
+
+        self.write_log = []
+        self.alert_log = []
+        self.sent_counts = {stream: 0 for stream in self.rates}
+        self.pending_notifications = deque()
+        self.random_number = None
+        self.heart_started = False
+        self.gyro_started = False
+        self.last_keepalive_time = 0
+        self.next_due = {}
+        self.heartrate = float(resting_heartrate)
+        self.spike_remaining = 0
+        self.movement_level = 0
+        self.gyro_position = [0, 0, 1000]
+        self.packet_counter = 0
+        self.delegate = None
+
+        handles = simulated_handles
+        self._char_alert = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_ALERT, handles['alert'])
+        self._char_auth = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_AUTH, handles['auth'])
+        self._desc_auth = Simulated_Characteristic(self, UUIDS.NOTIFICATION_DESCRIPTOR, handles['auth'] + 1)
+        self._char_heart_ctrl = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_HEART_RATE_CONTROL, handles['heart_ctrl'])
+        self._char_heart_measure = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_HEART_RATE_MEASURE, handles['heart_measure'])
+        self._heart_measure_handle = handles['heart_measure'] + 1
+        self._char_fetch = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_FETCH, handles['fetch'])
+        self._desc_fetch = Simulated_Characteristic(self, UUIDS.NOTIFICATION_DESCRIPTOR, handles['fetch'] + 1)
+        self._char_activity = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_ACTIVITY_DATA, handles['activity'])
+        self._desc_activity = Simulated_Characteristic(self, UUIDS.NOTIFICATION_DESCRIPTOR, handles['activity'] + 1)
+        self._char_hz = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_HZ, handles['hz'])
+        self._hz_handle = handles['hz'] + 1
+        self._char_sensor = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_SENSOR, handles['sensor'])
+        self._sensor_handle = handles['sensor'] + 1
+        self._char_steps = Simulated_Characteristic(self, UUIDS.CHARACTERISTIC_STEPS, handles['steps'])
+        self._steps_handle = handles['steps'] + 1
+
+        self._auth_notif(True)
+        self.waitForNotifications(0.1)
+        self.setDelegate( Delegate(self) )
+
+
+    # bluepy Peripheral interface
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+
+    def withDelegate(self, delegate):
+        return self.setDelegate(delegate)
+
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.handle_write(handle, val)
+
+
+    def disconnect(self):
+        self.heart_started = False
+        self.gyro_started = False
+
+
+    def waitForNotifications(self, timeout):
+        # Like bluepy, returns True after delivering a single notification.
+        deadline = clock.time() + timeout
+        while True:
+            if self.pending_notifications:
+                handle, data = self.pending_notifications.popleft()
+                if self.delegate:
+                    self.delegate.handleNotification(handle, data)
+                return True
+
+            next_stream, next_time = self.next_notification()
+            if next_stream is None or next_time > deadline:
+                wait_time = deadline - clock.time()
+                if wait_time > 0:
+                    clock.sleep(wait_time)
+                return False
+
+            wait_time = next_time - clock.time()
+            if wait_time > 0:
+                clock.sleep(wait_time)
+            self.next_due[next_stream] = next_time + 1 / (self.rates[next_stream] * self.speed)
+            self.emit(next_stream)
+
+
+    # Simulated band behaviour
+
+    def notify(self, handle, data):
+        self.pending_notifications.append((handle, data))
+
+
+    def handle_write(self, handle, data):
+        now = clock.time()
+        self.write_log.append((now, handle, data))
+        handles = simulated_handles
+
+        if handle == handles['alert']:
+            self.alert_log.append((now, data))
+        elif handle == handles['auth']:
+            self.handle_auth_write(data)
+        elif handle == handles['heart_ctrl']:
+            if data == BYTEPATTERNS.start_heart_measure_continues:
+                self.heart_started = True
+                self.last_keepalive_time = now
+                self.next_due['heart'] = now
+            elif data in (BYTEPATTERNS.stop_heart_measure_continues, BYTEPATTERNS.stop_heart_measure_manual):
+                self.heart_started = False
+            elif data == BYTEPATTERNS.heart_measure_keepalive:
+                self.last_keepalive_time = now
+        elif handle == handles['sensor']:
+            if len(data) == 3 and data[:1] == b'\x01':
+                if not self.gyro_started:
+                    for stream in ('raw_gyro', 'avg_gyro', 'raw_heart'):
+                        self.next_due[stream] = now
+                self.gyro_started = True
+
+
+    def handle_auth_write(self, data):
+        if data[:2] == BYTEPATTERNS.request_random_number:
+            self.random_number = os.urandom(16)
+            self.notify(simulated_handles['auth'], BYTEPATTERNS.fetch_continue + self.random_number)
+        elif data[:2] == BYTEPATTERNS.auth_key_prefix:
+            encrypted = data[2:18]
+            authorized = (self.random_number is not None and
+                          encrypted == AES.new(self.auth_key, AES.MODE_ECB).encrypt(self.random_number))
+            if authorized:
+                self.notify(simulated_handles['auth'], BYTEPATTERNS.auth_ok)
+            else:
+                self.notify(simulated_handles['auth'], b'\x10\x03\x04')
+
+
+    def next_notification(self):
+        if self.heart_started and clock.time() - self.last_keepalive_time > heart_keepalive_timeout:
+            self._log.info("No keepalive received, stopping heart measurement")
+            self.heart_started = False
+
+        next_stream = None
+        next_time = None
+        for stream, due_time in self.next_due.items():
+            if stream == 'heart' and not self.heart_started:
+                continue
+            if stream != 'heart' and not self.gyro_started:
+                continue
+            if next_time is None or due_time < next_time:
+                next_stream = stream
+                next_time = due_time
+        return next_stream, next_time
+
+
+    def emit(self, stream):
+        self.sent_counts[stream] += 1
+        self.packet_counter = (self.packet_counter + 1) % 256
+        if stream == 'heart':
+            self.notify(self._char_heart_measure.getHandle(), self.heartrate_packet())
+        elif stream == 'raw_gyro':
+            self.notify(self._char_hz.getHandle(), self.raw_gyro_packet())
+        elif stream == 'avg_gyro':
+            self.notify(self._char_hz.getHandle(), self.avg_gyro_packet())
+        elif stream == 'raw_heart':
+            self.notify(simulated_handles['raw_sensor'], self.raw_heart_packet())
+
+
+    def heartrate_packet(self):
+        # Random walk around the resting rate with occasional spikes of 20-40%.
+        if self.spike_remaining == 0 and random.random() < self.spike_probability:
+            self.spike_remaining = random.randint(10, 40)
+        if self.spike_remaining:
+            self.spike_remaining -= 1
+            target = self.resting_heartrate * 1.3
+        else:
+            target = self.resting_heartrate
+        self.heartrate += (target - self.heartrate) * 0.2 + random.gauss(0, 1)
+        bpm = max(30, min(127, int(self.heartrate)))
+        return struct.pack('bb', 0, bpm)
+
+
+    def raw_gyro_packet(self):
+        # Mostly still, with bursts of movement such as turning over in bed.
+        if self.movement_level == 0 and random.random() < 0.01:
+            self.movement_level = random.randint(20, 80)
+        elif self.movement_level:
+            self.movement_level -= 1
+        samples = []
+        for _ in range(3):
+            for axis in range(3):
+                jitter = random.randint(-300, 300) if self.movement_level else random.randint(-3, 3)
+                self.gyro_position[axis] = max(-4000, min(4000, self.gyro_position[axis] + jitter))
+                samples.append(self.gyro_position[axis])
+        return struct.pack('<BB9h', 1, self.packet_counter, *samples)
+
+
+    def avg_gyro_packet(self):
+        return struct.pack('<Bb3h', 3, self.packet_counter % 128, *self.gyro_position)
+
+
+    def raw_heart_packet(self):
+        return struct.pack('<BB7H', 2, self.packet_counter,
+                           *[30000 + random.randint(-500, 500) for _ in range(7)])
+
+
+if __name__ == "__main__":
+    import sleepdata
+    import bluesleep
+    import latency
+    from vibrate import Vibrate
+
+    parser = argparse.ArgumentParser(description='Load test the blesleep pipeline against a simulated band')
+    parser.add_argument('--seconds', type=float, default=30, help='wall clock duration of the test')
+    parser.add_argument('--speed', type=float, default=10, help='packet rate multiplier')
+    parser.add_argument('--output', help='directory for CSV output (default: none)')
+    parser.add_argument('--asyncio', action='store_true', help='run through bandio on an event loop instead of threads')
+    args = parser.parse_args()
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        sleepdata.data_writer_settings['output_dir'] = args.output
+    else:
+        sleepdata.output_formats = []
+
+    latency.enabled = True
+    band = Simulated_Band(speed=args.speed, spike_probability=0.02)
+    band.initialize()
+    bluesleep.band = band
+    bluesleep.vibration = Vibrate(band)
+
+    callback_count = [0]
+    def counting_callback(data):
+        callback_count[0] += 1
+        bluesleep.sleep_monitor_callback(data)
+
+    vibration_settings = dict(bluesleep.vibration_settings, interval_minutes=0.25, duration_seconds=2)
+    if args.asyncio:
+        import asyncio, bandio
+        bluesleep.vibration.configure_heartrate_alarm(vibration_settings)
+        monitor = bandio.run_monitor(bandio.Simulated_Transport(band), counting_callback,
+                                     bluesleep.vibration, vibration_settings)
+        threading.Thread(target=asyncio.run, args=(monitor,), daemon=True).start()
+    else:
+        threading.Thread(target=band.start_heart_and_gyro, args=(1, counting_callback), daemon=True).start()
+        threading.Thread(target=bluesleep.vibration.heartrate_alarm, args=(vibration_settings,), daemon=True).start()
+
+    start_cpu = time.process_time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        time.sleep(args.seconds)
+    cpu_seconds = time.process_time() - start_cpu
+
+    print("Ran {:.0f} seconds at {}x".format(args.seconds, args.speed))
+    for stream, count in band.sent_counts.items():
+        print("  {}: {} packets ({:.1f}/s)".format(stream, count, count / args.seconds))
+    print("Callbacks: {} ({:.1f}/s)".format(callback_count[0], callback_count[0] / args.seconds))
+    print("Alert writes: {}".format(len(band.alert_log)))
+    print("CPU: {:.2f} seconds ({:.0f}% of one core)".format(cpu_seconds, 100 * cpu_seconds / args.seconds))
+    print(latency.dump())
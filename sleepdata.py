@@ -1,45 +1,56 @@
 from datetime import datetime
-from os import path
-import csv, time
+import atexit, copy, os, threading
 
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+import numpy as np
+
+from ringbuffer import Ring_Buffer, Window_Average
+from datawriter import Data_Writer
+import sessionfile
+import actigraphy
+import detectors
+import metrics
+import clock
+import latency
+from constants import SLEEP_STAGES
 
 
 sleep_data = { 
                 'heartrate': {
                     'value_name': 'bpm',
                     'periods': [2, 5, 10, 15], 
-                    'raw_data': [],
-                    'averaged_data': [],
-                    'last_hr': []
+                    'raw_dtype': 'int16',
+                    'raw_capacity': 512,
+                    'raw_data': None,
+                    'averaged_data': None,
+                    'windows': None
                     },
                 'movement':{
                     'value_name': 'movement',
                     'periods': [10, 30, 60],
-                    'raw_data': [],
-                    'averaged_data': []
+                    'raw_dtype': 'int32',
+                    'raw_capacity': 4096,
+                    'raw_data': None,
+                    'averaged_data': None,
+                    'windows': None
                     }
                 } 
             
 
 tick_seconds = 0.5
-last_tick_time = None
+# One hour of averaged ticks; init_graph grows this if the graph shows more.
+averaged_capacity = 7200
 
-datestamp = datetime.now().strftime("%Y_%m_%d")
 csv_header_name_format = '{}_{}'
 csv_filename_format = '{}_{}.csv'
-
-plt.style.use('dark_background')
-graph_figure = plt.figure()
-graph_figure.canvas.set_window_title('blesleep')
-
-graph_axes = graph_figure.add_subplot(1, 1, 1)
-graph_data = {}
-
-graph_displaytime_minutes = None
-
-last_heartrate = 0
+data_writer_settings = {
+    'output_dir': '.',
+    'batch_rows': 200,
+    'flush_seconds': 5,
+    'fsync_seconds': 60
+    }
+data_writer = None
+# 'csv' and/or 'binary' (append-only session files, see sessionfile.py)
+output_formats = ['csv']
 
 class Average_Gyro_Data():
     gyro_last_x = 0
@@ -61,224 +72,284 @@ class Average_Gyro_Data():
             gyro_movement += gyro_delta_sum
         return gyro_movement
 
-
-def write_csv(data, name):
-    fieldnames = ['time']
-    for fieldname in data[0]:
-        if fieldname != 'time':
-            fieldnames.append(fieldname)
-            if name == 'raw':
-                name = '{}_{}'.format(name, fieldname)
-
-    csv_filename = csv_filename_format.format(datestamp, name)
-
-    if not path.exists(csv_filename):
-        open_handle = 'w'
-    else:
-        open_handle = 'a'
-
-    with open(csv_filename, open_handle, newline='') as csvfile:
-        csv_writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        if open_handle == 'w':
-            csv_writer.writeheader() 
-        if type(data) is list:
-            for row in data:
-                csv_writer.writerow(row)
+    # Same summary for a batch of (N, 3) x/y/z samples, three per packet.
+    #   Returns the movement of each packet.
+    def process_batch(self, gyro_xyz):
+        gyro_last = np.array([[self.gyro_last_x, self.gyro_last_y, self.gyro_last_z]], dtype='int32')
+        gyro_samples = np.concatenate((gyro_last, gyro_xyz.astype('int32')))
+        gyro_deltas = np.abs(np.diff(gyro_samples, axis=0)).sum(axis=1)
+        self.gyro_last_x, self.gyro_last_y, self.gyro_last_z = gyro_samples[-1].tolist()
+        return gyro_deltas.reshape(-1, 3).sum(axis=1)
+
+
+def start_data_writer():
+    global data_writer
+    if data_writer is None:
+        data_writer = Data_Writer(filename_format=csv_filename_format, **data_writer_settings)
+        data_writer.start()
+        atexit.register(data_writer.close)
+        metrics.register_gauge('data_writer_queue_depth', data_writer.queue.qsize)
+    return data_writer
+
+
+class Sleep_Session():
+    # Buffers, averaging, heartrate history and output for one band.
+    #   The default session (below) works on the module-level sleep_data and writer, so
+    #   single band code can keep using the module functions.  Named sessions (see
+    #   multiband.py) get their own copy of sleep_data and write to a subdirectory of
+    #   data_writer_settings['output_dir'] named after the session.
+
+    def __init__(self, name=None, session_data=None):
+        self.name = name
+        if session_data is None:
+            session_data = {}
+            for data_type, settings in sleep_data.items():
+                session_data[data_type] = {key: copy.deepcopy(value) for key, value in settings.items()
+                                           if key not in ('raw_data', 'averaged_data', 'windows')}
+        self.sleep_data = session_data
+        self.data_writer = None
+        self.last_tick_time = None
+        self.last_heartrate = 0
+        self.average_gyro_data = Average_Gyro_Data()
+        self.sleep_stager = actigraphy.Sleep_Stager(self.write_sleep_stage)
+        # Alarm detectors, see detectors.py; bluesleep configures them from vibration_settings
+        self.detector_bank = detectors.Detector_Bank([detectors.Heartrate_Increase_Detector()])
+        # Tick and output counts, see metrics.py
+        session_labels = {} if name is None else {'session': name}
+        self.metric_counts = metrics.counts(**session_labels)
+        # Output is also written from the alarm thread (write_alarm)
+        self.metric_lock = threading.Lock()
+        metrics.register_gauge('alarm_level', lambda: self.detector_bank.alarm_level, **session_labels)
+        for data_type in self.sleep_data:
+            for ring_name in ('raw_data', 'averaged_data'):
+                ring_labels = dict(session_labels, series=data_type, ring=ring_name)
+                metrics.register_gauge('ring_overwritten_rows_total',
+                                       lambda data_type=data_type, ring_name=ring_name:
+                                           self.sleep_data[data_type][ring_name].overwritten, **ring_labels)
+                metrics.register_gauge('ring_capacity',
+                                       lambda data_type=data_type, ring_name=ring_name:
+                                           self.sleep_data[data_type][ring_name].capacity, **ring_labels)
+        self.init_sleep_data()
+
+
+    def get_data_writer(self):
+        if self.name is None:
+            return start_data_writer()
+        if self.data_writer is None:
+            output_dir = os.path.join(data_writer_settings['output_dir'], self.name)
+            os.makedirs(output_dir, exist_ok=True)
+            self.data_writer = Data_Writer(filename_format=csv_filename_format,
+                                           **dict(data_writer_settings, output_dir=output_dir))
+            self.data_writer.start()
+            atexit.register(self.data_writer.close)
+            metrics.register_gauge('data_writer_queue_depth', self.data_writer.queue.qsize, session=self.name)
+        return self.data_writer
+
+
+    def write_csv(self, data, name):
+        fieldnames = ['time']
+        for fieldname in data[0]:
+            if fieldname != 'time':
+                fieldnames.append(fieldname)
+                if name == 'raw':
+                    name = '{}_{}'.format(name, fieldname)
+
+        if type(data) is not list:
+            data = [data]
+        with self.metric_lock:
+            self.metric_counts['csv_writes_total'] += 1
+            self.metric_counts['csv_rows_total'] += len(data)
+        self.get_data_writer().write(name, data, fieldnames)
+
+
+    def write_session(self, channel, times, columns, fields=None):
+        records = sessionfile.make_records(channel, times, columns, fields)
+        with self.metric_lock:
+            self.metric_counts['session_records_total'] += len(records)
+        self.get_data_writer().write_records(channel, records)
+
+
+    def write_activity(self, times, records):
+        # Per-minute history downloaded from the band (see miband.fetch_activity_history).
+        activity_fields = records.dtype.names
+        if 'csv' in output_formats:
+            self.write_csv([dict(zip(('time',) + activity_fields, (float(record_time),) + tuple(int(value) for value in record)))
+                            for record_time, record in zip(times, records.tolist())], 'activity')
+        if 'binary' in output_formats:
+            self.write_session('raw_activity', times, [records[field] for field in activity_fields])
+
+
+    def write_sleep_stage(self, epoch_time, score, stage):
+        if self.name is None:
+            print("Sleep stage: {}".format(SLEEP_STAGES.NAMES[stage]))
         else:
-            csv_writer.writerow(data)
-
-
-def flush_old_raw_data(tick_time):
-    for data_type in sleep_data:
-        s_data = sleep_data[data_type]
-        periods = s_data['periods']
-
-        cleaned_raw_data = []
-        old_raw_data = []
-        
-        for raw_datum in s_data['raw_data']:
-            datum_age = tick_time - raw_datum['time']
-            if datum_age < max(periods):
-                cleaned_raw_data.append(raw_datum)
-            else:
-                old_raw_data.append(raw_datum)
-
-        s_data['raw_data'] = cleaned_raw_data
-        if old_raw_data:
-            write_csv(old_raw_data, 'raw')
-
-
-def flush_old_graph_data(graph_displaytime_minutes):
-    graph_displaytime_seconds = graph_displaytime_minutes * 60
-    tick_time = time.time()
-    for data_type in sleep_data:
-        s_data = sleep_data[data_type]
-        cleaned_graph_data = []
-        old_graph_data = []
-        for avg_datum in s_data['averaged_data']:
-            datum_age = tick_time - datetime.timestamp(avg_datum['time'])
-            if datum_age < graph_displaytime_seconds:
-                cleaned_graph_data.append(avg_datum)
-            else:
-                old_graph_data.append(avg_datum)
-        s_data['averaged_data'] = cleaned_graph_data
-
-
-def average_raw_data(tick_time):
-    global last_heartrate
-    timestamp = datetime.fromtimestamp(tick_time)
-    csv_out = {'time': timestamp }
-
-    for data_type in sleep_data:
-        s_data = sleep_data[data_type]
-        period_averages_dict = {'time': timestamp}
-        periods = s_data['periods']
-        value_name = s_data['value_name']
-
-        flush_old_raw_data(tick_time)
-
-        for period_seconds in periods:
-            period_data = []
-            period_averages_dict[period_seconds] = 0
-            for raw_datum in s_data['raw_data']:
-                datum_age_seconds = tick_time - raw_datum['time']
-                if datum_age_seconds < period_seconds:
-                    period_data.append(raw_datum[value_name])
-                    
-            if len(period_data) > 0:
-                period_data_average = sum(period_data) / len(period_data)
-            else:
-                if data_type == "heartrate" and period_seconds == min(periods):
-                    period_data_average = last_heartrate
-                else:
-                    period_data_average = 0
-
-            period_averages_dict[period_seconds] = zero_to_nan(period_data_average)
-
-            csv_header_field_name = csv_header_name_format.format(data_type, period_seconds)
-            csv_out[csv_header_field_name] = zero_to_nan(period_data_average)
-
-        s_data['averaged_data'].append(period_averages_dict)
-    write_csv([csv_out], 'avg')
+            print("{} sleep stage: {}".format(self.name, SLEEP_STAGES.NAMES[stage]))
+        if 'csv' in output_formats:
+            self.write_csv([{'time': epoch_time, 'score': score, 'stage': SLEEP_STAGES.NAMES[stage]}], 'stage')
+        if 'binary' in output_formats:
+            self.write_session('sleep_stage', [epoch_time], [[score], [stage]])
+
+
+    def write_alarm(self, alarm_time, alarm_pct):
+        if 'csv' in output_formats:
+            self.write_csv([{'time': alarm_time, 'pct': alarm_pct}], 'alarm')
+        if 'binary' in output_formats:
+            self.write_session('alarm', [alarm_time], [[alarm_pct]])
+
+
+    def init_sleep_data(self):
+        for data_type in self.sleep_data:
+            s_data = self.sleep_data[data_type]
+            # Raw rows are only dropped once written out, so a faster stream grows the ring.
+            s_data['raw_data'] = Ring_Buffer(s_data['raw_capacity'],
+                                             [s_data['value_name']],
+                                             dtype=s_data['raw_dtype'], grow=True)
+            s_data['averaged_data'] = Ring_Buffer(averaged_capacity, s_data['periods'])
+            s_data['windows'] = [Window_Average(period_seconds, s_data['value_name'])
+                                 for period_seconds in s_data['periods']]
+
+
+    def flush_old_raw_data(self, tick_time):
+        for data_type in self.sleep_data:
+            s_data = self.sleep_data[data_type]
+            periods = s_data['periods']
+            value_name = s_data['value_name']
+
+            old_raw_data = s_data['raw_data'].evict_before(tick_time - max(periods))
+            if old_raw_data:
+                old_times, old_values = old_raw_data
+                if 'csv' in output_formats:
+                    self.write_csv([{'time': float(datum_time), value_name: int(datum_value)}
+                                    for datum_time, datum_value in zip(old_times, old_values[:, 0])], 'raw')
+                if 'binary' in output_formats:
+                    self.write_session('raw_' + value_name, old_times, [old_values[:, 0]])
+
+
+    def average_data(self, tick_time):
+        # Averages once every tick_seconds, however often data arrives.
+        if not self.last_tick_time:
+            self.last_tick_time = clock.time()
+        if (tick_time - self.last_tick_time) >= tick_seconds:
+            self.average_raw_data(tick_time)
+            self.last_tick_time = clock.time()
+
+
+    def average_raw_data(self, tick_time):
+        self.metric_counts['ticks_total'] += 1
+        timestamp = datetime.fromtimestamp(tick_time)
+        csv_out = {'time': timestamp }
+
+        self.sleep_stager.update(tick_time)
+
+        for data_type in self.sleep_data:
+            s_data = self.sleep_data[data_type]
+            periods = s_data['periods']
+            period_averages = []
+
+            for window in s_data['windows']:
+                period_seconds = window.period_seconds
+                window.update(s_data['raw_data'], tick_time)
+                period_data_average = window.average()
+
+                if period_data_average is None:
+                    if data_type == "heartrate" and period_seconds == min(periods):
+                        period_data_average = self.last_heartrate
+                    else:
+                        period_data_average = 0
+
+                period_averages.append(zero_to_nan(period_data_average))
+
+                csv_header_field_name = csv_header_name_format.format(data_type, period_seconds)
+                csv_out[csv_header_field_name] = zero_to_nan(period_data_average)
+
+            s_data['averaged_data'].append(tick_time, period_averages)
+        # Only after the windows let go of them, or they would have to start over.
+        self.flush_old_raw_data(tick_time)
+        self.detector_bank.update('tick', csv_out)
+        latency.mark('averaging')
+        if 'csv' in output_formats:
+            self.write_csv([csv_out], 'avg')
+        if 'binary' in output_formats:
+            avg_columns = list(csv_out)[1:]
+            self.write_session('avg', [tick_time], [[csv_out[column]] for column in avg_columns],
+                               fields=sessionfile.avg_fields(avg_columns))
+
+
+    def process_gyro_data(self, gyro_data, tick_time):
+        gyro_movement = self.average_gyro_data.process(gyro_data)
+        self.sleep_stager.add_movement(tick_time, gyro_movement)
+        self.detector_bank.update('movement', gyro_movement)
+        latency.mark('detector')
+        if 'binary' in output_formats:
+            self.write_session('raw_gyro', [tick_time] * len(gyro_data),
+                               [[gyro_datum[axis] for gyro_datum in gyro_data]
+                                for axis in ('gyro_raw_x', 'gyro_raw_y', 'gyro_raw_z')])
+        #print("Gyro: {}".format(gyro_movement))
+        self.sleep_data['movement']['raw_data'].append(tick_time, gyro_movement)
+
+
+    def process_gyro_batch(self, gyro_xyz, tick_time):
+        gyro_movements = self.average_gyro_data.process_batch(gyro_xyz)
+        self.sleep_stager.add_movement(tick_time, int(gyro_movements.sum()))
+        self.detector_bank.update_many('movement', gyro_movements)
+        latency.mark('detector')
+        if 'binary' in output_formats:
+            self.write_session('raw_gyro', np.full(len(gyro_xyz), tick_time),
+                               [gyro_xyz[:, 0], gyro_xyz[:, 1], gyro_xyz[:, 2]])
+        self.sleep_data['movement']['raw_data'].append_many(np.full(len(gyro_movements), tick_time), gyro_movements)
+
+
+    def process_heartrate_data(self, heartrate_data, tick_time):
+        if self.name is None:
+            print("BPM: " + str(heartrate_data))
+        else:
+            print("{} BPM: {}".format(self.name, heartrate_data))
+        heartrate = self.sleep_data['heartrate']
+        self.sleep_stager.add_heartrate(tick_time, heartrate_data)
+        self.detector_bank.update('heartrate', heartrate_data)
+        latency.mark('detector')
+        if heartrate_data > 0:
+            heartrate['raw_data'].append(tick_time, heartrate_data)
 
 
-def process_gyro_data(gyro_data, tick_time):
-    sleep_move = sleep_data['movement']
-    value_name = sleep_move['value_name']
-    gyro_movement = average_gyro_data.process(gyro_data)
-    #print("Gyro: {}".format(gyro_movement))
-    sleep_move['raw_data'].append({
-        'time': tick_time,
-        value_name: gyro_movement
-    })
+# Module-level API, working on the default session.
 
+def init_sleep_data():
+    default_session.init_sleep_data()
 
-def process_heartrate_data(heartrate_data, tick_time):
-    last_heartrate_count = 20
-    print("BPM: " + str(heartrate_data))
-    if heartrate_data > 0:
-        value_name = sleep_data['heartrate']['value_name']
-        sleep_data['heartrate']['raw_data'].append({
-            'time': tick_time,
-            value_name: heartrate_data
-        } )
-
-        if len(sleep_data['heartrate']['last_hr']) > last_heartrate_count:
-            sleep_data['heartrate']['last_hr'].pop(0)
-        sleep_data['heartrate']['last_hr'].append(heartrate_data)
-
-
-def analyze_heartrate(hr_count):
-    # Finds the pct change between the lowest HR in the last $hr_count samples and the current HR
-    pct_heartrate_increase = 0
-    if len(sleep_data['heartrate']['last_hr']) >= hr_count:
-        last_heartrate_list = sleep_data['heartrate']['last_hr'][-hr_count:]
-        last_heartrate_min = min(last_heartrate_list)
-        current_heartrate = last_heartrate_list[-1]
-        pct_heartrate_increase = int((current_heartrate - last_heartrate_min)/last_heartrate_min*100)
-    return pct_heartrate_increase
-    
-
-def zero_to_nan(value):
-    if value == 0:
-        return (float('nan'))
-    return int(value)
 
+def average_data(tick_time):
+    default_session.average_data(tick_time)
 
-def update_graph_data():
-    for data_type in sleep_data:
-        s_data = sleep_data[data_type]
-        
-        avg_data = s_data['averaged_data']
 
-        if len(avg_data) > 1:
-            
-            g_data = graph_data[data_type]
-            data_periods = s_data['periods']
+def average_raw_data(tick_time):
+    default_session.average_raw_data(tick_time)
 
-            starting_index = max([(len(g_data['time']) - 1), 0])
-            ending_index = len(avg_data) - 1
 
-            sleep_data_range = avg_data[starting_index:ending_index]
+def process_gyro_data(gyro_data, tick_time):
+    default_session.process_gyro_data(gyro_data, tick_time)
 
-            for sleep_datum in sleep_data_range:
-                g_data['time'].append(sleep_datum['time'])
-                for period in data_periods:
-                    if g_data['data'][period] != 'nan':
-                        g_data['data'][period].append(sleep_datum[period])
 
+def process_gyro_batch(gyro_xyz, tick_time):
+    default_session.process_gyro_batch(gyro_xyz, tick_time)
 
-def init_graph_data():
-    for data_type in sleep_data:
-        data_periods = sleep_data[data_type]['periods']
-        graph_data[data_type] = {
-            'time': [],
-            'data': {}
-        }
-        for period in data_periods:
-            graph_data[data_type]['data'][period] = []
 
+def process_heartrate_data(heartrate_data, tick_time):
+    default_session.process_heartrate_data(heartrate_data, tick_time)
 
-def graph_animation(i):
     
-    if len(graph_data) == 0:
-        init_graph_data()
-
-    flush_old_graph_data(graph_displaytime_minutes)
-    update_graph_data()
-
-    for data_type in graph_data:
-        if len(graph_data[data_type]['time']) > 0:
-            graph_axes.clear()
-            break
-
-    plotflag = False
-    for data_type in sleep_data:
-        s_data = sleep_data[data_type]
-        g_data = graph_data[data_type]
-        if len(g_data['time']) > 0:
-            plotflag = True
-            data_periods = sleep_data[data_type]['periods']
-            for period in data_periods:
-                axis_label = "{} {} sec".format(s_data['value_name'], period)
-                graph_axes.plot(g_data['time'],
-                                g_data['data'][period],
-                                label=axis_label) 
-
-    if plotflag:
-        plt.legend()
+
+def zero_to_nan(value):
+    if value == 0:
+        return (float('nan'))
+    return int(value)
 
 
 def init_graph(graph_displaytime_mins=60, maximize=False):
-    global graph_displaytime_minutes
-    graph_displaytime_minutes = graph_displaytime_mins
-    if maximize:
-        figure_manager = plt.get_current_fig_manager()
-        figure_manager.full_screen_toggle()
-    
-    ani = animation.FuncAnimation(graph_figure, graph_animation, interval=1000)
-    plt.show()
+    # Plotting is optional; matplotlib is only imported once a graph is asked for.
+    import sleepgraph
+    sleepgraph.init_graph(graph_displaytime_mins=graph_displaytime_mins, maximize=maximize)
 
 
 if __name__ == 'sleepdata':
-    average_gyro_data = Average_Gyro_Data()
\ No newline at end of file
+    default_session = Sleep_Session(session_data=sleep_data)
\ No newline at end of file
@@ -0,0 +1,204 @@
+from datetime import datetime
+import bisect
+
+import numpy as np
+
+import matplotlib.pyplot as plt
+import matplotlib.animation as animation
+import matplotlib.dates as mdates
+
+import sleepdata
+from sleepdata import sleep_data
+from decimate import MinMax_Decimator
+import clock
+
+# Live graph of the averaged heartrate and movement data.  Only imported when a
+#   graph is shown (sleepdata.init_graph), so headless runs never load matplotlib.
+
+plt.style.use('dark_background')
+graph_figure = plt.figure()
+graph_figure.canvas.set_window_title('blesleep')
+
+graph_axes = graph_figure.add_subplot(1, 1, 1)
+graph_data = {}
+graph_lines = {}
+graph_decimators = {}
+graph_value_range = [float('inf'), float('-inf')]
+# Fraction of the display time the x axis runs ahead of the newest data
+graph_margin = 0.1
+
+graph_displaytime_minutes = None
+
+
+def flush_old_graph_data(graph_displaytime_minutes):
+    # Graph times are epoch seconds in time order, so the cutoff is found by bisection
+    #   and everything before it dropped with one slice.
+    graph_displaytime_seconds = graph_displaytime_minutes * 60
+    cutoff_time = clock.time() - graph_displaytime_seconds
+    for data_type in sleep_data:
+        sleep_data[data_type]['averaged_data'].evict_before(cutoff_time)
+        if data_type in graph_data:
+            g_data = graph_data[data_type]
+            cutoff_index = bisect.bisect_left(g_data['time'], cutoff_time)
+            if cutoff_index:
+                del g_data['time'][:cutoff_index]
+                for period in g_data['data']:
+                    del g_data['data'][period][:cutoff_index]
+
+
+def update_graph_data():
+    # Returns the values added, so the graph only rescales when they leave the current range.
+    new_values = []
+    for data_type in sleep_data:
+        s_data = sleep_data[data_type]
+        
+        avg_data = s_data['averaged_data']
+
+        if len(avg_data) > 1:
+            
+            g_data = graph_data[data_type]
+            data_periods = s_data['periods']
+
+            # next_index is the absolute ring index of the first row not yet graphed,
+            #   so eviction on either side cannot shift it.
+            starting_index = max(g_data['next_index'], avg_data.start)
+            ending_index = avg_data.end
+            g_data['next_index'] = ending_index
+
+            for datum_index in range(starting_index, ending_index):
+                g_data['time'].append(avg_data.time_at(datum_index))
+                for period in data_periods:
+                    if g_data['data'][period] != 'nan':
+                        datum_value = avg_data.value_at(datum_index, period)
+                        g_data['data'][period].append(datum_value)
+                        new_values.append(datum_value)
+                        if graph_decimators:
+                            graph_decimators[data_type][period].add(g_data['time'][-1], datum_value)
+    return new_values
+
+
+def init_graph_data():
+    for data_type in sleep_data:
+        data_periods = sleep_data[data_type]['periods']
+        graph_data[data_type] = {
+            'time': [],
+            'data': {},
+            'next_index': 0
+        }
+        for period in data_periods:
+            graph_data[data_type]['data'][period] = []
+
+
+def init_graph_lines():
+    # The line artists are created once and only get new data each frame; they are
+    #   animated, so blitting redraws just them on top of a cached background.
+    #   FuncAnimation calls this again after a resize, which must not add more lines.
+    if not graph_lines:
+        for data_type in sleep_data:
+            s_data = sleep_data[data_type]
+            graph_lines[data_type] = {}
+            for period in s_data['periods']:
+                axis_label = "{} {} sec".format(s_data['value_name'], period)
+                graph_lines[data_type][period], = graph_axes.plot([], [], label=axis_label, animated=True)
+        graph_axes.xaxis_date()
+        graph_axes.legend(loc='upper left')
+    init_graph_decimators()
+    return [line for data_type in graph_lines for line in graph_lines[data_type].values()]
+
+
+def init_graph_decimators():
+    # Lines are drawn from min/max buckets about one pixel wide, so a long window
+    #   costs no more to draw than a short one.  Rebuilt when the plot is resized.
+    bucket_width = graph_displaytime_minutes * 60 / max(graph_axes.bbox.width, 1)
+    for data_type in sleep_data:
+        graph_decimators[data_type] = {}
+        for period in sleep_data[data_type]['periods']:
+            decimator = MinMax_Decimator(bucket_width)
+            if data_type in graph_data:
+                for x, y in zip(graph_data[data_type]['time'], graph_data[data_type]['data'][period]):
+                    decimator.add(x, y)
+            graph_decimators[data_type][period] = decimator
+
+
+def epoch_to_graph_time(times):
+    # Matplotlib date numbers for local time.  The UTC offset is taken once per call,
+    #   so a whole line converts in one array operation instead of per datum.
+    if len(times) == 0:
+        return times
+    reference_time = float(times[-1])
+    offset = mdates.date2num(datetime.fromtimestamp(reference_time)) - reference_time / 86400
+    return np.asarray(times) / 86400 + offset
+
+
+def update_graph_limits(new_values):
+    # Changing the limits needs a full redraw of axes and ticks, so the x range runs
+    #   ahead of the data by graph_margin and y only changes when new values fall
+    #   outside the range seen so far.
+    now = mdates.date2num(datetime.fromtimestamp(clock.time()))
+    display_days = graph_displaytime_minutes / (24 * 60)
+    x_min, x_max = graph_axes.get_xlim()
+    rescale = False
+
+    if now > x_max:
+        x_min = now - display_days
+        x_max = now + display_days * graph_margin
+        # The window moved, so fit y to what is left rather than only growing it.
+        new_values = [value for data_type in graph_decimators
+                      for decimator in graph_decimators[data_type].values()
+                      for value in (decimator.value_range() or [])]
+        graph_value_range[:] = [float('inf'), float('-inf')]
+        rescale = True
+
+    new_values = np.array(new_values, dtype='float64')
+    new_values = new_values[~np.isnan(new_values)]
+    if len(new_values) and (new_values.min() < graph_value_range[0] or new_values.max() > graph_value_range[1]):
+        graph_value_range[:] = [min(graph_value_range[0], new_values.min()),
+                                max(graph_value_range[1], new_values.max())]
+        rescale = True
+
+    if rescale:
+        graph_axes.set_xlim(x_min, x_max)
+        y_low, y_high = graph_value_range
+        if y_low <= y_high:
+            y_headroom = max((y_high - y_low) * graph_margin, 1)
+            graph_axes.set_ylim(y_low - y_headroom, y_high + y_headroom)
+        graph_figure.canvas.draw()
+
+
+def graph_animation(i):
+    
+    if len(graph_data) == 0:
+        init_graph_data()
+
+    flush_old_graph_data(graph_displaytime_minutes)
+    new_values = update_graph_data()
+
+    display_start = clock.time() - graph_displaytime_minutes * 60
+
+    drawn_lines = []
+    for data_type in graph_lines:
+        for period, line in graph_lines[data_type].items():
+            decimator = graph_decimators[data_type][period]
+            decimator.evict_before(display_start)
+            line_times, line_values = decimator.points()
+            line.set_data(epoch_to_graph_time(line_times), line_values)
+            drawn_lines.append(line)
+
+    update_graph_limits(new_values)
+    return drawn_lines
+
+
+def init_graph(graph_displaytime_mins=60, maximize=False):
+    global graph_displaytime_minutes
+    graph_displaytime_minutes = graph_displaytime_mins
+    graph_capacity = int(graph_displaytime_mins * 60 / sleepdata.tick_seconds) + 1
+    for data_type in sleep_data:
+        if sleep_data[data_type]['averaged_data'].capacity < graph_capacity:
+            sleep_data[data_type]['averaged_data'].resize(graph_capacity)
+    if maximize:
+        figure_manager = plt.get_current_fig_manager()
+        figure_manager.full_screen_toggle()
+    
+    ani = animation.FuncAnimation(graph_figure, graph_animation, init_func=init_graph_lines,
+                                  interval=1000, blit=True)
+    plt.show()
@@ -0,0 +1,59 @@
+import asyncio, contextlib, io, unittest
+
+import bandio
+import bluesleep
+import sleepdata
+from simband import Simulated_Band
+from vibrate import Vibrate
+
+# Run with: python3 -m unittest (or python3 -m pytest)
+
+
+class Run_Monitor_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.output_formats = sleepdata.output_formats
+        sleepdata.output_formats = []
+
+
+    def tearDown(self):
+        sleepdata.output_formats = self.output_formats
+
+
+    def test_simulated_band(self):
+        # The whole asyncio core against a simulated band: at 60x, 4 seconds are
+        #   4 minutes of band time, with a heartrate spike in most readings.
+        band = Simulated_Band(speed=60, spike_probability=0.5)
+        self.assertTrue(band.initialize())
+        session = sleepdata.Sleep_Session('bandio_test')
+        vibration_settings = dict(bluesleep.vibration_settings, detectors=['heartrate'],
+                                  interval_minutes=0.25, duration_seconds=1)
+        bluesleep.configure_detectors(session, vibration_settings)
+        vibration = Vibrate(band)
+        vibration.configure_heartrate_alarm(vibration_settings)
+
+        samples = []
+        def callback(data):
+            samples.append(data[0])
+            bluesleep.handle_sample(session, vibration, data)
+
+        async def run_for(seconds):
+            try:
+                await asyncio.wait_for(bandio.run_monitor(bandio.Simulated_Transport(band), callback,
+                                                          vibration, vibration_settings), seconds)
+            except asyncio.TimeoutError:
+                pass
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(run_for(4))
+
+        self.assertIn('HR', samples)
+        self.assertIn('GYRO_RAW_BATCH', samples)
+        self.assertGreater(len(session.sleep_data['heartrate']['raw_data'].get_times()), 0)
+        self.assertGreater(session.metric_counts['ticks_total'], 0)
+        # The alarm went out as writes to the band's alert characteristic.
+        self.assertGreater(len(band.alert_log), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+import sleepdata
+
+# Run with: python3 -m unittest (or python3 -m pytest)
+
+
+class Window_Average_Test(unittest.TestCase):
+
+    def setUp(self):
+        self.output_formats = sleepdata.output_formats
+        sleepdata.output_formats = []
+
+
+    def tearDown(self):
+        sleepdata.output_formats = self.output_formats
+
+
+    def test_windows_never_reset(self):
+        # Eviction must wait for the windows, or every tick re-sums them from scratch.
+        session = sleepdata.Sleep_Session('window_test')
+        random = np.random.default_rng(1)
+        start_time = 1600000000.0
+        tick_count = 2000
+        for tick in range(tick_count):
+            tick_time = start_time + tick * sleepdata.tick_seconds
+            for packet in range(40):
+                session.sleep_data['movement']['raw_data'].append(tick_time + packet / 100, int(random.integers(0, 500)))
+            session.sleep_data['heartrate']['raw_data'].append(tick_time, int(random.integers(50, 90)))
+            session.average_raw_data(tick_time + sleepdata.tick_seconds)
+
+        for data_type, s_data in session.sleep_data.items():
+            self.assertEqual([window.resets for window in s_data['windows']], [0] * len(s_data['windows']), data_type)
+            self.assertEqual(s_data['raw_data'].overwritten, 0, data_type)
+
+        # The running sums still match a direct average of each window.
+        raw_data = session.sleep_data['movement']['raw_data']
+        last_tick = start_time + tick_count * sleepdata.tick_seconds
+        times = raw_data.get_times()
+        values = raw_data.get_values('movement')
+        for window in session.sleep_data['movement']['windows']:
+            in_window = times > last_tick - window.period_seconds
+            self.assertAlmostEqual(window.average(), values[in_window].mean())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import argparse, csv, glob, os, time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import sessionfile
+
+# Sparse time index over the CSV output, for range queries that only read the
+#   rows they need.  Next to each CSV file, <file>.idx holds one fixed size entry
+#   per block of index_block_rows rows: the block's first and last time and its
+#   byte range in the CSV.  Data_Writer appends the entries as it writes rows;
+#   index_csv() adds entries for rows written without them (older files, or the
+#   tail of a file after a crash).
+#
+#   query() picks the night files by datestamp, then reads only the index and the
+#   CSV blocks overlapping the window.  Binary session files need no index: their
+#   records are memory-mapped and the window is found by binary search on time.
+
+index_block_rows = 256
+
+index_dtype = np.dtype([('first_time', '<f8'), ('last_time', '<f8'), ('start', '<i8'), ('end', '<i8')])
+
+csv_filename_format = '{}_{}.csv'
+
+
+def index_filename(csv_filename):
+    return csv_filename + '.idx'
+
+
+def row_timestamp(row_time):
+    if isinstance(row_time, datetime):
+        return row_time.timestamp()
+    return float(row_time)
+
+
+def parse_time(text):
+    # CSV times are epoch seconds, or a datetime in the 'avg' output.
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+class Block_Indexer():
+    # Index writer for one CSV file being appended to by Data_Writer.  add_row()
+    #   is called before each row is written.
+
+    def __init__(self, csv_filename, csvfile):
+        self.csvfile = csvfile
+        self.index_file = open(index_filename(csv_filename), 'ab')
+        self.block_rows = 0
+        self.block_start = None
+        self.first_time = None
+        self.last_time = None
+
+
+    def add_row(self, row_time):
+        if self.block_rows == index_block_rows:
+            self.write_block()
+        if self.block_rows == 0:
+            self.block_start = self.csvfile.tell()
+            self.first_time = row_time
+        self.last_time = row_time
+        self.block_rows += 1
+
+
+    def write_block(self):
+        block_entry = np.array([(self.first_time, self.last_time, self.block_start, self.csvfile.tell())],
+                               dtype=index_dtype)
+        self.index_file.write(block_entry.tobytes())
+        self.block_rows = 0
+
+
+    def flush(self, fsync=False):
+        # Called after the CSV is flushed, so no entry points past the CSV's data.
+        self.index_file.flush()
+        if fsync:
+            os.fsync(self.index_file.fileno())
+
+
+    def close(self):
+        if self.block_rows:
+            self.write_block()
+        self.index_file.close()
+
+
+def read_index(csv_filename):
+    try:
+        return np.fromfile(index_filename(csv_filename), dtype=index_dtype)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=index_dtype)
+
+
+def read_header_line(csv_file):
+    csv_file.seek(0)
+    header_line = csv_file.readline()
+    return next(csv.reader([header_line.decode()])), len(header_line)
+
+
+def index_csv(csv_filename):
+    # Indexes rows after the last indexed block, a block of index_block_rows
+    #   complete lines at a time.  Returns the number of rows added.
+    block_index = read_index(csv_filename)
+    with open(csv_filename, 'rb') as csv_file:
+        _, header_length = read_header_line(csv_file)
+        indexed_end = max(int(block_index['end'].max()) if len(block_index) else 0, header_length)
+        csv_file.seek(indexed_end)
+        tail = csv_file.read()
+    lines = tail.split(b'\n')[:-1]
+    if not lines:
+        return 0
+    line_ends = indexed_end + np.cumsum([len(line) + 1 for line in lines])
+    line_times = [parse_time(line.split(b',', 1)[0].decode()) for line in lines]
+    block_entries = np.zeros((len(lines) + index_block_rows - 1) // index_block_rows, dtype=index_dtype)
+    for block_number, first_line in enumerate(range(0, len(lines), index_block_rows)):
+        last_line = min(first_line + index_block_rows, len(lines)) - 1
+        block_entries[block_number] = (line_times[first_line], line_times[last_line],
+                                       line_ends[first_line - 1] if first_line else indexed_end, line_ends[last_line])
+    with open(index_filename(csv_filename), 'ab') as index_file:
+        index_file.write(block_entries.tobytes())
+    return len(lines)
+
+
+class Range_Result():
+    # Rows of one query, and how many bytes of data and index were read for them.
+
+    def __init__(self):
+        self.times = []
+        self.columns = {}
+        self.bytes_read = 0
+
+
+    def add(self, times, columns):
+        self.times.append(np.asarray(times, dtype='float64'))
+        for name, values in columns.items():
+            self.columns.setdefault(name, []).append(np.asarray(values))
+
+
+    def finish(self):
+        self.times = np.concatenate(self.times) if self.times else np.zeros(0)
+        self.columns = {name: np.concatenate(values) for name, values in self.columns.items()}
+        return self
+
+
+def csv_column(values):
+    try:
+        return np.array(values, dtype='float64')
+    except ValueError:
+        return np.array(values)
+
+
+def read_csv_range(csv_filename, start_time, end_time, result):
+    block_index = read_index(csv_filename)
+    result.bytes_read += block_index.nbytes
+    with open(csv_filename, 'rb') as csv_file:
+        fieldnames, header_length = read_header_line(csv_file)
+        result.bytes_read += header_length
+        file_size = os.fstat(csv_file.fileno()).st_size
+        # Byte ranges of the overlapping blocks, plus anything not indexed yet.
+        overlapping = block_index[(block_index['last_time'] >= start_time) & (block_index['first_time'] <= end_time)]
+        byte_ranges = [(int(block['start']), min(int(block['end']), file_size)) for block in overlapping]
+        indexed_end = max(int(block_index['end'].max()) if len(block_index) else 0, header_length)
+        if indexed_end < file_size:
+            byte_ranges.append((indexed_end, file_size))
+
+        lines = []
+        for range_start, range_end in byte_ranges:
+            csv_file.seek(range_start)
+            data = csv_file.read(range_end - range_start)
+            result.bytes_read += len(data)
+            lines.extend(data.decode().splitlines())
+    rows = [row for row in csv.reader(lines) if len(row) == len(fieldnames)]
+    if not rows:
+        return
+    times = np.array([parse_time(row[0]) for row in rows])
+    in_range = (times >= start_time) & (times <= end_time)
+    columns = {name: csv_column([row[column] for row in rows])[in_range]
+               for column, name in enumerate(fieldnames) if column > 0}
+    result.add(times[in_range], columns)
+
+
+def read_binary_range(session_filename, start_time, end_time, result):
+    _, records = sessionfile.read_channel(session_filename)
+    record_times = records['time']
+    first = np.searchsorted(record_times, start_time, side='left')
+    last = np.searchsorted(record_times, end_time, side='right')
+    # The header and the records in the window; the few records the binary search
+    #   probes on the way are not counted.
+    result.bytes_read += getattr(records, 'offset', 0) + (last - first) * records.dtype.itemsize
+    selected = records[first:last]
+    result.add(selected['time'], {name: np.array(selected[name]) for name in records.dtype.names[1:]})
+
+
+def datestamps_between(start_time, end_time):
+    day = datetime.fromtimestamp(start_time).date()
+    last_day = datetime.fromtimestamp(end_time).date()
+    while day <= last_day:
+        yield day.strftime("%Y_%m_%d")
+        day += timedelta(days=1)
+
+
+def query(name, start_time, end_time, data_dir='.', result=None):
+    # Rows of the output named name ('raw_bpm', 'avg', ...) with times within
+    #   [start_time, end_time], from binary session files where they exist and
+    #   CSV otherwise.  Returns a Range_Result.
+    if result is None:
+        result = Range_Result()
+    for datestamp in datestamps_between(start_time, end_time):
+        session_filename = os.path.join(data_dir, sessionfile.session_filename_format.format(datestamp, name))
+        csv_filename = os.path.join(data_dir, csv_filename_format.format(datestamp, name))
+        if os.path.exists(session_filename):
+            read_binary_range(session_filename, start_time, end_time, result)
+        elif os.path.exists(csv_filename):
+            read_csv_range(csv_filename, start_time, end_time, result)
+    return result
+
+
+def query_nights(name, start_clock, end_clock, nights, data_dir='.', last_night=None):
+    # The same clock time window ('02:00' to '04:00') on each of the last nights
+    #   nights up to last_night (a date, default today).  A window past midnight
+    #   ends the next day.  Returns [(night date, Range_Result), ...].
+    if last_night is None:
+        last_night = datetime.now().date()
+    start_hour, start_minute = (int(part) for part in start_clock.split(':'))
+    end_hour, end_minute = (int(part) for part in end_clock.split(':'))
+    night_results = []
+    for night_number in range(nights - 1, -1, -1):
+        night = last_night - timedelta(days=night_number)
+        window_start = datetime(night.year, night.month, night.day, start_hour, start_minute)
+        window_end = datetime(night.year, night.month, night.day, end_hour, end_minute)
+        if window_end <= window_start:
+            window_end += timedelta(days=1)
+        night_results.append((night, query(name, window_start.timestamp(), window_end.timestamp(), data_dir).finish()))
+    return night_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index recorded CSV output and query it by time range')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index CSV files written without an index')
+    build_parser.add_argument('data_dir', nargs='?', default='.')
+    query_parser = subparsers.add_parser('query', help='one clock time window over the last nights')
+    query_parser.add_argument('name', help="output name, e.g. raw_bpm, raw_movement or avg")
+    query_parser.add_argument('start', help='HH:MM')
+    query_parser.add_argument('end', help='HH:MM')
+    query_parser.add_argument('--nights', type=int, default=7)
+    query_parser.add_argument('--last-night', help='YYYY-MM-DD (default: today)')
+    query_parser.add_argument('--column', help='column to summarize (default: the first)')
+    query_parser.add_argument('--data-dir', default='.')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        for csv_filename in sorted(glob.glob(os.path.join(args.data_dir, csv_filename_format.format('*', '*')))):
+            row_count = index_csv(csv_filename)
+            if row_count:
+                print("{}: indexed {} rows".format(csv_filename, row_count))
+    else:
+        last_night = datetime.strptime(args.last_night, '%Y-%m-%d').date() if args.last_night else None
+        start_time = time.time()
+        night_results = query_nights(args.name, args.start, args.end, args.nights, args.data_dir, last_night)
+        for night, result in night_results:
+            if not len(result.times):
+                continue
+            column = args.column or next(iter(result.columns))
+            values = result.columns[column]
+            print("{}: {} rows, {} mean {:.1f}, min {}, max {}".format(
+                night, len(values), column, np.nanmean(values), np.nanmin(values), np.nanmax(values)))
+        print("Read {:.1f} kB in {:.3f} seconds".format(
+            sum(result.bytes_read for _, result in night_results) / 1000, time.time() - start_time))
@@ -1,6 +1,11 @@
-import time
 import random
 import logging
+import threading
+
+import clock
+import latency
+import metrics
+from miband import vibration_seconds
 
 # Notes:
 # The miband4 does not (seem to) support different vibration intensities, rather the values sent (2-255)
@@ -9,14 +14,52 @@ import logging
 # Currently "continuous" mode doesn't work, as it doesn't turn off.
 # This will be fixed shortly.
 
+#This pattern is an example.
+example_pulse_pattern = [[30, 0.01], [60, 0.01], [90, 0.01], [120, 0.01], [150, 0.01], [180, 0.01]]
+
+# Seconds past a program's last pulse before its playback is given up, e.g. when
+#   the band it was queued on disconnected
+playback_timeout_margin = 5
+
+def compile_vibration_program(pulse_pattern, duration_seconds):
+    # Lays [value, delay seconds] pulses out on a timeline, repeating the pattern until
+    #   duration_seconds is reached: each pulse starts once the previous one's motor
+    #   time and delay are over.  Returns (offset seconds, value) writes ending with a
+    #   stop, to be played by miband.play_vibration_program.
+    program = []
+    offset = 0
+    while offset < duration_seconds:
+        round_start = offset
+        for vibrate_value, vibro_delay in pulse_pattern:
+            if offset >= duration_seconds:
+                break
+            program.append((offset, vibrate_value))
+            if vibrate_value != 255 and vibrate_value != 0:
+                offset += vibration_seconds(vibrate_value)
+            offset += vibro_delay
+        if offset == round_start:
+            break
+    program.append((offset, 0))
+    return program
+
+
 class Vibrate():
     vibrate_band = None
     vibration_log = None
-    heartrate_increase_pct = 0
+    _heartrate_increase_pct = 0
+    alarm_trace = None
+    heartrate_alarm_pct = 0
+    buzz_delay = 0
+    buzz_timer = 0
+    # Called with (alarm time, percent) whenever the alarm fires, e.g. to record it
+    on_alarm = None
 
 
     def __init__(self, band):
         self.vibrate_band = band
+        self.alarm_condition = threading.Condition()
+        # Alarm and vibration counts, see metrics.py; labelled per band by multiband
+        self.metric_counts = metrics.counts(source='vibrate')
 
         FORMAT = '%(asctime)-15s %(name)s (%(levelname)s) > %(message)s'
         logging.basicConfig(format=FORMAT)
@@ -25,19 +68,54 @@ class Vibrate():
         self.vibration_log.setLevel(vibration_log_level)
 
 
+    @property
+    def heartrate_increase_pct(self):
+        return self._heartrate_increase_pct
+
+
+    @heartrate_increase_pct.setter
+    def heartrate_increase_pct(self, value):
+        # Written by the data thread; wakes the alarm thread only when the threshold is crossed.
+        self._heartrate_increase_pct = value
+        if value >= self.heartrate_alarm_pct:
+            self.alarm_trace = latency.current_trace()
+            with self.alarm_condition:
+                self.alarm_condition.notify_all()
+
+
+    def configure_heartrate_alarm(self, settings):
+        # heartrate_increase_pct is the detectors' alarm level (see detectors.py), in
+        #   percent of the threshold of the detector closest to alarming.
+        self.heartrate_alarm_pct = 100
+        self.buzz_delay = settings['interval_minutes'] * 60
+        self.buzz_timer = clock.time() - self.buzz_delay
+
+
+    def check_heartrate_alarm(self):
+        # One evaluation of the alarm rule; returns True when the band should buzz now.
+        tick_time = clock.time()
+        elapsed_time = tick_time - self.buzz_timer
+        if self.heartrate_increase_pct >= self.heartrate_alarm_pct:
+            if elapsed_time >= self.buzz_delay:
+                self.vibration_log.info("Heartrate alarm triggered at {} percent of the threshold, buzzing".format(self.heartrate_increase_pct))
+                self.buzz_timer = tick_time
+                self.metric_counts['alarms_total'] += 1
+                if self.on_alarm:
+                    self.on_alarm(tick_time, self.heartrate_increase_pct)
+                return True
+            self.vibration_log.info("Heartrate alarm threshold reached ({} percent of it) but timout not expired".format(self.heartrate_increase_pct))
+            self.metric_counts['alarms_suppressed_total'] += 1
+        return False
+
+
     def heartrate_alarm(self, settings):
         interval_minutes = settings['interval_minutes']
         duration_seconds = settings['duration_seconds']
         vibration_type = settings['type']
-        heartrate_alarm_pct = settings['heartrate_alarm_pct']
 
-        tick_time = time.time()
-        buzz_delay = interval_minutes * 60
-        buzz_timer = tick_time - buzz_delay
+        self.configure_heartrate_alarm(settings)
 
-
-        self.vibration_log.info("Starting heartrate alarm timer, alarming at {} percent for {} seconds with a {} minute interval".format(
-                                                                                                        heartrate_alarm_pct, 
+        self.vibration_log.info("Starting heartrate alarm timer, alarming for {} seconds with a {} minute interval".format(
                                                                                                         duration_seconds, 
                                                                                                         interval_minutes))
         if vibration_type not in ['random', 'pattern', 'rolling', 'continuous']:
@@ -46,23 +124,49 @@ class Vibrate():
             return
 
         while True:
-            elapsed_time = tick_time - buzz_timer
-            if elapsed_time >= buzz_delay and self.heartrate_increase_pct >= heartrate_alarm_pct:
-                self.vibration_log.info("Heartrate alarm triggered at {} percent, buzzing".format(self.heartrate_increase_pct))
-                if vibration_type == 'random':
-                    self.vibrate_random(duration_seconds)
-                elif vibration_type == 'pattern':
-                    self.vibrate_pattern(duration_seconds)
-                elif vibration_type == 'rolling':
-                    self.vibrate_rolling(duration_seconds)
-                elif vibration_type == 'continuous':
-                    self.vibrate_continuous(duration_seconds)
-                buzz_timer = tick_time
-            elif not elapsed_time >= buzz_delay and self.heartrate_increase_pct >= heartrate_alarm_pct:
-                self.vibration_log.info("Heartrate alarm threshold reached ({} percent) but timout not expired".format(self.heartrate_increase_pct))
-            else:
-                tick_time = time.time()
-            time.sleep(0.5)
+            self.wait_for_heartrate_alarm()
+            self.vibrate_type(vibration_type, duration_seconds)
+
+
+    def wait_for_heartrate_alarm(self):
+        # Sleeps until the threshold is reached and the buzz interval has expired.
+        #   While the interval runs the thread waits on a timer for its end rather than polling.
+        with self.alarm_condition:
+            while True:
+                self.alarm_condition.wait_for(lambda: self._heartrate_increase_pct >= self.heartrate_alarm_pct)
+                if self.check_heartrate_alarm():
+                    # The first vibration write is measured against the triggering notification.
+                    latency.set_trace(self.alarm_trace)
+                    latency.mark('alarm_decision')
+                    return
+                buzz_allowed_time = self.buzz_timer + self.buzz_delay
+                while clock.time() < buzz_allowed_time:
+                    self.alarm_condition.wait(buzz_allowed_time - clock.time())
+
+
+    def vibrate_type(self, vibration_type, duration_seconds):
+        # The band sends the pulses itself at their planned times; this only waits for the end.
+        print("Sending {} vibration...".format(vibration_type))
+        program = self.vibration_program(vibration_type, duration_seconds)
+        playback = self.vibrate_band.play_vibration_program(program, latency.take_trace())
+        if not playback.finished.wait(program[-1][0] + playback_timeout_margin):
+            self.vibration_log.warning("Vibration not played within {:.0f} seconds, giving up".format(
+                                                                    program[-1][0] + playback_timeout_margin))
+            playback.abandoned = True
+            return
+        print ("Stopping vibration")
+        self.log_playback(playback)
+
+
+    def vibration_program(self, vibration_type, duration_seconds):
+        self.metric_counts['vibrations_total'] += 1
+        return compile_vibration_program(self.pulse_pattern(vibration_type), duration_seconds)
+
+
+    def log_playback(self, playback):
+        mean_jitter_ms, max_jitter_ms = playback.jitter_ms()
+        self.vibration_log.info("Sent {} pulses, jitter mean {:.1f} ms, max {:.1f} ms".format(
+                                                                len(playback.jitter), mean_jitter_ms, max_jitter_ms))
 
 
     def timed_vibration(self, settings):
@@ -70,8 +174,7 @@ class Vibrate():
         duration_seconds = settings['duration_seconds']
         type = settings['type']
         
-        buzz_timer = time.time() 
-        tick_time = time.time()
+        buzz_timer = clock.time() 
         buzz_delay = interval_minutes * 60
 
         self.vibration_log.info("Starting vibration timer: {} minutes".format(interval_minutes))
@@ -82,22 +185,10 @@ class Vibrate():
             return
 
         while True:
-            elapsed_time = tick_time - buzz_timer
-            if elapsed_time >= buzz_delay:
-                print("Buzz timer expired, buzzing")
-                if type == 'random':
-                    self.vibrate_random(duration_seconds)
-                elif type == 'pattern':
-                    self.vibrate_pattern(duration_seconds)
-                elif type == 'rolling':
-                    self.vibrate_rolling(duration_seconds)
-                elif type == 'continuous':
-                    self.vibrate_continuous(duration_seconds)
-
-                buzz_timer = tick_time
-            else:
-                tick_time = time.time()
-            time.sleep(0.5)
+            clock.sleep(max(buzz_timer + buzz_delay - clock.time(), 0))
+            print("Buzz timer expired, buzzing")
+            buzz_timer = clock.time()
+            self.vibrate_type(type, duration_seconds)
 
 
     def generate_random_vibration_pattern(self, pulse_count):
@@ -119,78 +210,15 @@ class Vibrate():
         return output_pulse_pattern
 
 
-    def vibrate_random(self, duration_seconds):
-        print("Sending random vibration...")
-        duration_start = time.time()
-
-        pattern_length = 20  #This value is arbitrary
-
-        pulse_pattern = self.generate_random_vibration_pattern(pattern_length)
-
-        while True:
-            if (time.time() - duration_start) >= duration_seconds:
-                print ("Stopping vibration")
-                self.vibrate_band.vibrate(0)
-                break
-            else:
-                for pattern in pulse_pattern:
-                    if (time.time() - duration_start) >= duration_seconds:
-                        break
-                    vibrate_ms = pattern[0]
-                    vibro_delay = pattern[1]
-                    self.vibrate_band.vibrate(vibrate_ms)
-                    time.sleep(vibro_delay)
-
-
-    def vibrate_pattern(self, duration_seconds):
-        print("Sending vibration...")
-        duration_start = time.time()
-
-        #This pattern is an example.
-        pulse_pattern = [[30, 0.01], [60, 0.01], [90, 0.01], [120, 0.01], [150, 0.01], [180, 0.01]]
-
-        while True:
-            if (time.time() - duration_start) >= duration_seconds:
-                print ("Stopping vibration")
-                self.vibrate_band.vibrate(0)
-                break
-            else:
-                for pattern in pulse_pattern:
-                    if (time.time() - duration_start) >= duration_seconds:
-                        break
-                    vibrate_ms = pattern[0]
-                    vibro_delay = pattern[1]
-                    self.vibrate_band.vibrate(vibrate_ms)
-                    time.sleep(vibro_delay)
-
-
-    def vibrate_rolling(self, duration_seconds):
-        print("Sending rolling vibration...")
-
-        duration_start = time.time()
-        
-        while True:
-            if (time.time() - duration_start) >= duration_seconds:
-                print ("Stopping vibration")
-                self.vibrate_band.vibrate(0)
-                break
-            else:
-                for x in range(10):
-                    for x in range(20, 40, 1):
-                        self.vibrate_band.vibrate(x)
-                    for x in range(40, 20, -1):
-                        self.vibrate_band.vibrate(x)
-
-    def vibrate_continuous(self, duration_seconds):
-        #Currently broken, still working on this bit.
-        print("Sending continuous vibration...")
-
-        duration_start = time.time()
-        
-        while True:
-            if (time.time() - duration_start) >= duration_seconds:
-                print ("Stopping vibration")
-                self.vibrate_band.vibrate(0)
-                break
-            else:
-                self.vibrate_band.vibrate(1)
+    def pulse_pattern(self, vibration_type):
+        # One round of a vibration type as [value, delay seconds] pulses.
+        if vibration_type == 'random':
+            pattern_length = 20  #This value is arbitrary
+            return self.generate_random_vibration_pattern(pattern_length)
+        elif vibration_type == 'pattern':
+            return example_pulse_pattern
+        elif vibration_type == 'rolling':
+            return [[x, 0] for x in range(20, 40, 1)] + [[x, 0] for x in range(40, 20, -1)]
+        elif vibration_type == 'continuous':
+            #Currently broken, still working on this bit.
+            return [[1, 0]]